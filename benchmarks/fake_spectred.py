@@ -0,0 +1,324 @@
+import argparse
+import asyncio
+import hashlib
+
+import grpc
+
+from spectred import messages_pb2_grpc
+from spectred.messages_pb2 import SpectredResponse
+from spectred.rpc_pb2 import RpcBlock
+
+# Local stand-in for a spectred node: serves the protowire.RPC/MessageStream
+# service over a synthetic DAG, so that the crawl and everything after it can
+# be run and measured without a node. Implements the requests the scripts
+# send (getInfo, getBlockDagInfo, GetSink, getBlocks, getBlock and
+# getVirtualChainFromBlock).
+#
+# The DAG is deterministic for the same parameters. Every
+# `mergeset_width`-th block is a chain block whose mergeset holds the blocks
+# since the previous chain block, and every block has a coinbase transaction
+# from one of `miners` miners plus `txs_per_block - 1` transactions that each
+# spend an output of an earlier block.
+
+COINBASE_SUBNETWORK_ID = "0100000000000000000000000000000000000000"
+NATIVE_SUBNETWORK_ID = "0000000000000000000000000000000000000000"
+GENESIS_TIMESTAMP = 1_700_000_000_000
+
+
+def sha256(s):
+    return hashlib.sha256(s.encode()).hexdigest()
+
+
+# Coinbase payload: blue score and subsidy (16 bytes), script version, a
+# pay-to-pubkey script and the miner's version string
+def coinbase_payload(miner):
+    pubkey = sha256(f"miner{miner}")
+    info = f"0.3.{miner % 20}/synthetic".encode().hex()
+    return "00" * 16 + "0000" + "22" + "20" + pubkey + "ac" + info
+
+
+class SyntheticDag(object):
+    def __init__(
+        self,
+        blocks=10_000,
+        blocks_per_second=1,
+        txs_per_block=10,
+        mergeset_width=3,
+        miners=100,
+        addresses=10_000,
+        pruning_point=0,
+    ):
+        self.blocks_per_second = blocks_per_second
+        self.txs_per_block = txs_per_block
+        self.mergeset_width = mergeset_width
+        self.miners = miners
+        self.addresses = [f"spectre:q{sha256(f'a{i}')[:60]}" for i in range(addresses)]
+        self.payloads = [coinbase_payload(i) for i in range(miners)]
+
+        self.hashes = [sha256(f"b{i}") for i in range(blocks)]
+        self.index = {hash: i for i, hash in enumerate(self.hashes)}
+        self.chain = list(range(0, blocks, mergeset_width))
+        self.pruning_point = self.chain[pruning_point // mergeset_width]
+
+    def is_chain_block(self, i):
+        return i % self.mergeset_width == 0
+
+    def selected_parent(self, i):
+        return (i - 1) - ((i - 1) % self.mergeset_width)
+
+    def tx_id(self, i, j):
+        return sha256(f"t{i}-{j}")
+
+    def tip(self):
+        return self.chain[-1]
+
+    def block(self, i, include_transactions=True):
+        b = RpcBlock()
+        header = b.header
+        header.version = 1
+        header.timestamp = GENESIS_TIMESTAMP + int(i * 1000 / self.blocks_per_second)
+        header.daaScore = 1000 + i
+        header.blueScore = 900 + i
+        header.bits = 0x1E7FFFFF
+        header.parents.add().parentHashes.extend(
+            [self.hashes[i - 1]] if i else [sha256("genesis")]
+        )
+
+        verbose = b.verboseData
+        verbose.hash = self.hashes[i]
+        verbose.difficulty = 1234.5
+        verbose.blueScore = header.blueScore
+        verbose.isChainBlock = self.is_chain_block(i)
+        if i:
+            verbose.selectedParentHash = self.hashes[self.selected_parent(i)]
+        if self.is_chain_block(i) and i:
+            verbose.mergeSetBluesHashes.extend(
+                self.hashes[i - self.mergeset_width + 1 : i]
+            )
+
+        if include_transactions:
+            for j in range(self.txs_per_block):
+                self.add_transaction(b, i, j)
+        return b
+
+    def add_transaction(self, b, i, j):
+        tx = b.transactions.add()
+        tx.version = 0
+        tx.verboseData.transactionId = self.tx_id(i, j)
+        tx.verboseData.blockHash = self.hashes[i]
+        tx.verboseData.blockTime = b.header.timestamp
+
+        if j == 0:
+            tx.subnetworkId = COINBASE_SUBNETWORK_ID
+            tx.payload = self.payloads[i % self.miners]
+            amounts = [50_000_000_000]
+        else:
+            tx.subnetworkId = NATIVE_SUBNETWORK_ID
+            # Spend the outputs of the same transaction a few chain blocks back
+            prev = i - 2 * self.mergeset_width
+            for index in range(2):
+                input = tx.inputs.add()
+                input.previousOutpoint.transactionId = (
+                    self.tx_id(prev, j) if prev >= 0 else sha256(f"utxo{i}-{j}")
+                )
+                input.previousOutpoint.index = index
+                input.sequence = 0
+                input.sigOpCount = 1
+            amounts = [100_000_000 * j + i, 5000]
+
+        for k, amount in enumerate(amounts):
+            output = tx.outputs.add()
+            output.amount = amount
+            output.scriptPublicKey.scriptPublicKey = "20" + sha256(f"s{i}-{j}") + "ac"
+            output.verboseData.scriptPublicKeyType = "pubkey"
+            output.verboseData.scriptPublicKeyAddress = self.addresses[
+                (i * self.txs_per_block + j + k) % len(self.addresses)
+            ]
+
+    # Chain blocks after the block at start, with the transactions they accept
+    # (those of their mergeset, the selected parent included)
+    def virtual_chain(self, start, limit=None):
+        chain = [c for c in self.chain if c > start][:limit]
+        accepted = []
+        for c in chain:
+            accepted.append(
+                (
+                    self.hashes[c],
+                    [
+                        self.tx_id(m, j)
+                        for m in range(c - self.mergeset_width, c)
+                        for j in range(self.txs_per_block)
+                    ],
+                )
+            )
+        return [self.hashes[c] for c in chain], accepted
+
+
+class FakeSpectred(messages_pb2_grpc.RPCServicer):
+    def __init__(self, dag, page_size=500, vspc_limit=None):
+        self.dag = dag
+        self.page_size = page_size
+        self.vspc_limit = vspc_limit
+        self.blocks = {}  # Built once, the server should not be the bottleneck
+
+    def get_block(self, i, include_transactions=True):
+        block = self.blocks.get(i)
+        if block is None:
+            block = self.blocks[i] = self.dag.block(i)
+        if include_transactions:
+            return block
+        light = RpcBlock()
+        light.CopyFrom(block)
+        light.ClearField("transactions")
+        return light
+
+    def respond(self, request):
+        dag = self.dag
+        r = SpectredResponse()
+        r.id = request.id
+        kind = request.WhichOneof("payload")
+        req = getattr(request, kind)
+
+        if kind == "getInfoRequest":
+            resp = r.getInfoResponse
+            resp.p2pId = "fake-spectred"
+            resp.serverVersion = "0.0.0-synthetic"
+            resp.isUtxoIndexed = True
+            resp.isSynced = True
+        elif kind == "getBlockDagInfoRequest":
+            resp = r.getBlockDagInfoResponse
+            resp.networkName = "spectre-synthetic"
+            resp.blockCount = len(dag.hashes)
+            resp.pruningPointHash = dag.hashes[dag.pruning_point]
+            resp.sink = dag.hashes[dag.tip()]
+            resp.virtualDaaScore = 1000 + len(dag.hashes)
+        elif kind == "GetSinkRequest":
+            r.GetSinkResponse.sink = dag.hashes[dag.tip()]
+        elif kind == "getBlocksRequest":
+            resp = r.getBlocksResponse
+            low = dag.index.get(req.lowHash)
+            if low is None:
+                resp.error.message = f"Block {req.lowHash} not found"
+            else:
+                for i in range(low, min(low + self.page_size, dag.tip() + 1)):
+                    resp.blockHashes.append(dag.hashes[i])
+                    if req.includeBlocks:
+                        resp.blocks.append(self.get_block(i, req.includeTransactions))
+        elif kind == "getBlockRequest":
+            resp = r.getBlockResponse
+            i = dag.index.get(req.hash)
+            if i is None:
+                resp.error.message = f"Block {req.hash} not found"
+            else:
+                resp.block.CopyFrom(self.get_block(i, req.includeTransactions))
+        elif kind == "getVirtualChainFromBlockRequest":
+            resp = r.getVirtualChainFromBlockResponse
+            resp.SetInParent()
+            start = dag.index.get(req.startHash)
+            if start is None:
+                resp.error.message = f"Block {req.startHash} not found"
+            else:
+                added, accepted = dag.virtual_chain(start, self.vspc_limit)
+                resp.addedChainBlockHashes.extend(added)
+                if req.includeAcceptedTransactionIds:
+                    for hash, tx_ids in accepted:
+                        d = resp.acceptedTransactionIds.add()
+                        d.acceptingBlockHash = hash
+                        d.acceptedTransactionIds.extend(tx_ids)
+        else:
+            # Answer with the matching response type so the client does not
+            # wait for it until its timeout
+            getattr(
+                r, kind.replace("Request", "Response")
+            ).error.message = f"{kind} is not supported by the fake node"
+        return r
+
+    async def MessageStream(self, request_iterator, context):
+        async for request in request_iterator:
+            await context.write(self.respond(request))
+
+
+## Main
+async def serve(args):
+    dag = SyntheticDag(
+        blocks=args.blocks,
+        blocks_per_second=args.bps,
+        txs_per_block=args.txs,
+        mergeset_width=args.mergeset_width,
+        miners=args.miners,
+        addresses=args.addresses,
+        pruning_point=args.pruning_point,
+    )
+    server = grpc.aio.server()
+    messages_pb2_grpc.add_RPCServicer_to_server(
+        FakeSpectred(dag, args.page_size, args.vspc_limit), server
+    )
+    port = server.add_insecure_port(f"localhost:{args.port}")
+    await server.start()
+    # benchmarks.run waits for this line
+    print(f"Listening on localhost:{port}", flush=True)
+    await server.wait_for_termination()
+
+
+def add_dag_arguments(parser):
+    parser.add_argument(
+        "--blocks", type=int, default=10_000, help="blocks (default: 10000)"
+    )
+    parser.add_argument(
+        "--bps", type=float, default=1, help="blocks per second (default: 1)"
+    )
+    parser.add_argument(
+        "--txs",
+        type=int,
+        default=10,
+        help="transactions per block, the coinbase included (default: 10)",
+    )
+    parser.add_argument(
+        "--mergeset-width",
+        type=int,
+        default=3,
+        help="blocks per chain block mergeset (default: 3)",
+    )
+    parser.add_argument(
+        "--miners", type=int, default=100, help="distinct miners (default: 100)"
+    )
+    parser.add_argument(
+        "--addresses",
+        type=int,
+        default=10_000,
+        help="distinct output addresses (default: 10000)",
+    )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Serve a synthetic DAG over the spectred gRPC interface."
+    )
+    parser.add_argument("--port", type=int, default=18110, help="(default: 18110)")
+    add_dag_arguments(parser)
+    parser.add_argument(
+        "--pruning-point",
+        type=int,
+        default=0,
+        help="position of the pruning point block (default: 0)",
+    )
+    parser.add_argument(
+        "--page-size",
+        type=int,
+        default=500,
+        help="max blocks per getBlocks response (default: 500)",
+    )
+    parser.add_argument(
+        "--vspc-limit",
+        type=int,
+        default=None,
+        help="max chain blocks per getVirtualChainFromBlock response (default: all)",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(serve(parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,52 @@
+import json
+import resource
+import subprocess
+import sys
+import time
+
+# Runs a command with its output going to a log file and prints the wall time
+# and peak RSS as JSON. The peak RSS is that of the largest process, the
+# command itself or one of its workers. A process only sees the peak over all
+# of its children so far, so benchmarks.run starts one of these per benchmark.
+#
+#   python -m benchmarks.measure LOG_FILE CWD COMMAND...
+
+
+## Helpers
+def peak_rss_bytes():
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+# {"items": ..., "seconds": ...} printed last by the command, if any
+def reported_result(log_file):
+    with open(log_file, "rb") as f:
+        lines = f.read().splitlines()
+    if not lines:
+        return {}
+    try:
+        result = json.loads(lines[-1])
+    except ValueError:
+        return {}
+    return result if isinstance(result, dict) else {}
+
+
+## Main
+if __name__ == "__main__":
+    log_file, cwd, *command = sys.argv[1:]
+
+    started = time.perf_counter()
+    with open(log_file, "wb") as log:
+        returncode = subprocess.call(
+            command, cwd=cwd, stdout=log, stderr=subprocess.STDOUT
+        )
+    wall_time = time.perf_counter() - started
+
+    result = {
+        "returncode": returncode,
+        "wall_time": wall_time,
+        "peak_rss": peak_rss_bytes(),
+    }
+    result.update(reported_result(log_file))
+    print(json.dumps(result))
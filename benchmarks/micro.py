@@ -0,0 +1,89 @@
+import argparse
+import json
+import time
+
+from benchmarks.fake_spectred import FakeSpectred, SyntheticDag, add_dag_arguments
+from helper.block_state import BlockState
+from helper.crawl import apply_vspc
+from helper.mining_address import decode_payloads
+from spectred.SpectredThread import build_request
+
+# Benchmarks of single steps on synthetic data, without a server. Each one
+# builds its input first and prints {"items": ..., "seconds": ...} for the
+# timed part as the last line, see benchmarks.run.
+
+
+## Helpers
+# Applies the virtual chain of the whole DAG to an empty block state in memory,
+# in getVirtualChainFromBlock responses of `chunk` chain blocks
+def bench_vspc(dag, chunk):
+    node = FakeSpectred(dag, vspc_limit=chunk)
+    responses = []
+    start = dag.pruning_point
+    while True:
+        r = node.respond(
+            build_request(
+                "getVirtualChainFromBlockRequest",
+                {"startHash": dag.hashes[start], "includeAcceptedTransactionIds": True},
+            )
+        ).getVirtualChainFromBlockResponse
+        if not r.addedChainBlockHashes:
+            break
+        responses.append(r)
+        start = dag.index[r.addedChainBlockHashes[-1]]
+
+    with BlockState(":memory:") as state:
+        started = time.perf_counter()
+        for vspc in responses:
+            apply_vspc(vspc, state, None)
+        seconds = time.perf_counter() - started
+        return state.count_accepted(), seconds
+
+
+# Decodes one coinbase payload per block. Payloads of the same miner differ
+# in their blue score, like on the network.
+def bench_payloads(dag):
+    payloads = [
+        (900 + i).to_bytes(8, "little").hex() + dag.payloads[i % dag.miners][16:]
+        for i in range(len(dag.hashes))
+    ]
+
+    started = time.perf_counter()
+    results = decode_payloads(payloads)
+    seconds = time.perf_counter() - started
+    assert all(r is not None for r in results)
+    return len(payloads), seconds
+
+
+## Main
+def main(args):
+    dag = SyntheticDag(
+        blocks=args.blocks,
+        blocks_per_second=args.bps,
+        txs_per_block=args.txs,
+        mergeset_width=args.mergeset_width,
+        miners=args.miners,
+        addresses=args.addresses,
+    )
+    if args.benchmark == "vspc":
+        items, seconds = bench_vspc(dag, args.vspc_limit)
+    else:
+        items, seconds = bench_payloads(dag)
+    print(json.dumps({"items": items, "seconds": seconds}))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run one micro benchmark.")
+    parser.add_argument("benchmark", choices=["vspc", "payloads"])
+    add_dag_arguments(parser)
+    parser.add_argument(
+        "--vspc-limit",
+        type=int,
+        default=1000,
+        help="chain blocks per virtual chain response (default: 1000)",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,230 @@
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+
+from benchmarks.fake_spectred import add_dag_arguments
+
+# Offline benchmark suite: starts benchmarks.fake_spectred with a synthetic
+# DAG, crawls it with save_blocks.py into a scratch directory and runs the
+# analysis scripts on the result, plus the micro benchmarks of
+# benchmarks.micro. Reports the throughput and peak RSS of every step.
+#
+#   python -m benchmarks.run [--blocks N] [--txs N] ... [BENCHMARK ...]
+#
+# Run it from the repository root. --json saves the results, --compare shows
+# the throughput relative to saved results.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# name: (command, throughput unit, benchmarks whose output it needs). "{...}"
+# fields are filled in from the arguments.
+BENCHMARKS = {
+    "crawl": (
+        ["save_blocks.py", "--fresh", "--nodes", "localhost:{port}"],
+        "blocks",
+        [],
+    ),
+    "crawl_segments": (
+        [
+            "save_blocks.py",
+            "--fresh",
+            "--nodes",
+            "localhost:{port}",
+            "--segments",
+            "{segments}",
+        ],
+        "blocks",
+        [],
+    ),
+    "vspc": (["-m", "benchmarks.micro", "vspc", "{dag_args}"], "txs", []),
+    "payloads": (
+        ["-m", "benchmarks.micro", "payloads", "{dag_args}"],
+        "payloads",
+        [],
+    ),
+    "spent_outputs": (["filter_spent_outputs.py"], "blocks", ["crawl"]),
+    "block_tx_analysis": (
+        ["block_tx_analysis.py"],
+        "blocks",
+        ["crawl", "spent_outputs"],
+    ),
+    "mining_analysis": (["prepare_mining_analysis.py"], "blocks", ["crawl"]),
+}
+
+
+## Helpers
+def free_port():
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+def dag_args(args):
+    return [
+        f"--blocks={args.blocks}",
+        f"--bps={args.bps}",
+        f"--txs={args.txs}",
+        f"--mergeset-width={args.mergeset_width}",
+        f"--miners={args.miners}",
+        f"--addresses={args.addresses}",
+    ]
+
+
+def start_server(args, port):
+    server = subprocess.Popen(
+        [sys.executable, "-m", "benchmarks.fake_spectred", f"--port={port}"]
+        + dag_args(args),
+        cwd=ROOT,
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    line = server.stdout.readline()
+    if not line.startswith("Listening"):
+        server.kill()
+        raise RuntimeError("The fake node did not start")
+    return server
+
+
+def build_command(name, args, port):
+    command, _, _ = BENCHMARKS[name]
+    fields = {"port": port, "segments": args.segments}
+    argv = []
+    for arg in command:
+        if arg == "{dag_args}":
+            argv.extend(dag_args(args))
+        else:
+            argv.append(arg.format(**fields))
+    # Scripts run in the scratch directory, modules in the repository
+    if argv[0] == "-m":
+        return [sys.executable] + argv, ROOT
+    return [sys.executable, os.path.join(ROOT, argv[0])] + argv[1:], args.workdir
+
+
+def run_benchmark(name, args, port):
+    command, cwd = build_command(name, args, port)
+    log_file = os.path.join(args.workdir, f"{name}.log")
+    out = subprocess.run(
+        [sys.executable, "-m", "benchmarks.measure", log_file, cwd] + command,
+        cwd=ROOT,
+        stdout=subprocess.PIPE,
+        text=True,
+        check=True,
+    )
+    result = json.loads(out.stdout)
+    if result["returncode"]:
+        with open(log_file) as f:
+            tail = f.readlines()[-20:]
+        raise RuntimeError(f"{name} failed, end of {log_file}:\n{''.join(tail)}")
+
+    _, unit, _ = BENCHMARKS[name]
+    if "items" not in result:
+        # Scripts handle every block of the DAG up to the tip
+        result["items"] = args.blocks - (args.blocks - 1) % args.mergeset_width
+        result["seconds"] = result["wall_time"]
+    result["unit"] = unit
+    result["throughput"] = result["items"] / result["seconds"]
+    return result
+
+
+def print_results(results, baseline=None):
+    header = (
+        f"{'benchmark':<20}{'seconds':>9}{'items':>10}  "
+        f"{'throughput':<20}{'peak RSS':>10}"
+    )
+    if baseline is not None:
+        header += f"{'vs. saved':>11}"
+    print(header)
+    for name, r in results.items():
+        line = (
+            f"{name:<20}{r['seconds']:>9.2f}{r['items']:>10}  "
+            f"{r['throughput']:>10.0f} {r['unit'] + '/s':<9}"
+            f"{r['peak_rss'] / 2**20:>7.0f} MB"
+        )
+        if baseline is not None and name in baseline:
+            line += f"{r['throughput'] / baseline[name]['throughput']:>10.2f}x"
+        print(line)
+
+
+## Main
+def main(args):
+    names = args.benchmarks or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            sys.exit(f"Unknown benchmark {name}, choose from {', '.join(BENCHMARKS)}")
+
+    keep_workdir = args.workdir is not None
+    if not keep_workdir:
+        args.workdir = tempfile.mkdtemp(prefix="spectre-bench-")
+    os.makedirs(os.path.join(args.workdir, "data"), exist_ok=True)
+
+    port = free_port()
+    server = start_server(args, port)
+    results = {}
+    try:
+        # Both crawls write the same store
+        done = set()
+        for name in names:
+            for setup in BENCHMARKS[name][2]:
+                if setup not in done:
+                    print(f"Running {setup} for {name} (not reported)", flush=True)
+                    run_benchmark(setup, args, port)
+                    done.add(setup)
+
+            print(f"Running {name}", flush=True)
+            results[name] = run_benchmark(name, args, port)
+            done.add("crawl" if name.startswith("crawl") else name)
+    finally:
+        server.terminate()
+        server.wait()
+        if not keep_workdir:
+            shutil.rmtree(args.workdir, ignore_errors=True)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+    print_results(results, baseline)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"dag": dag_args(args), "results": results}, f, indent=2)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the crawl and the analysis on a synthetic DAG."
+    )
+    parser.add_argument(
+        "benchmarks",
+        nargs="*",
+        metavar="BENCHMARK",
+        help=f"benchmarks to run (default: all): {', '.join(BENCHMARKS)}",
+    )
+    add_dag_arguments(parser)
+    parser.add_argument(
+        "--segments",
+        type=int,
+        default=4,
+        help="segments of the crawl_segments benchmark (default: 4)",
+    )
+    parser.add_argument(
+        "--workdir",
+        help="keep the store and the logs in this directory (default: a "
+        "temporary directory that is removed)",
+    )
+    parser.add_argument("--json", metavar="PATH", help="save the results to PATH")
+    parser.add_argument(
+        "--compare",
+        metavar="PATH",
+        help="show the throughput relative to results saved with --json",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main(parse_args())
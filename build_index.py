@@ -0,0 +1,20 @@
+import os
+import sys
+
+from helper.block_index import INDEX_FILE, BlockIndex, index_store
+from helper.block_store import find_blocks_file
+
+# Build the SQLite block index from a store crawled without --index, or from
+# the data/block.json dump of old crawls. save_blocks.py keeps the index up to
+# date from then on.
+blocks_file = find_blocks_file()
+if not os.path.exists(blocks_file):
+    sys.exit(f"No block store at {blocks_file}, crawl one with save_blocks.py")
+
+index_store(blocks_file, INDEX_FILE)
+
+with BlockIndex(INDEX_FILE) as index:
+    for table in ("blocks", "transactions", "outputs"):
+        print(f"{table}: {index.count(table):,}")
+
+print(f"Successfully written to {INDEX_FILE}")
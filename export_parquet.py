@@ -0,0 +1,70 @@
+import argparse
+import os
+import sys
+
+from helper.block_store import find_blocks_file
+
+try:
+    from helper.parquet_export import PARQUET_DIR, export_store
+except ImportError as e:
+    # pyarrow is only needed for this export
+    sys.exit(
+        f"The Parquet export needs pyarrow ({e}), install it with: pip install pyarrow"
+    )
+
+# Exports the block store to Parquet tables of blocks, transactions, inputs,
+# outputs and mergeset edges (see helper/parquet_export.py), partitioned by
+# day or DAA score range. The whole export is rewritten on every run, the
+# legacy data/block.json dump of old crawls is exported if there is no store.
+
+
+## Main
+def main(args):
+    blocks_file = find_blocks_file()
+    if not os.path.exists(blocks_file) or not os.path.getsize(blocks_file):
+        sys.exit(f"No blocks in {blocks_file}, crawl them with save_blocks.py")
+
+    rows = export_store(
+        blocks_file,
+        args.out,
+        daa_range_size=args.daa_range,
+        workers=args.workers,
+        compression=args.compression,
+    )
+    for table, count in rows.items():
+        print(f"{table}: {count:,}")
+    if not rows["blocks"]:
+        sys.exit(f"No blocks could be read from {blocks_file}")
+    print(f"Successfully written to {args.out}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Export the block store to partitioned Parquet tables."
+    )
+    parser.add_argument(
+        "--out", default=PARQUET_DIR, help=f"output directory (default: {PARQUET_DIR})"
+    )
+    parser.add_argument(
+        "--daa-range",
+        type=int,
+        default=None,
+        metavar="SIZE",
+        help="partition by DAA score ranges of this size instead of by day",
+    )
+    parser.add_argument(
+        "--compression",
+        default="zstd",
+        help="Parquet compression codec, e.g. zstd, snappy or none (default: zstd)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="processes exporting ranges of the store (default: all cores)",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -1,34 +1,72 @@
 import json
+import os
 
-# Input and output paths
-blocks_file = r"data\block.json"
-output_file = r"data\spent-outputs.json"
+from helper.block_store import find_blocks_file, iter_blocks
+from helper.outpoint_index import OUTPOINTS_FILE, OutpointIndexWriter
+from helper.sharding import map_shards
 
-# init outputs dictionary
-outputs = {}
-referenced_outputs = {}
+# Also write the legacy spent-outputs.json (large, slow to load)
+WRITE_JSON = False
+# Read ranges of the store in this many processes
+WORKERS = os.cpu_count() or 1
 
-with open(blocks_file, "r") as f:
-    blocks_data = json.load(f)["blocks"]
+# Output paths, the input is the block store
+output_file = OUTPOINTS_FILE
+json_output_file = r"data\spent-outputs.json"
 
-# Iterate through each block and its transactions
-for block_hash, block_data in blocks_data.items():
-    for transaction in block_data.get("transactions", []):
-        # Iterate through transaction outputs
-        for index, output in enumerate(transaction.get("outputs", [])):
-            # Construct the unique key for each output
-            transaction_id = transaction["verboseData"]["transactionId"]
-            unique_key = f"{transaction_id}-{index}"
 
-            # amount and address
-            amount = int(output["amount"])
-            address = output["verboseData"]["scriptPublicKeyAddress"]
+## Helpers
+# Outputs of the blocks in one shard of the store (see helper.sharding)
+def collect_outputs(shard, blocks_file, write_json=False):
+    start, end = shard
 
-            # Add to outputs dictionary
-            outputs[unique_key] = {"amount": amount, "address": address}
+    # init outputs index
+    outputs = OutpointIndexWriter()
+    json_outputs = {}
 
-# Write the outputs to spent-outputs.json
-with open(output_file, "w") as f:
-    json.dump({"outputs": outputs}, f, indent=4)
+    # Iterate through each block and its transactions, reading the stored
+    # RpcBlock messages directly
+    for _, block_data in iter_blocks(blocks_file, raw=True, start=start, end=end):
+        for transaction in block_data.transactions:
+            transaction_id = transaction.verboseData.transactionId
 
-print(f"Successfully written to {output_file}")
+            # Iterate through transaction outputs
+            for index, output in enumerate(transaction.outputs):
+                # amount and address
+                amount = output.amount
+                address = output.verboseData.scriptPublicKeyAddress
+
+                # Add to outputs index, keyed by (txid, index)
+                outputs.add(transaction_id, index, amount, address)
+
+                if write_json:
+                    unique_key = f"{transaction_id}-{index}"
+                    json_outputs[unique_key] = {"amount": amount, "address": address}
+
+    return outputs, json_outputs
+
+
+## Main
+if __name__ == "__main__":
+    blocks_file = find_blocks_file()  # or the data/block.json dump of old crawls
+
+    outputs = OutpointIndexWriter()
+    json_outputs = {}
+
+    # Shards are merged in store order, outputs added again by later blocks are
+    # dropped when the index is saved
+    for shard_outputs, shard_json_outputs in map_shards(
+        collect_outputs, blocks_file, WORKERS, blocks_file, WRITE_JSON
+    ):
+        outputs.merge(shard_outputs)
+        json_outputs.update(shard_json_outputs)
+
+    # Write the outputs to the outpoint index
+    count = outputs.save(output_file)
+    print(f"Successfully written {count} outputs to {output_file}")
+
+    if WRITE_JSON:
+        with open(json_output_file, "w") as f:
+            json.dump({"outputs": json_outputs}, f, indent=4)
+
+        print(f"Successfully written to {json_output_file}")
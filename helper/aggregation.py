@@ -0,0 +1,424 @@
+import copy
+import hashlib
+import heapq
+import math
+from array import array
+
+# Accumulators for single-pass analyses over a block iterator. Every
+# accumulator takes values one at a time with add() and keeps only what its
+# result needs, so statistics can be collected while blocks are streamed
+# instead of from lists of every value seen. Accumulators of the same kind
+# can be merged, e.g. the partial results of shards analyzed in parallel.
+
+
+def interpolate(sorted_values, q):
+    pos = (len(sorted_values) - 1) * q
+    lo, hi = math.floor(pos), math.ceil(pos)
+    if lo == hi:
+        return sorted_values[lo]
+    if pos - lo == 0.5:
+        # Midpoint like statistics.median, exact for large ints
+        return (sorted_values[lo] + sorted_values[hi]) / 2
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (pos - lo)
+
+
+class Accumulator(object):
+    def add(self, value):
+        raise NotImplementedError
+
+    def update(self, values):
+        for value in values:
+            self.add(value)
+
+    def merge(self, other):
+        raise NotImplementedError
+
+    def result(self):
+        raise NotImplementedError
+
+
+class Count(Accumulator):
+    def __init__(self):
+        self.count = 0
+
+    def add(self, value=None):
+        self.count += 1
+
+    def merge(self, other):
+        self.count += other.count
+
+    def result(self):
+        return self.count
+
+
+class Sum(Accumulator):
+    def __init__(self):
+        self.total = 0
+
+    def add(self, value):
+        self.total += value
+
+    def merge(self, other):
+        self.total += other.total
+
+    def result(self):
+        return self.total
+
+
+class Min(Accumulator):
+    def __init__(self):
+        self.value = None
+
+    def add(self, value):
+        if self.value is None or value < self.value:
+            self.value = value
+
+    def merge(self, other):
+        if other.value is not None:
+            self.add(other.value)
+
+    def result(self):
+        return self.value
+
+
+class Max(Accumulator):
+    def __init__(self):
+        self.value = None
+
+    def add(self, value):
+        if self.value is None or value > self.value:
+            self.value = value
+
+    def merge(self, other):
+        if other.value is not None:
+            self.add(other.value)
+
+    def result(self):
+        return self.value
+
+
+class ExactQuantiles(Accumulator):
+    # Exact order statistics. Values are kept in a typed array (8 bytes per
+    # value instead of a boxed int in a list) and sorted once when queried.
+    def __init__(self, typecode="q"):
+        self.values = array(typecode)
+        self.sorted = True
+
+    def add(self, value):
+        self.values.append(value)
+        self.sorted = False
+
+    def merge(self, other):
+        self.values.extend(other.values)
+        self.sorted = False
+
+    def quantile(self, q):
+        if not self.values:
+            return None
+        if not self.sorted:
+            self.values = array(self.values.typecode, sorted(self.values))
+            self.sorted = True
+        return interpolate(self.values, q)
+
+    def result(self):
+        return self.quantile(0.5)
+
+
+class StreamingQuantile(Accumulator):
+    # P² estimate of a single quantile (Jain & Chlamtac, 1985) in constant
+    # memory. Exact for up to 5 values, an approximation after that.
+    def __init__(self, q=0.5):
+        self.q = q
+        self.heights = []
+        self.positions = [1, 2, 3, 4, 5]
+        self.desired = [1, 1 + 2 * q, 1 + 4 * q, 3 + 2 * q, 5]
+        self.increments = [0, q / 2, q, (1 + q) / 2, 1]
+
+    def add(self, value):
+        heights = self.heights
+        if len(heights) < 5:
+            heights.append(value)
+            heights.sort()
+            return
+
+        if value < heights[0]:
+            heights[0] = value
+            k = 0
+        elif value >= heights[4]:
+            heights[4] = value
+            k = 3
+        else:
+            k = next(i for i in range(4) if heights[i] <= value < heights[i + 1])
+
+        for i in range(k + 1, 5):
+            self.positions[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+
+        for i in range(1, 4):
+            d = self.desired[i] - self.positions[i]
+            if (d >= 1 and self.positions[i + 1] - self.positions[i] > 1) or (
+                d <= -1 and self.positions[i - 1] - self.positions[i] < -1
+            ):
+                d = 1 if d > 0 else -1
+                height = self.__parabolic(i, d)
+                if not heights[i - 1] < height < heights[i + 1]:
+                    height = self.__linear(i, d)
+                heights[i] = height
+                self.positions[i] += d
+
+    # Merges the estimate of other values, approximately: the ranks of both
+    # estimates are interpolated linearly between their markers and added up,
+    # the markers are placed where the sum reaches their desired ranks
+    def merge(self, other):
+        if len(other.heights) < 5:
+            for value in other.heights:
+                self.add(value)
+            return
+        if len(self.heights) < 5:
+            values = self.heights
+            self.heights = list(other.heights)
+            self.positions = list(other.positions)
+            self.desired = list(other.desired)
+            for value in values:
+                self.add(value)
+            return
+
+        n = self.positions[4] + other.positions[4]
+        points = sorted({*self.heights, *other.heights})
+        ranks = [self.__rank(x) + other.__rank(x) for x in points]
+        heights = [points[0]]
+        positions = [1]
+        for i in range(1, 4):
+            desired = 1 + (n - 1) * self.increments[i]
+            j = next((j for j, r in enumerate(ranks) if r >= desired), len(ranks) - 1)
+            height = points[j]
+            if j and ranks[j] > desired > ranks[j - 1]:
+                height = points[j - 1] + (points[j] - points[j - 1]) * (
+                    desired - ranks[j - 1]
+                ) / (ranks[j] - ranks[j - 1])
+            heights.append(height)
+            positions.append(min(max(round(desired), positions[-1] + 1), n - 4 + i))
+        heights.append(points[-1])
+        positions.append(n)
+
+        self.heights = heights
+        self.positions = positions
+        self.desired = [1 + (n - 1) * f for f in self.increments]
+
+    # Rank of x among the values seen, interpolated between the markers
+    def __rank(self, x):
+        n, h = self.positions, self.heights
+        if x < h[0]:
+            return 0
+        if x >= h[4]:
+            return n[4]
+        i = next(i for i in range(4) if h[i] <= x < h[i + 1])
+        return n[i] + (n[i + 1] - n[i]) * (x - h[i]) / (h[i + 1] - h[i])
+
+    def __parabolic(self, i, d):
+        n, h = self.positions, self.heights
+        return h[i] + d / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + d) * (h[i + 1] - h[i]) / (n[i + 1] - n[i])
+            + (n[i + 1] - n[i] - d) * (h[i] - h[i - 1]) / (n[i] - n[i - 1])
+        )
+
+    def __linear(self, i, d):
+        n, h = self.positions, self.heights
+        return h[i] + d * (h[i + d] - h[i]) / (n[i + d] - n[i])
+
+    def result(self):
+        if not self.heights:
+            return None
+        if len(self.heights) < 5:
+            return interpolate(self.heights, self.q)
+        return self.heights[2]
+
+
+class Summary(Accumulator):
+    # Count, total, mean, median, min and max of a series of values. The
+    # median is exact unless exact=False, which keeps memory constant.
+    def __init__(self, exact=True):
+        self.count = Count()
+        self.total = Sum()
+        self.min = Min()
+        self.max = Max()
+        self.median = ExactQuantiles() if exact else StreamingQuantile(0.5)
+
+    def add(self, value):
+        self.count.add()
+        self.total.add(value)
+        self.min.add(value)
+        self.max.add(value)
+        self.median.add(value)
+
+    def merge(self, other):
+        for name in ("count", "total", "min", "max", "median"):
+            getattr(self, name).merge(getattr(other, name))
+
+    def __len__(self):
+        return self.count.result()
+
+    def result(self):
+        count = self.count.result()
+        if not count:
+            return None
+        total = self.total.result()
+        return {
+            "count": count,
+            "total": total,
+            "mean": total / count,
+            "median": self.median.result(),
+            "min": self.min.result(),
+            "max": self.max.result(),
+        }
+
+
+class Intervals(Accumulator):
+    # Summary of the gaps between consecutive values once sorted, e.g. block
+    # intervals from timestamps streamed in DAG order. With exact=False only
+    # the latest `window` values are kept and sorted, the gaps of the values
+    # before them go to an estimated Summary. That needs constant memory for
+    # values that are nearly in order, a value that arrives more than `window`
+    # values late counts as a gap of 0. Estimated intervals merge with those of
+    # the values that follow, e.g. of the next shard of a store.
+    def __init__(self, exact=True, window=10_000):
+        self.exact = exact
+        if exact:
+            self.values = ExactQuantiles()
+            return
+
+        self.window = window
+        self.pending = []  # heap
+        self.first = None
+        self.last = None
+        self.count = 0
+        self.intervals = Summary(exact=False)
+
+    def add(self, value):
+        if self.exact:
+            self.values.add(value)
+            return
+
+        self.count += 1
+        heapq.heappush(self.pending, value)
+        if len(self.pending) > self.window:
+            self.__add_sorted(heapq.heappop(self.pending))
+
+    def __add_sorted(self, value):
+        if self.last is None:
+            self.first = value
+        else:
+            self.intervals.add(max(value - self.last, 0))
+        if self.last is None or value > self.last:
+            self.last = value
+
+    def merge(self, other):
+        if self.exact:
+            self.values.merge(other.values)
+            return
+
+        if other.first is None:
+            for value in other.pending:
+                self.add(value)
+            return
+
+        # The pending values go first, then the gap to the first value of
+        # other and the gaps other has summarized already
+        for value in sorted(self.pending):
+            self.__add_sorted(value)
+        self.__add_sorted(other.first)
+        self.intervals.merge(other.intervals)
+        self.last = max(self.last, other.last)
+        self.pending = list(other.pending)
+        self.count += other.count
+
+    def __len__(self):
+        return len(self.values.values) if self.exact else self.count
+
+    def result(self):
+        if not self.exact:
+            # The pending values are added to a copy, so that more can follow
+            rest = copy.deepcopy(self)
+            for value in sorted(rest.pending):
+                rest.__add_sorted(value)
+            return rest.intervals.result()
+
+        self.values.quantile(0)  # sorts the values
+        values = self.values.values
+
+        intervals = Summary(self.exact)
+        for i in range(len(values) - 1):
+            intervals.add(values[i + 1] - values[i])
+        return intervals.result()
+
+
+class Distinct(Accumulator):
+    # Exact number of distinct values, every value is kept in a set
+    def __init__(self):
+        self.values = set()
+
+    def add(self, value):
+        self.values.add(value)
+
+    def merge(self, other):
+        self.values.update(other.values)
+
+    def result(self):
+        return len(self.values)
+
+
+class HyperLogLog(Accumulator):
+    # Estimated number of distinct strings (Flajolet et al., 2007) in 2^p
+    # one-byte registers, 16 KB and a standard error of about 0.8% with the
+    # default precision. Sketches of the same precision merge into the sketch
+    # of the union of their values.
+    def __init__(self, p=14):
+        self.p = p
+        self.registers = bytearray(1 << p)
+
+    def add(self, value):
+        x = int.from_bytes(
+            hashlib.blake2b(value.encode(), digest_size=8).digest(), "big"
+        )
+        bits = 64 - self.p
+        index = x >> bits
+        # Position of the first 1 bit in the remaining bits
+        rank = bits - (x & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        if other.p != self.p:
+            raise ValueError("HyperLogLog sketches of different precision")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def result(self):
+        m = len(self.registers)
+        estimate = (
+            0.7213 / (1 + 1.079 / m) * m * m / sum(2.0**-r for r in self.registers)
+        )
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # Linear counting is more accurate for small cardinalities
+            estimate = m * math.log(m / zeros)
+        return round(estimate)
+
+
+class Aggregator(object):
+    # Named accumulators fed from one pass over the blocks
+    def __init__(self, **accumulators):
+        self.accumulators = accumulators
+
+    def __getitem__(self, name):
+        return self.accumulators[name]
+
+    def add(self, name, value=None):
+        self.accumulators[name].add(value)
+
+    def merge(self, other):
+        for name, acc in self.accumulators.items():
+            acc.merge(other[name])
+
+    def results(self):
+        return {name: acc.result() for name, acc in self.accumulators.items()}
@@ -0,0 +1,207 @@
+from array import array
+
+import numpy as np
+import pandas as pd
+
+from helper.block_stats import (
+    COINBASE_SUBNETWORK_ID,
+    start_of_day,
+    warn_missing_output,
+)
+
+# Columnar backend of analyze_blocks(). Blocks are read once into typed
+# arrays (int64 amounts, timestamps and DAA scores) and the statistics are
+# computed with vectorized numpy/pandas operations instead of per value.
+
+
+def exact_sum(values):
+    # Sum of int64 values without overflowing int64: the high and low 32 bits
+    # are summed separately and combined as a Python int
+    return int((values >> 32).sum()) * 2**32 + int((values & 0xFFFFFFFF).sum())
+
+
+# Same numbers as helper.aggregation.Summary with exact medians
+def summarize(values):
+    if not len(values):
+        return None
+
+    values = np.sort(values)
+    count = len(values)
+    total = exact_sum(values)
+    mid = count // 2
+    if count % 2:
+        median = int(values[mid])
+    else:
+        median = (int(values[mid - 1]) + int(values[mid])) / 2
+
+    return {
+        "count": count,
+        "total": total,
+        "mean": total / count,
+        "median": median,
+        "min": int(values[0]),
+        "max": int(values[-1]),
+    }
+
+
+def load_columns(blocks, get_spent_output=None):
+    columns = {
+        name: array("q")
+        for name in (
+            "timestamp",
+            "daa_score",
+            "is_chain_block",
+            "blues",
+            "reds",
+            "coinbase_amount",
+            "created_tx",
+            "created_amount",
+            "spent_tx",
+            "spent_amount",
+            "fee_tx",
+        )
+    }
+    merged_blues = []
+    merged_reds = []
+    receiving_addrs = []
+    sending_addrs = []
+
+    accepted_txs = 0
+    coinbase_txs = 0
+
+    for _, block, accepted in blocks:
+        columns["timestamp"].append(block.header.timestamp)
+        columns["daa_score"].append(block.header.daaScore)
+        columns["is_chain_block"].append(block.verboseData.isChainBlock)
+        columns["blues"].append(len(block.verboseData.mergeSetBluesHashes))
+        columns["reds"].append(len(block.verboseData.mergeSetRedsHashes))
+        merged_blues.extend(block.verboseData.mergeSetBluesHashes)
+        merged_reds.extend(block.verboseData.mergeSetRedsHashes)
+
+        for tx in block.transactions:
+            tx_id = tx.verboseData.transactionId
+
+            # Count every accepted transaction once, see
+            # helper.block_store.iter_accepted_blocks(first=True)
+            if tx_id not in accepted:
+                continue
+            accepted_txs += 1
+
+            if tx.subnetworkId == COINBASE_SUBNETWORK_ID:
+                coinbase_txs += 1
+                for output in tx.outputs:
+                    columns["coinbase_amount"].append(output.amount)
+                continue
+
+            # Outputs and inputs carry the row of their transaction, fees are
+            # summed per row later
+            tx_row = accepted_txs
+            for output in tx.outputs:
+                columns["created_tx"].append(tx_row)
+                columns["created_amount"].append(output.amount)
+                receiving_addrs.append(output.verboseData.scriptPublicKeyAddress)
+
+            if get_spent_output is None:
+                continue
+
+            for input in tx.inputs:
+                outpoint = input.previousOutpoint
+                spent_output = get_spent_output(outpoint.transactionId, outpoint.index)
+                if spent_output is None:
+                    warn_missing_output(outpoint.transactionId, outpoint.index)
+                    break
+
+                columns["spent_tx"].append(tx_row)
+                columns["spent_amount"].append(spent_output[0])
+                sending_addrs.append(spent_output[1])
+            else:
+                columns["fee_tx"].append(tx_row)
+
+    columns = {
+        name: np.frombuffer(values, dtype=np.int64) for name, values in columns.items()
+    }
+    columns.update(
+        merged_blues=merged_blues,
+        merged_reds=merged_reds,
+        receiving_addrs=receiving_addrs,
+        sending_addrs=sending_addrs,
+        accepted_txs=accepted_txs,
+        coinbase_txs=coinbase_txs,
+    )
+    return columns
+
+
+# Same results as helper.block_stats.analyze_blocks() with exact medians
+def analyze_blocks(blocks, get_spent_output=None):
+    columns = load_columns(blocks, get_spent_output)
+
+    timestamps = columns["timestamp"]
+    is_chain_block = columns["is_chain_block"].astype(bool)
+
+    # Daily block rollup
+    daily = (
+        pd.DataFrame(
+            {
+                "day": start_of_day(timestamps),
+                "chainblocks": is_chain_block,
+                "blues": columns["blues"],
+                "reds": columns["reds"],
+            }
+        )
+        .groupby("day")
+        .agg(
+            total=("chainblocks", "size"),
+            chainblocks=("chainblocks", "sum"),
+            blues=("blues", "sum"),
+            reds=("reds", "sum"),
+        )
+    )
+    daily["non_chainblocks"] = daily["total"] - daily["chainblocks"]
+    blocks_per_day = {
+        int(day): {
+            "total": int(row.total),
+            "chainblocks": int(row.chainblocks),
+            "non_chainblocks": int(row.non_chainblocks),
+            "blues": int(row.blues),
+            "reds": int(row.reds),
+        }
+        for day, row in daily.iterrows()
+    }
+
+    # Fees of the transactions whose inputs were all resolved
+    fee_txs = columns["fee_tx"]
+    input_totals = (
+        pd.Series(columns["spent_amount"])
+        .groupby(columns["spent_tx"])
+        .sum()
+        .reindex(fee_txs, fill_value=0)
+    )
+    output_totals = (
+        pd.Series(columns["created_amount"])
+        .groupby(columns["created_tx"])
+        .sum()
+        .reindex(fee_txs, fill_value=0)
+    )
+    fees = (input_totals - output_totals).to_numpy(np.int64)
+
+    _, blocks_per_daa = np.unique(columns["daa_score"], return_counts=True)
+
+    return {
+        "blocks": len(timestamps),
+        "chainblocks": int(is_chain_block.sum()),
+        "non_chainblocks": int((~is_chain_block).sum()),
+        "coinbase_txs": columns["coinbase_txs"],
+        "coinbase_outputs": summarize(columns["coinbase_amount"]),
+        "outputs_spent": summarize(columns["spent_amount"]),
+        "outputs_created": summarize(columns["created_amount"]),
+        "fees": summarize(fees),
+        "block_intervals": summarize(np.diff(np.sort(timestamps))),
+        "chainblock_intervals": summarize(np.diff(np.sort(timestamps[is_chain_block]))),
+        "merged_blues": pd.unique(np.array(columns["merged_blues"], object)).size,
+        "merged_reds": pd.unique(np.array(columns["merged_reds"], object)).size,
+        "blocks_per_day": blocks_per_day,
+        "blocks_per_daa": summarize(blocks_per_daa.astype(np.int64)),
+        "accepted_txs": columns["accepted_txs"],
+        "sending_addrs": pd.unique(np.array(columns["sending_addrs"], object)).size,
+        "receiving_addrs": pd.unique(np.array(columns["receiving_addrs"], object)).size,
+    }
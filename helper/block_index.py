@@ -0,0 +1,173 @@
+import os
+import sqlite3
+
+from helper.block_store import BLOCKS_FILE, iter_blocks, open_block_state
+
+# Indexed view of the block store for lookups that would otherwise need the
+# whole store in memory: which blocks contain a transaction and what an
+# outpoint holds. Which chain block accepted a transaction is only kept by the
+# block state (see helper.block_state), BlockState.get_accepted() looks it up.
+INDEX_FILE = "./data/blocks.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS blocks (
+    hash TEXT PRIMARY KEY,
+    timestamp INTEGER NOT NULL,
+    daa_score INTEGER NOT NULL,
+    blue_score INTEGER NOT NULL,
+    difficulty REAL NOT NULL,
+    is_chain_block INTEGER NOT NULL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS transactions (
+    tx_id TEXT PRIMARY KEY,
+    subnetwork_id TEXT NOT NULL,
+    block_time INTEGER NOT NULL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS block_transactions (
+    block_hash TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    tx_id TEXT NOT NULL,
+    PRIMARY KEY (block_hash, position)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS block_transactions_tx_id
+    ON block_transactions (tx_id);
+
+CREATE TABLE IF NOT EXISTS outputs (
+    tx_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    amount INTEGER NOT NULL,
+    address TEXT NOT NULL,
+    PRIMARY KEY (tx_id, idx)
+) WITHOUT ROWID;
+
+-- Acceptance was kept here as well by earlier versions
+DROP TABLE IF EXISTS acceptance;
+"""
+
+
+# With the block state of the store given, blocks are indexed with the chain
+# membership it has for them, so that chain changes applied before a block is
+# indexed are not lost
+class BlockIndex(object):
+    def __init__(self, path=INDEX_FILE, state=None):
+        self.path = path
+        self.state = state
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute("PRAGMA synchronous = NORMAL")
+        self.db.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    ## Ingest
+    def add_blocks(self, blocks):
+        block_rows = []
+        tx_rows = []
+        membership_rows = []
+        output_rows = []
+
+        chain_blocks = {}
+        if self.state is not None:
+            chain_blocks = self.state.get_chain_blocks(
+                [block.verboseData.hash for block in blocks]
+            )
+
+        for block in blocks:
+            hash = block.verboseData.hash
+            block_rows.append(
+                (
+                    hash,
+                    block.header.timestamp,
+                    block.header.daaScore,
+                    block.header.blueScore,
+                    block.verboseData.difficulty,
+                    chain_blocks.get(hash, block.verboseData.isChainBlock),
+                )
+            )
+
+            for position, tx in enumerate(block.transactions):
+                tx_id = tx.verboseData.transactionId
+                tx_rows.append((tx_id, tx.subnetworkId, tx.verboseData.blockTime))
+                membership_rows.append((hash, position, tx_id))
+
+                for idx, output in enumerate(tx.outputs):
+                    output_rows.append(
+                        (
+                            tx_id,
+                            idx,
+                            output.amount,
+                            output.verboseData.scriptPublicKeyAddress,
+                        )
+                    )
+
+        self.db.executemany(
+            "INSERT OR IGNORE INTO blocks VALUES (?, ?, ?, ?, ?, ?)", block_rows
+        )
+        self.db.executemany(
+            "INSERT OR IGNORE INTO transactions VALUES (?, ?, ?)", tx_rows
+        )
+        self.db.executemany(
+            "INSERT OR IGNORE INTO block_transactions VALUES (?, ?, ?)",
+            membership_rows,
+        )
+        self.db.executemany(
+            "INSERT OR IGNORE INTO outputs VALUES (?, ?, ?, ?)", output_rows
+        )
+
+    # Blocks not indexed yet get their chain membership from the block state
+    # when they are
+    def set_chain_blocks(self, hashes, is_chain_block):
+        self.db.executemany(
+            "UPDATE blocks SET is_chain_block = ? WHERE hash = ?",
+            ((is_chain_block, hash) for hash in hashes),
+        )
+
+    ## Lookups
+    def get_output(self, tx_id, idx):
+        # (amount, address) of an outpoint, None if it is not indexed
+        return self.db.execute(
+            "SELECT amount, address FROM outputs WHERE tx_id = ? AND idx = ?",
+            (tx_id, idx),
+        ).fetchone()
+
+    def has_block(self, hash):
+        row = self.db.execute("SELECT 1 FROM blocks WHERE hash = ?", (hash,))
+        return row.fetchone() is not None
+
+    def get_transaction_blocks(self, tx_id):
+        # [(block hash, position in block)] of all blocks containing tx_id
+        return self.db.execute(
+            "SELECT block_hash, position FROM block_transactions WHERE tx_id = ?",
+            (tx_id,),
+        ).fetchall()
+
+    def count(self, table):
+        return self.db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+
+# (Re)build the index of a whole block store, e.g. one crawled without --index
+def index_store(path=BLOCKS_FILE, index_path=INDEX_FILE, batch_size=1000):
+    if os.path.exists(index_path):
+        os.remove(index_path)
+
+    with open_block_state(path) as state, BlockIndex(index_path) as index:
+        batch = []
+        for _, block in iter_blocks(path, raw=True, state=state):
+            batch.append(block)
+            if len(batch) == batch_size:
+                index.add_blocks(batch)
+                batch = []
+        index.add_blocks(batch)
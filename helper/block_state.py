@@ -0,0 +1,168 @@
+import sqlite3
+
+# Chain membership and transaction acceptance of the blocks in a block store
+# (see helper.block_store). Both change with the virtual chain after the blocks
+# are stored, so they live in an SQLite database next to the store that is
+# changed in place: a run only writes what the virtual chain changed, and
+# readers look up the blocks and transactions they read, a batch at a time,
+# instead of loading the state as a whole.
+#
+# Every transaction also records the offset of the first record of the store
+# that includes it, so that a transaction included by several blocks can be
+# counted at exactly one of them, even by readers of separate store ranges.
+# Hashes and transaction ids are stored as bytes.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chain_blocks (
+    hash BLOB PRIMARY KEY,
+    is_chain_block INTEGER NOT NULL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS transactions (
+    tx_id BLOB PRIMARY KEY,
+    first_offset INTEGER,
+    accepting_block_hash BLOB
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS transactions_accepting_block_hash
+    ON transactions (accepting_block_hash)
+    WHERE accepting_block_hash IS NOT NULL;
+
+CREATE TABLE IF NOT EXISTS state_meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+) WITHOUT ROWID;
+"""
+
+# Values per IN (...) of a lookup
+LOOKUP_SIZE = 500
+
+
+class BlockState(object):
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute("PRAGMA synchronous = NORMAL")
+        self.db.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    # Saves the changes so far, for a store of store_size bytes
+    def commit(self, store_size):
+        self.db.execute(
+            "INSERT OR REPLACE INTO state_meta VALUES ('store_size', ?)",
+            (store_size,),
+        )
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def store_size(self):
+        row = self.db.execute(
+            "SELECT value FROM state_meta WHERE key = 'store_size'"
+        ).fetchone()
+        return row[0] if row else 0
+
+    # Forget everything, e.g. for a store that is crawled again
+    def reset(self):
+        for table in ("chain_blocks", "transactions", "state_meta"):
+            self.db.execute(f"DELETE FROM {table}")
+        self.db.commit()
+
+    ## Updates
+    # Records where transactions are first included, from (tx_id, byte offset
+    # of the record) rows of records appended to the store
+    def add_transactions(self, rows):
+        self.db.executemany(
+            "INSERT INTO transactions (tx_id, first_offset) VALUES (?, ?) "
+            "ON CONFLICT (tx_id) DO UPDATE SET first_offset = excluded.first_offset "
+            "WHERE first_offset IS NULL",
+            ((bytes.fromhex(tx_id), offset) for tx_id, offset in rows),
+        )
+
+    # Forgets the records from byte offset size on, after the store was
+    # truncated there. Acceptance is kept, it is not part of the records.
+    def truncate(self, size):
+        if size >= self.store_size():
+            return
+        self.db.execute(
+            "UPDATE transactions SET first_offset = NULL WHERE first_offset >= ?",
+            (size,),
+        )
+
+    def set_chain_blocks(self, hashes, is_chain_block):
+        self.db.executemany(
+            "INSERT OR REPLACE INTO chain_blocks VALUES (?, ?)",
+            ((bytes.fromhex(hash), is_chain_block) for hash in hashes),
+        )
+
+    def accept_transactions(self, accepting_block_hash, tx_ids):
+        accepting_block_hash = bytes.fromhex(accepting_block_hash)
+        self.db.executemany(
+            "INSERT INTO transactions (tx_id, accepting_block_hash) VALUES (?, ?) "
+            "ON CONFLICT (tx_id) DO UPDATE "
+            "SET accepting_block_hash = excluded.accepting_block_hash",
+            ((bytes.fromhex(tx_id), accepting_block_hash) for tx_id in tx_ids),
+        )
+
+    def unaccept_chain_blocks(self, hashes):
+        self.db.executemany(
+            "UPDATE transactions SET accepting_block_hash = NULL "
+            "WHERE accepting_block_hash = ?",
+            ((bytes.fromhex(hash),) for hash in hashes),
+        )
+
+    ## Lookups
+    def __lookup(self, query, keys):
+        keys = [bytes.fromhex(key) for key in keys]
+        rows = []
+        for i in range(0, len(keys), LOOKUP_SIZE):
+            batch = keys[i : i + LOOKUP_SIZE]
+            query_batch = query.format(", ".join("?" * len(batch)))
+            rows += self.db.execute(query_batch, batch).fetchall()
+        return rows
+
+    # {hash: isChainBlock} of the given blocks whose chain membership changed
+    # after they were stored
+    def get_chain_blocks(self, hashes):
+        return {
+            hash.hex(): bool(is_chain_block)
+            for hash, is_chain_block in self.__lookup(
+                "SELECT hash, is_chain_block FROM chain_blocks WHERE hash IN ({})",
+                hashes,
+            )
+        }
+
+    # {tx_id: (accepting block hash, first offset)} of the given transactions
+    # that are accepted
+    def get_accepted(self, tx_ids):
+        return {
+            tx_id.hex(): (accepting_block_hash.hex(), first_offset)
+            for tx_id, accepting_block_hash, first_offset in self.__lookup(
+                "SELECT tx_id, accepting_block_hash, first_offset FROM transactions "
+                "WHERE tx_id IN ({}) AND accepting_block_hash IS NOT NULL",
+                tx_ids,
+            )
+        }
+
+    # Offsets of the records that first include the transactions accepted by
+    # the given blocks
+    def get_first_offsets(self, accepting_block_hashes):
+        return {
+            first_offset
+            for (first_offset,) in self.__lookup(
+                "SELECT DISTINCT first_offset FROM transactions "
+                "WHERE accepting_block_hash IN ({}) AND first_offset IS NOT NULL",
+                accepting_block_hashes,
+            )
+        }
+
+    def count_accepted(self):
+        return self.db.execute(
+            "SELECT COUNT(*) FROM transactions WHERE accepting_block_hash IS NOT NULL"
+        ).fetchone()[0]
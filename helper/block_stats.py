@@ -0,0 +1,260 @@
+import copy
+
+from helper.aggregation import (
+    Aggregator,
+    Count,
+    Distinct,
+    HyperLogLog,
+    Intervals,
+    Summary,
+)
+from helper.block_store import iter_accepted_blocks
+from helper.spent_outputs import load_spent_outputs
+
+COINBASE_SUBNETWORK_ID = "0100000000000000000000000000000000000000"
+
+# Without exact statistics, the block counts of this many DAA scores are kept
+# apart and those of lower DAA scores go to the estimated summary. Blocks with
+# the same DAA score are close to each other in DAG order.
+DAA_SCORE_WINDOW = 10_000
+
+
+def start_of_day(ts):
+    return ts - (ts % (24 * 60 * 60 * 1000))
+
+
+def warn_missing_output(tx_id, index):
+    key = f"{tx_id}-{index}"
+    print(f"Warning: Key {key} not found in spent outputs. Skipping block.")
+
+
+# Block and transaction statistics of block_tx_analysis.py. Blocks are added
+# one at a time, partial statistics of separate block ranges can be merged,
+# estimated ones approximately. With exact=False medians, block intervals and
+# blocks per DAA score are estimated in constant memory. With sketches=True unique addresses
+# (per day) and merged blocks are estimated from HyperLogLog sketches instead
+# of keeping every address and hash.
+class BlockStats(object):
+    def __init__(self, exact=True, sketches=False):
+        # Initialize sets and accumulators for analysis
+        distinct = HyperLogLog if sketches else Distinct
+        self.merged = Aggregator(merged_blues=distinct(), merged_reds=distinct())
+
+        self.blocks_per_daa = {}
+        self.daa_score_blocks = Summary(exact)  # Blocks of earlier DAA scores
+        self.blocks_per_day = {}
+
+        self.stats = Aggregator(
+            blocks=Count(),
+            chainblocks=Count(),
+            non_chainblocks=Count(),
+            accepted_txs=Count(),  # Including coinbase transactions
+            coinbase_txs=Count(),
+            coinbase_outputs=Summary(exact),
+            outputs_spent=Summary(exact),  # Spent outputs
+            outputs_created=Summary(exact),  # Created outputs
+            fees=Summary(exact),
+            block_intervals=Intervals(exact),
+            chainblock_intervals=Intervals(exact),
+        )
+        self.exact = exact
+        self.sketches = sketches
+
+        # Unique addresses, per day with sketches
+        self.addrs = Aggregator(sending_addrs=Distinct(), receiving_addrs=Distinct())
+        self.addrs_per_day = {}
+
+    def __day_addrs(self, day_start):
+        if not self.sketches:
+            return self.addrs
+        addrs = self.addrs_per_day.get(day_start)
+        if addrs is None:
+            addrs = self.addrs_per_day[day_start] = Aggregator(
+                sending_addrs=HyperLogLog(), receiving_addrs=HyperLogLog()
+            )
+        return addrs
+
+    # Transactions count once they are accepted, at the first record of the
+    # store that includes them: accepted is that of
+    # helper.block_store.iter_accepted_blocks() with first=True. Spent outputs
+    # are resolved with get_spent_output(tx_id, index) -> (amount, address) or
+    # None, no input statistics are collected without it.
+    def add_block(self, block, accepted, get_spent_output=None):
+        stats = self.stats
+        stats.add("blocks")
+        stats.add("block_intervals", block.header.timestamp)
+
+        timestamp = block.header.timestamp
+        day_start = start_of_day(timestamp)
+
+        day = self.blocks_per_day.setdefault(
+            day_start,
+            {"total": 0, "chainblocks": 0, "non_chainblocks": 0, "blues": 0, "reds": 0},
+        )
+        day["total"] += 1
+
+        if block.verboseData.isChainBlock:
+            day["chainblocks"] += 1
+        else:
+            day["non_chainblocks"] += 1
+
+        # Directly count merged blues and reds for blocks within this time range
+        day["blues"] += len(block.verboseData.mergeSetBluesHashes)
+        day["reds"] += len(block.verboseData.mergeSetRedsHashes)
+
+        daa_score = block.header.daaScore
+        self.blocks_per_daa[daa_score] = self.blocks_per_daa.get(daa_score, 0) + 1
+        if not self.exact and len(self.blocks_per_daa) > 2 * DAA_SCORE_WINDOW:
+            self.__summarize_daa_scores(DAA_SCORE_WINDOW)
+
+        # Chainblock vs. non-chainblock
+        if block.verboseData.isChainBlock:
+            stats.add("chainblocks")
+            stats.add("chainblock_intervals", block.header.timestamp)
+        else:
+            stats.add("non_chainblocks")
+
+        # Blue mergeset
+        for hash in block.verboseData.mergeSetBluesHashes:
+            self.merged.add("merged_blues", hash)
+
+        # Red mergeset
+        for hash in block.verboseData.mergeSetRedsHashes:
+            self.merged.add("merged_reds", hash)
+
+        # Process transactions
+        addrs = self.__day_addrs(day_start)
+        for tx in block.transactions:
+            tx_id = tx.verboseData.transactionId
+
+            # Skip if tx is not accepted or counted at another block
+            if tx_id not in accepted:
+                continue
+            stats.add("accepted_txs")
+
+            # Process coinbase transactions
+            if tx.subnetworkId == COINBASE_SUBNETWORK_ID:
+                stats.add("coinbase_txs")
+                for output in tx.outputs:
+                    stats.add("coinbase_outputs", output.amount)
+                continue
+
+            # Process "regular" transactions
+            total_output_amount = 0
+            for output in tx.outputs:
+                stats.add("outputs_created", output.amount)
+                total_output_amount += output.amount
+
+                addrs.add("receiving_addrs", output.verboseData.scriptPublicKeyAddress)
+
+            if get_spent_output is None:
+                continue
+
+            total_input_amount = 0
+            skip_block = False  # indicate whether to skip the block
+            for input in tx.inputs:
+                prev_outpoint_tx_id = input.previousOutpoint.transactionId
+                prev_outpoint_index = input.previousOutpoint.index
+
+                spent_output = get_spent_output(
+                    prev_outpoint_tx_id, prev_outpoint_index
+                )
+                if spent_output is None:
+                    warn_missing_output(prev_outpoint_tx_id, prev_outpoint_index)
+                    skip_block = True
+                    break  # Stop processing this block if key is missing
+
+                input_amount, sending_addr = spent_output
+                stats.add("outputs_spent", input_amount)
+                total_input_amount += input_amount
+
+                addrs.add("sending_addrs", sending_addr)
+
+            if skip_block:
+                continue
+
+            tx_fee = total_input_amount - total_output_amount
+            stats.add("fees", tx_fee)
+
+    # Moves the block counts of all but the `keep` highest DAA scores to the
+    # summary
+    def __summarize_daa_scores(self, keep):
+        daa_scores = sorted(self.blocks_per_daa)
+        for daa_score in daa_scores[: len(daa_scores) - keep]:
+            self.daa_score_blocks.add(self.blocks_per_daa.pop(daa_score))
+
+    # Merge the statistics of the following block range
+    def merge(self, other):
+        self.stats.merge(other.stats)
+
+        for day_start, counts in other.blocks_per_day.items():
+            day = self.blocks_per_day.setdefault(day_start, dict.fromkeys(counts, 0))
+            for name, count in counts.items():
+                day[name] += count
+
+        for daa_score, count in other.blocks_per_daa.items():
+            self.blocks_per_daa[daa_score] = (
+                self.blocks_per_daa.get(daa_score, 0) + count
+            )
+
+        self.daa_score_blocks.merge(other.daa_score_blocks)
+        if not self.exact and len(self.blocks_per_daa) > 2 * DAA_SCORE_WINDOW:
+            self.__summarize_daa_scores(DAA_SCORE_WINDOW)
+        self.merged.merge(other.merged)
+
+        self.addrs.merge(other.addrs)
+        for day_start, addrs in other.addrs_per_day.items():
+            if day_start in self.addrs_per_day:
+                self.addrs_per_day[day_start].merge(addrs)
+            else:
+                self.addrs_per_day[day_start] = addrs
+
+    def results(self):
+        bpd = copy.deepcopy(self.daa_score_blocks)
+        bpd.update(self.blocks_per_daa.values())
+
+        addrs = self.addrs
+        if self.sketches:
+            # Unique addresses of the whole range from the union of the days
+            addrs = Aggregator(
+                sending_addrs=HyperLogLog(), receiving_addrs=HyperLogLog()
+            )
+            for day_addrs in self.addrs_per_day.values():
+                addrs.merge(day_addrs)
+
+        results = self.stats.results()
+        results.update(addrs.results())
+        results.update(self.merged.results())
+        results.update(
+            blocks_per_day=self.blocks_per_day,
+            blocks_per_daa=bpd.result(),
+            addrs_per_day={
+                day_start: day_addrs.results()
+                for day_start, day_addrs in self.addrs_per_day.items()
+            },
+        )
+        return results
+
+
+# Statistics of all (hash, RpcBlock, accepted) of iter_accepted_blocks() with
+# first=True, see BlockStats.add_block()
+def analyze_blocks(blocks, get_spent_output=None, exact=True, sketches=False):
+    stats = BlockStats(exact, sketches)
+    for _, block, accepted in blocks:
+        stats.add_block(block, accepted, get_spent_output)
+    return stats.results()
+
+
+# Statistics of one shard of the block store (see helper.sharding). A
+# transaction that blocks of several shards include is counted by the shard
+# of the first one.
+def analyze_shard(shard, path, spent_outputs=True, exact=True, sketches=False):
+    start, end = shard
+    get_spent_output = load_spent_outputs(verbose=False) if spent_outputs else None
+
+    stats = BlockStats(exact, sketches)
+    for _, block, accepted in iter_accepted_blocks(
+        path, start=start, end=end, first=True
+    ):
+        stats.add_block(block, accepted, get_spent_output)
+    return stats
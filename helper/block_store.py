@@ -0,0 +1,518 @@
+import json
+import mmap
+import os
+import re
+import struct
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+from itertools import islice
+
+from google.protobuf import json_format
+
+from helper.block_state import BlockState
+from helper.fast_json import DecodeError, loads
+from helper.message_view import MessageView
+from spectred.rpc_pb2 import RpcBlock
+
+# Blocks are stored one record per block, in the order they were crawled.
+# Records are never rewritten: chain membership and transaction acceptance,
+# which change with the virtual chain, live in the block state next to the
+# blocks (see helper.block_state) and are looked up while reading.
+#
+# A store ending in .pb holds length-prefixed RpcBlock messages exactly as the
+# node sent them (minus the higher parent levels), any other store holds one
+# JSON block per line.
+#
+# The {"blocks": {hash: block, ...}} dumps of the original save_blocks.py
+# (json.dump with indent=4) can be read like a store too. Every block entry
+# of the mapping is a record: its end is found from the indentation of the
+# closing line and the block is parsed on its own, so a dump is streamed
+# instead of loaded at once. Chain membership and acceptance are part of the
+# dumped blocks, the block state of a dump is derived from them once.
+BLOCKS_FILE = "./data/blocks.pb"
+LEGACY_BLOCKS_FILE = "./data/block.json"
+
+RECORD_LENGTH = struct.Struct("<I")
+
+# Records per batch of block state lookups while reading
+STATE_BATCH_SIZE = 1000
+
+LEGACY_DUMP = re.compile(rb'\s*\{\s*"blocks"\s*:')
+LEGACY_DUMP_START = re.compile(rb'\s*\{\r?\n\s*"blocks": \{\r?\n')
+LEGACY_ENTRY = re.compile(rb'( *)"[0-9a-fA-F]+": (\{)\r?\n')
+
+
+def state_file(path):
+    return os.path.splitext(path)[0] + ".state.sqlite"
+
+
+# Block state file of earlier versions, a single JSON document
+def json_state_file(path):
+    return os.path.splitext(path)[0] + ".state.json"
+
+
+def is_protobuf_store(path):
+    return path.endswith(".pb")
+
+
+def is_legacy_dump(path):
+    if is_protobuf_store(path) or not os.path.exists(path):
+        return False
+    with open(path, "rb") as f:
+        return LEGACY_DUMP.match(f.read(64)) is not None
+
+
+# The block store, or the dump of the original save_blocks.py if there is no
+# store yet. The state of a dump is derived here, before any worker process
+# needs it.
+def find_blocks_file():
+    if os.path.exists(BLOCKS_FILE) or not is_legacy_dump(LEGACY_BLOCKS_FILE):
+        return BLOCKS_FILE
+    open_block_state(LEGACY_BLOCKS_FILE).close()
+    return LEGACY_BLOCKS_FILE
+
+
+def block_to_dict(block):
+    d = json_format.MessageToDict(block)
+    # Keep 1 level of parents, like the JSON blocks always had
+    parents = d["header"].get("parents")
+    d["header"]["parents"] = parents[0].get("parentHashes", []) if parents else []
+    return d
+
+
+# RpcBlock view of a JSON block (see helper.message_view), with the one level
+# of parents that JSON blocks keep
+def block_view(d):
+    parents = d["header"].get("parents")
+    if parents and isinstance(parents[0], str):
+        d["header"]["parents"] = [{"parentHashes": parents}]
+    return MessageView(d, RpcBlock.DESCRIPTOR)
+
+
+# Appends blocks to a store. With the block state of the store given, the
+# transactions of every block appended are recorded in it.
+class BlockStoreWriter(object):
+    def __init__(self, path, truncate_at=None, state=None):
+        self.path = path
+        self.protobuf = is_protobuf_store(path)
+        self.f = open(path, "a+b")
+        if truncate_at is None:
+            truncate_at = self.__complete_size()
+        self.f.truncate(truncate_at)
+        self.size = truncate_at
+
+        self.state = state
+        self.tx_rows = []
+        if state is not None:
+            state.truncate(truncate_at)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __complete_size(self):
+        # Size without a torn last record left by an interrupted write
+        size = self.f.seek(0, os.SEEK_END)
+
+        if self.protobuf:
+            pos = 0
+            self.f.seek(0)
+            while pos + RECORD_LENGTH.size <= size:
+                (length,) = RECORD_LENGTH.unpack(self.f.read(RECORD_LENGTH.size))
+                if pos + RECORD_LENGTH.size + length > size:
+                    break
+                pos = self.f.seek(length, os.SEEK_CUR)
+            return pos
+
+        pos = size
+        while pos > 0:
+            step = min(pos, 64 * 1024)
+            self.f.seek(pos - step)
+            newline = self.f.read(step).rfind(b"\n")
+            if newline >= 0:
+                return pos - step + newline + 1
+            pos -= step
+        return 0
+
+    def tell(self):
+        return self.f.seek(0, os.SEEK_END)
+
+    def append(self, block):
+        if self.state is not None:
+            _, tx_ids = record_ids(block)
+            self.tx_rows.extend((tx_id, self.size) for tx_id in tx_ids)
+            if len(self.tx_rows) >= 10000:
+                self.__add_transactions()
+
+        if self.protobuf:
+            data = block.SerializeToString()
+            self.f.write(RECORD_LENGTH.pack(len(data)))
+            self.f.write(data)
+            self.size += RECORD_LENGTH.size + len(data)
+            return
+
+        if isinstance(block, RpcBlock):
+            block = block_to_dict(block)
+        data = json.dumps(block, separators=(",", ":")).encode() + b"\n"
+        self.f.write(data)
+        self.size += len(data)
+
+    def __add_transactions(self):
+        self.state.add_transactions(self.tx_rows)
+        self.tx_rows = []
+
+    def flush(self):
+        self.f.flush()
+        if self.state is not None:
+            self.__add_transactions()
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+
+# Yields the records from byte offset start (a record boundary) up to end
+def iter_records(path, start=0, end=None):
+    for _, _, record in iter_record_spans(path, start, end):
+        yield record
+
+
+# Offset of the first block entry in the memory map of a legacy dump
+def legacy_dump_start(m):
+    start = LEGACY_DUMP_START.match(m)
+    if start is None:
+        raise ValueError('Only indented {"blocks": {...}} dumps can be read')
+    return start.end()
+
+
+# Yields (start, end, value_start, value_end) of the block entries in the
+# memory map of a legacy dump from byte offset start (an entry boundary) up to
+# end, m[value_start:value_end] is the JSON of the block. The block object
+# ends at the first line that is indented like its key.
+def iter_legacy_entries(m, start=0, end=None):
+    pos = max(start, legacy_dump_start(m))
+    while end is None or pos < end:
+        entry = LEGACY_ENTRY.match(m, pos)
+        if entry is None:
+            # End of the mapping
+            break
+
+        closing = m.find(b"\n" + entry.group(1) + b"}", entry.end() - 1)
+        if closing < 0:
+            # Truncated dump
+            break
+        value_end = closing + len(entry.group(1)) + 2
+        entry_start, pos = pos, m.find(b"\n", value_end) + 1 or len(m)
+        yield entry_start, pos, entry.start(2), value_end
+
+
+# Yields (start, end, record) with the byte range of every record, see
+# iter_records()
+def iter_record_spans(path, start=0, end=None):
+    if not os.path.exists(path):
+        return
+
+    if is_legacy_dump(path):
+        with (
+            open(path, "rb") as f,
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m,
+        ):
+            for record_start, pos, value_start, value_end in iter_legacy_entries(
+                m, start, end
+            ):
+                yield record_start, pos, loads(m[value_start:value_end])
+        return
+
+    if is_protobuf_store(path):
+        with open(path, "rb") as f:
+            f.seek(start)
+            pos = start
+            while (end is None or pos < end) and (header := f.read(RECORD_LENGTH.size)):
+                data = b""
+                if len(header) == RECORD_LENGTH.size:
+                    (length,) = RECORD_LENGTH.unpack(header)
+                    data = f.read(length)
+                if len(header) < RECORD_LENGTH.size or len(data) < length:
+                    # Torn write at the end of an interrupted crawl
+                    break
+                record_start = pos
+                pos += RECORD_LENGTH.size + length
+                yield record_start, pos, RpcBlock.FromString(data)
+        return
+
+    with open(path, "rb") as f:
+        f.seek(start)
+        pos = start
+        for line in f:
+            if end is not None and pos >= end:
+                break
+            record_start = pos
+            pos += len(line)
+            try:
+                yield record_start, pos, loads(line)
+            except DecodeError:
+                # Torn write at the end of an interrupted crawl
+                break
+
+
+# Yields the records starting at the given byte offsets, in that order
+def read_records(path, offsets):
+    if is_legacy_dump(path):
+        with (
+            open(path, "rb") as f,
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m,
+        ):
+            for offset in offsets:
+                _, _, value_start, value_end = next(iter_legacy_entries(m, offset))
+                yield loads(m[value_start:value_end])
+        return
+
+    with open(path, "rb") as f:
+        for offset in offsets:
+            f.seek(offset)
+            if not is_protobuf_store(path):
+                yield loads(f.readline())
+                continue
+
+            (length,) = RECORD_LENGTH.unpack(f.read(RECORD_LENGTH.size))
+            yield RpcBlock.FromString(f.read(length))
+
+
+# Start offsets of all complete records, followed by the end of the last one
+def record_offsets(path):
+    offsets = array("q", [0])
+    if not os.path.exists(path):
+        return offsets
+
+    with open(path, "rb") as f:
+        if is_legacy_dump(path):
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                offsets[0] = legacy_dump_start(m)
+                for _, pos, _, _ in iter_legacy_entries(m):
+                    offsets.append(pos)
+            return offsets
+
+        if is_protobuf_store(path):
+            size = f.seek(0, os.SEEK_END)
+            pos = f.seek(0)
+            while pos + RECORD_LENGTH.size <= size:
+                (length,) = RECORD_LENGTH.unpack(f.read(RECORD_LENGTH.size))
+                if pos + RECORD_LENGTH.size + length > size:
+                    break
+                pos = f.seek(length, os.SEEK_CUR)
+                offsets.append(pos)
+            return offsets
+
+        pos = 0
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            pos += len(line)
+            offsets.append(pos)
+        return offsets
+
+
+# Splits the store into up to `shards` byte ranges of about equal size that
+# start and end on record boundaries, as (start, end)
+def shard_store(path, shards):
+    offsets = record_offsets(path)
+    size = offsets[-1]
+    if not size:
+        return []
+
+    bounds = sorted({bisect_left(offsets, size * i // shards) for i in range(shards)})
+    return [
+        (offsets[i], end)
+        for i, end in zip(bounds, [offsets[i] for i in bounds[1:]] + [size])
+    ]
+
+
+# The block state of a store (see helper.block_state), to be closed by the
+# caller. The state of a legacy dump is derived again whenever the dump is
+# newer, the JSON state file of earlier versions is migrated once.
+def open_block_state(path=BLOCKS_FILE):
+    derive = is_legacy_dump(path) and (
+        not os.path.exists(state_file(path))
+        or os.path.getmtime(state_file(path)) < os.path.getmtime(path)
+    )
+    migrate = not os.path.exists(state_file(path)) and os.path.exists(
+        json_state_file(path)
+    )
+
+    state = BlockState(state_file(path))
+    if derive:
+        derive_legacy_dump_state(path, state)
+        if os.path.exists(json_state_file(path)):
+            os.remove(json_state_file(path))
+    elif migrate:
+        migrate_json_state(path, state)
+    return state
+
+
+# Block state of a legacy dump from the acceptance marks of its transactions,
+# the dumped blocks have the right isChainBlock already
+def derive_legacy_dump_state(path, state):
+    state.reset()
+    store_size = 0
+    for record_start, store_size, block in iter_record_spans(path):
+        accepted = defaultdict(list)
+        for tx in block["transactions"]:
+            accepting_block_hash = tx.get("acceptingBlockHash")
+            if accepting_block_hash is not None:
+                accepted[accepting_block_hash].append(
+                    tx["verboseData"]["transactionId"]
+                )
+        for accepting_block_hash, tx_ids in accepted.items():
+            state.accept_transactions(accepting_block_hash, tx_ids)
+
+        _, tx_ids = record_ids(block)
+        state.add_transactions((tx_id, record_start) for tx_id in tx_ids)
+    state.commit(store_size)
+
+
+# Moves the JSON state file of earlier versions into the block state, which
+# then needs the transactions of every record of the store
+def migrate_json_state(path, state):
+    with open(json_state_file(path), "rb") as f:
+        json_state = loads(f.read())
+
+    for is_chain_block in (True, False):
+        state.set_chain_blocks(
+            [
+                hash
+                for hash, value in json_state["chainBlocks"].items()
+                if value == is_chain_block
+            ],
+            is_chain_block,
+        )
+
+    accepted = defaultdict(list)
+    for tx_id, accepting_block_hash in json_state["acceptedTransactions"].items():
+        accepted[accepting_block_hash].append(tx_id)
+    del json_state
+    for accepting_block_hash, tx_ids in accepted.items():
+        state.accept_transactions(accepting_block_hash, tx_ids)
+    del accepted
+
+    store_size = 0
+    for record_start, store_size, block in iter_record_spans(path):
+        _, tx_ids = record_ids(block)
+        state.add_transactions((tx_id, record_start) for tx_id in tx_ids)
+    state.commit(store_size)
+
+    os.remove(json_state_file(path))
+    print(f"Moved the block state from {json_state_file(path)} to {state_file(path)}")
+
+
+# Hash and transaction ids of a record (or of a block about to be stored)
+def record_ids(record):
+    if isinstance(record, RpcBlock):
+        return record.verboseData.hash, [
+            tx.verboseData.transactionId for tx in record.transactions
+        ]
+    return record["verboseData"]["hash"], [
+        tx["verboseData"]["transactionId"] for tx in record["transactions"]
+    ]
+
+
+# Yields (record, hash, is_chain_block, accepted) for the (offset, record)
+# pairs of a store, looking up the block state a batch at a time.
+# is_chain_block is None unless the chain membership of the block changed after
+# it was stored. accepted maps the ids of the accepted transactions of the
+# block to their accepting block; with first=True only those that no earlier
+# record of the store includes, so that every accepted transaction is in the
+# accepted of exactly one record. With acceptance=False only chain membership
+# is looked up.
+def apply_block_state(records, state, first=False, acceptance=True):
+    records = iter(records)
+    while batch := list(islice(records, STATE_BATCH_SIZE)):
+        ids = [record_ids(record) for _, record in batch]
+        chain_blocks = state.get_chain_blocks([hash for hash, _ in ids])
+        accepted_txs = {}
+        if acceptance:
+            accepted_txs = state.get_accepted(
+                [tx_id for _, tx_ids in ids for tx_id in tx_ids]
+            )
+
+        for (offset, record), (hash, tx_ids) in zip(batch, ids):
+            accepted = {}
+            for tx_id in tx_ids:
+                row = accepted_txs.get(tx_id)
+                if row is not None and (not first or row[1] == offset):
+                    accepted[tx_id] = row[0]
+            yield record, hash, chain_blocks.get(hash), accepted
+
+
+# Yields (hash, block) with the block state applied. By default blocks are
+# dicts shaped like the node's JSON (uint64 values as strings, accepted
+# transactions marked with "accepted" and "acceptingBlockHash"). With raw=True
+# blocks are RpcBlock messages (views of the JSON blocks unless the store is a
+# protobuf store, see block_view()) with only isChainBlock applied, see
+# iter_accepted_blocks() for their acceptance.
+def iter_blocks(path=BLOCKS_FILE, raw=False, state=None, start=0, end=None):
+    if not os.path.exists(path):
+        return
+    if state is None:
+        with open_block_state(path) as state:
+            yield from iter_blocks(path, raw, state, start, end)
+        return
+
+    records = (
+        (record_start, record)
+        for record_start, _, record in iter_record_spans(path, start, end)
+    )
+    for block, hash, is_chain_block, accepted in apply_block_state(
+        records, state, acceptance=not raw
+    ):
+        if raw:
+            if not isinstance(block, RpcBlock):
+                block = block_view(block)
+            if is_chain_block is not None:
+                block.verboseData.isChainBlock = is_chain_block
+            yield hash, block
+            continue
+
+        if isinstance(block, RpcBlock):
+            block = block_to_dict(block)
+
+        if is_chain_block is not None:
+            block["verboseData"]["isChainBlock"] = is_chain_block
+
+        for tx in block["transactions"]:
+            accepting_block_hash = accepted.get(tx["verboseData"]["transactionId"])
+            if accepting_block_hash is not None:
+                tx["accepted"] = True
+                tx["acceptingBlockHash"] = accepting_block_hash
+
+        yield hash, block
+
+
+# Yields (hash, block, accepted) with blocks like iter_blocks(raw=True) and
+# accepted as in apply_block_state(), for the records from start to end or for
+# the given (offset, record) pairs, e.g. of read_records()
+def iter_accepted_blocks(
+    path=BLOCKS_FILE, state=None, start=0, end=None, first=False, records=None
+):
+    if not os.path.exists(path):
+        return
+    if state is None:
+        with open_block_state(path) as state:
+            yield from iter_accepted_blocks(path, state, start, end, first, records)
+        return
+
+    if records is None:
+        records = (
+            (record_start, record)
+            for record_start, _, record in iter_record_spans(path, start, end)
+        )
+    for block, hash, is_chain_block, accepted in apply_block_state(
+        records, state, first
+    ):
+        if not isinstance(block, RpcBlock):
+            block = block_view(block)
+        if is_chain_block is not None:
+            block.verboseData.isChainBlock = is_chain_block
+        yield hash, block, accepted
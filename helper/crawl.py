@@ -0,0 +1,138 @@
+import json
+import os
+from collections import deque
+
+# Building blocks shared by save_blocks.py (batch crawl) and ingest_blocks.py
+# (live ingestion), which continue from each other's checkpoint.
+
+CHECKPOINT_FILE = "./data/blocks.checkpoint.json"
+RECENT_HASHES = 2000
+
+
+async def get_blocks(rpc_client, low_hash):
+    print(f"Requesting blocks with lowHash: {low_hash}")
+    r = await rpc_client.request(
+        "getBlocksRequest",
+        params={
+            "lowHash": low_hash,
+            "includeTransactions": True,
+            "includeBlocks": True,
+        },
+        raw=True,
+    )
+    return r.getBlocksResponse
+
+
+async def get_vspc(rpc_client, low_hash):
+    r = await rpc_client.request(
+        "getVirtualChainFromBlockRequest",
+        params={
+            "startHash": low_hash,
+            "includeAcceptedTransactionIds": True,
+        },
+        timeout=60 * 10,  # seconds * minutes, per chunk
+        retry=2,
+        raw=True,
+    )
+    return r.getVirtualChainFromBlockResponse
+
+
+async def get_block(rpc_client, hash, include_transactions=True):
+    r = await rpc_client.request(
+        "getBlockRequest",
+        params={"hash": hash, "includeTransactions": include_transactions},
+        raw=True,
+    )
+    return r.getBlockResponse
+
+
+async def get_selected_tip(rpc_client):
+    r = await rpc_client.request("GetSinkRequest", raw=True)
+    return r.GetSinkResponse.sink
+
+
+class RecentHashes(object):
+    # Bounded set of the most recently crawled block hashes. A block is only
+    # returned twice by getBlocks if it is in the anticone of a page's low hash,
+    # so duplicates are always among the most recent blocks.
+    def __init__(self, hashes=(), size=RECENT_HASHES):
+        self.queue = deque(maxlen=size)
+        self.set = set()
+        for hash in hashes:
+            self.add(hash)
+
+    def __contains__(self, hash):
+        return hash in self.set
+
+    def add(self, hash):
+        if len(self.queue) == self.queue.maxlen:
+            self.set.discard(self.queue[0])
+        self.queue.append(hash)
+        self.set.add(hash)
+
+
+# Apply a chunk of the virtual selected parent chain to the block state (see
+# helper.block_state), up to stop_hash (exclusive). Returns the last accepting
+# block applied, None if there was none, and whether stop_hash was reached. The
+# block index and the rollups are told about the changes if given.
+def apply_vspc(vspc, state, stop_hash, index=None, rollups=None):
+    # Set isChainBlock to False for removed blocks
+    removed_chain_blocks = set(vspc.removedChainBlockHashes)
+    state.set_chain_blocks(removed_chain_blocks, False)
+
+    # Undo the acceptance by chain blocks that got reorged out. The rollups
+    # recompute the hours of the records that first include the transactions
+    # whose acceptance changed.
+    changed_offsets = set()
+    if rollups is not None:
+        changed_offsets = state.get_first_offsets(removed_chain_blocks)
+    state.unaccept_chain_blocks(removed_chain_blocks)
+
+    # Set isChainBlock to True for added blocks
+    added_chain_blocks = []
+    for hash in vspc.addedChainBlockHashes:
+        if hash == stop_hash:
+            break
+        added_chain_blocks.append(hash)
+    state.set_chain_blocks(added_chain_blocks, True)
+
+    if index is not None:
+        index.set_chain_blocks(removed_chain_blocks, False)
+        index.set_chain_blocks(added_chain_blocks, True)
+
+    # Set accepted to True for accepted transactions
+    last_applied = None
+    accepting_blocks = []
+    for d in vspc.acceptedTransactionIds:
+        if d.acceptingBlockHash == stop_hash:
+            break
+
+        state.accept_transactions(d.acceptingBlockHash, d.acceptedTransactionIds)
+        last_applied = d.acceptingBlockHash
+        accepting_blocks.append(d.acceptingBlockHash)
+
+    if rollups is not None:
+        changed_offsets |= state.get_first_offsets(accepting_blocks)
+        rollups.chain_changed(
+            [*removed_chain_blocks, *added_chain_blocks], changed_offsets
+        )
+
+    return last_applied, len(added_chain_blocks) < len(vspc.addedChainBlockHashes)
+
+
+# The checkpoint records where the last run stopped. While a crawl of
+# save_blocks.py is running it also records the segments, so an interrupted
+# crawl can pick up every segment where its part file ends.
+def load_checkpoint():
+    if not os.path.exists(CHECKPOINT_FILE):
+        return None
+
+    with open(CHECKPOINT_FILE, "r") as f:
+        return json.load(f)
+
+
+def save_checkpoint(checkpoint):
+    tmp_file = f"{CHECKPOINT_FILE}.tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(checkpoint, f, indent=4)
+    os.replace(tmp_file, CHECKPOINT_FILE)
@@ -0,0 +1,28 @@
+import json
+
+# JSON decoding with the fastest parser that is installed: orjson, msgspec or
+# else the standard library. loads() takes str or bytes, DecodeError is what
+# it raises on invalid or truncated input.
+
+try:
+    import orjson
+
+    BACKEND = "orjson"
+    loads = orjson.loads
+    DecodeError = orjson.JSONDecodeError
+except ImportError:
+    try:
+        import msgspec
+
+        BACKEND = "msgspec"
+        loads = msgspec.json.Decoder().decode
+        DecodeError = msgspec.DecodeError
+    except ImportError:
+        BACKEND = "json"
+        loads = json.loads
+        DecodeError = json.JSONDecodeError
+
+
+# Decodes a whole file, opened in binary or text mode
+def load(f):
+    return loads(f.read())
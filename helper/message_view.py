@@ -0,0 +1,93 @@
+import base64
+
+from google.protobuf.descriptor import FieldDescriptor
+
+# Protobuf style access to a message decoded from its JSON form (see
+# json_format.MessageToDict): block.header.daaScore instead of
+# block["header"]["daaScore"]. Fields are converted when they are read, like
+# 64 bit integers that JSON holds as strings, and missing fields read as their
+# defaults. Much cheaper than json_format.ParseDict() when only some fields of
+# a message are read.
+
+INT64_TYPES = {
+    FieldDescriptor.TYPE_INT64,
+    FieldDescriptor.TYPE_UINT64,
+    FieldDescriptor.TYPE_SINT64,
+    FieldDescriptor.TYPE_FIXED64,
+    FieldDescriptor.TYPE_SFIXED64,
+}
+
+# Message descriptor: {field name: (JSON name, converter, repeated, field)}
+_fields = {}
+
+
+def converter(field):
+    if field.type == FieldDescriptor.TYPE_MESSAGE:
+        message_type = field.message_type
+        return lambda value: MessageView(value, message_type)
+    if field.type in INT64_TYPES:
+        return int
+    if field.type == FieldDescriptor.TYPE_BYTES:
+        return base64.b64decode
+    if field.type == FieldDescriptor.TYPE_ENUM:
+        values = field.enum_type.values_by_name
+        return lambda value: values[value].number if isinstance(value, str) else value
+    return None
+
+
+def is_repeated(field):
+    # FieldDescriptor.label is gone in newer protobuf releases
+    if hasattr(field, "is_repeated"):
+        return field.is_repeated
+    return field.label == FieldDescriptor.LABEL_REPEATED
+
+
+def fields_of(descriptor):
+    fields = _fields.get(descriptor)
+    if fields is None:
+        fields = _fields[descriptor] = {
+            field.name: (
+                field.json_name,
+                converter(field),
+                is_repeated(field),
+                field,
+            )
+            for field in descriptor.fields
+        }
+    return fields
+
+
+# View of the JSON dict of a message of the given type. Assigned fields are
+# written to the dict.
+class MessageView(object):
+    __slots__ = ("_dict", "_fields")
+
+    def __init__(self, d, descriptor):
+        object.__setattr__(self, "_dict", d)
+        object.__setattr__(self, "_fields", fields_of(descriptor))
+
+    def __getattr__(self, name):
+        try:
+            json_name, convert, repeated, field = self._fields[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+        if repeated:
+            values = self._dict.get(json_name, [])
+            return [convert(v) for v in values] if convert else values
+
+        if field.type == FieldDescriptor.TYPE_MESSAGE:
+            # Kept in the dict, so that assignments to it are too
+            return convert(self._dict.setdefault(json_name, {}))
+
+        value = self._dict.get(json_name)
+        if value is None:
+            return field.default_value
+        return convert(value) if convert else value
+
+    def __setattr__(self, name, value):
+        try:
+            json_name = self._fields[name][0]
+        except KeyError:
+            raise AttributeError(name) from None
+        self._dict[json_name] = value
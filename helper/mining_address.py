@@ -1,5 +1,7 @@
 # encoding: utf-8
 import binascii
+from functools import lru_cache, reduce
+from operator import xor
 
 charset = "qpzry9x8gf2tvdw0s3jn54khce6mua7l"
 
@@ -12,72 +14,92 @@ def get_miner_payload_from_block(block: dict):
     raise LookupError("Could not find miner payload.")
 
 
+# Coinbase payloads of the same miner differ only in the first 16 bytes (blue
+# score and subsidy), the script and info that follow are decoded once
+PAYLOAD_CACHE_SIZE = 4096
+ADDRESS_CACHE_SIZE = 4096
+
+
 def retrieve_miner_info_from_payload(payload: str):
     parsed_payload = parse_payload(payload)
     return parsed_payload[1], parsed_payload[0]
 
 
+# (info, address) of many payloads at once, None for payloads that can not be
+# decoded after calling on_error(i, exception) with their position
+def decode_payloads(payloads, on_error=None):
+    results = []
+    for i, payload in enumerate(payloads):
+        try:
+            address, info = parse_payload(payload)
+        except Exception as e:
+            if on_error is not None:
+                on_error(i, e)
+            results.append(None)
+            continue
+        results.append((info, address))
+    return results
+
+
 def parse_payload(payload: str):
     payload_bin = binascii.unhexlify(payload)
-    # version = payload_bin[16]
-    length = payload_bin[18]
-    script = payload_bin[19 : 19 + length]
+    return list(parse_script_and_info(payload_bin[16:]))
 
-    info = payload_bin[19 + length :]
 
-    return [toAddress(script), info.decode()]
+# Address and info from the payload after its first 16 bytes
+@lru_cache(maxsize=PAYLOAD_CACHE_SIZE)
+def parse_script_and_info(payload_tail: bytes):
+    # version = payload_tail[0]
+    length = payload_tail[2]
+    script = payload_tail[3 : 3 + length]
 
+    info = payload_tail[3 + length :]
 
-charset = "qpzry9x8gf2tvdw0s3jn54khce6mua7l"
+    return toAddress(script), info.decode()
 
 
-def polymod(values):
-    c = 1
+GENERATORS = (0x98F2BC8E61, 0x79B76D99E2, 0xF33E5FB3C4, 0xAE2EABE2A8, 0x1E4F43E470)
+# XOR of the generators selected by the 5 bits shifted out of the checksum
+POLYMOD_TABLE = tuple(
+    reduce(xor, (g for i, g in enumerate(GENERATORS) if c0 >> i & 1), 0)
+    for c0 in range(32)
+)
+# Maps 5-bit values to their base32 character with bytes.translate()
+CHARSET_TABLE = charset.encode().ljust(256, b"\0")
+
+
+def polymod_state(values, c=1):
     for d in values:
-        c0 = c >> 35
-        c = ((c & 0x07FFFFFFFF) << 5) ^ d
-        if c0 & 0x01:
-            c ^= 0x98F2BC8E61
-        if c0 & 0x02:
-            c ^= 0x79B76D99E2
-        if c0 & 0x04:
-            c ^= 0xF33E5FB3C4
-        if c0 & 0x08:
-            c ^= 0xAE2EABE2A8
-        if c0 & 0x10:
-            c ^= 0x1E4F43E470
-    return c ^ 1
+        c = ((c & 0x07FFFFFFFF) << 5) ^ d ^ POLYMOD_TABLE[c >> 35]
+    return c
+
+
+def polymod(values):
+    return polymod_state(values) ^ 1
+
+
+# Checksum state after the prefix and its separator
+@lru_cache(maxsize=None)
+def prefix_polymod_state(prefix: str):
+    return polymod_state(bytes([ord(c) & 0x1F for c in prefix]) + bytes([0]))
+
+
+# Splits bytes into 5-bit values, the last one padded with zero bits
+def to_base32(data: bytes):
+    bits = len(data) * 8
+    count = -(-bits // 5)
+    n = int.from_bytes(data, "big") << (count * 5 - bits)
+    return bytes((n >> shift) & 0x1F for shift in range(5 * (count - 1), -1, -5))
 
 
 def encodeAddress(prefix: str, payload: bytes, version: int):
-    data = bytes([version]) + payload
-    accumulator = 0
-    data = [int(x) for x in data]
-    ret = []
-    mask = (1 << 5) - 1
-    bits = 0
-    for value in data:
-        accumulator = (accumulator << 8) | value
-        bits = bits + 8
-
-        while bits >= 5:
-            bits = bits - 5
-            ret.append((accumulator >> bits) & mask)
-
-    if bits > 0:
-        ret.append((accumulator << (5 - bits)) & mask)
-
-    address = bytes(ret[::])
-    checksum_num = polymod(
-        bytes([ord(c) & 0x1F for c in prefix])
-        + bytes([0])
-        + address
-        + bytes([0, 0, 0, 0, 0, 0, 0, 0])
-    )
-    checksum = bytes([(checksum_num >> 5 * i) & 0x1F for i in range(7, -1, -1)])
-    return prefix + ":" + "".join(charset[b] for b in address + checksum)
+    address = to_base32(bytes([version]) + payload)
+    checksum_num = polymod_state(address + bytes(8), prefix_polymod_state(prefix)) ^ 1
+    checksum = bytes((checksum_num >> shift) & 0x1F for shift in range(35, -1, -5))
+    return prefix + ":" + (address + checksum).translate(CHARSET_TABLE).decode()
 
 
+@lru_cache(maxsize=ADDRESS_CACHE_SIZE)
 def toAddress(script):
     if script[0] == 0xAA and script[1] <= 0x76:
         return encodeAddress("spectre", script[2 : (2 + script[1])], 0x08)
@@ -0,0 +1,177 @@
+import mmap
+import os
+import struct
+from bisect import bisect_left
+
+import numpy as np
+
+# Compact, memory-mappable index of transaction outputs for resolving the
+# previous outpoints of inputs.
+#
+# Layout (little-endian unless noted):
+#   header   magic, version, record count, address count (24 bytes)
+#   records  sorted by key, 48 bytes each:
+#            txid (32 bytes) + output index (uint32, big-endian) as the key,
+#            amount (int64), address id (uint32)
+#   offsets  address count + 1 uint32 offsets into the address blob
+#   blob     utf-8 addresses, each address is stored once
+#
+# Keys compare like bytes, so lookups are a binary search over the mapped
+# file and opening the index reads nothing but the header.
+OUTPOINTS_FILE = "./data/outpoints.idx"
+# Outputs from before the block store, fetched from the node
+RESOLVED_OUTPOINTS_FILE = "./data/outpoints.resolved.idx"
+
+MAGIC = b"SPOI"
+VERSION = 1
+HEADER = struct.Struct("<4sIQI4x")
+KEY_SIZE = 36
+RECORD = struct.Struct(f"<{KEY_SIZE}sqI")
+OFFSET = struct.Struct("<I")
+
+RECORD_DTYPE = np.dtype(
+    [
+        ("t0", ">u8"),
+        ("t1", ">u8"),
+        ("t2", ">u8"),
+        ("t3", ">u8"),
+        ("index", ">u4"),
+        ("amount", "<i8"),
+        ("address", "<u4"),
+    ]
+)
+
+
+def outpoint_key(tx_id, index):
+    return bytes.fromhex(tx_id) + index.to_bytes(4, "big")
+
+
+class OutpointIndexWriter(object):
+    def __init__(self):
+        self.records = bytearray()
+        self.addresses = {}
+
+    def __len__(self):
+        return len(self.records) // RECORD.size
+
+    def add(self, tx_id, index, amount, address):
+        address_id = self.addresses.setdefault(address, len(self.addresses))
+        self.records += RECORD.pack(outpoint_key(tx_id, index), amount, address_id)
+
+    # Appends the outputs of another writer, as if they were added here
+    def merge(self, other):
+        address_ids = np.array(
+            [
+                self.addresses.setdefault(address, len(self.addresses))
+                for address in other.addresses
+            ],
+            dtype="<u4",
+        )
+        records = np.frombuffer(other.records, dtype=RECORD_DTYPE).copy()
+        records["address"] = address_ids[records["address"]]
+        self.records += records.tobytes()
+
+    def save(self, path=OUTPOINTS_FILE):
+        records = np.frombuffer(self.records, dtype=RECORD_DTYPE)
+        order = np.lexsort(
+            (
+                records["index"],
+                records["t3"],
+                records["t2"],
+                records["t1"],
+                records["t0"],
+            )
+        )
+        records = records[order]
+
+        # Transactions merged by several blocks add their outputs again
+        keys = records[["t0", "t1", "t2", "t3", "index"]]
+        if len(records):
+            records = records[np.concatenate(([True], keys[1:] != keys[:-1]))]
+
+        blob = bytearray()
+        offsets = bytearray(OFFSET.pack(0))
+        for address in self.addresses:
+            blob += address.encode()
+            offsets += OFFSET.pack(len(blob))
+
+        tmp_file = f"{path}.tmp"
+        with open(tmp_file, "wb") as f:
+            f.write(HEADER.pack(MAGIC, VERSION, len(records), len(self.addresses)))
+            f.write(records.tobytes())
+            f.write(offsets)
+            f.write(blob)
+        os.replace(tmp_file, path)
+        return len(records)
+
+
+class _Keys(object):
+    # Sequence view of the record keys for bisect
+    def __init__(self, data, count):
+        self.data = data
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        pos = HEADER.size + i * RECORD.size
+        return self.data[pos : pos + KEY_SIZE]
+
+
+class OutpointIndex(object):
+    def __init__(self, path=OUTPOINTS_FILE):
+        self.f = open(path, "rb")
+        self.data = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.count, self.address_count = HEADER.unpack_from(self.data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} outpoint index")
+
+        self.keys = _Keys(self.data, self.count)
+        self.offsets = HEADER.size + self.count * RECORD.size
+        self.blob = self.offsets + (self.address_count + 1) * OFFSET.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, outpoint):
+        return self.get(*outpoint) is not None
+
+    # (tx_id, index, amount, address) of every output, in key order
+    def __iter__(self):
+        for i in range(self.count):
+            key, amount, address_id = RECORD.unpack_from(
+                self.data, HEADER.size + i * RECORD.size
+            )
+            tx_id = key[:32].hex()
+            index = int.from_bytes(key[32:], "big")
+            yield tx_id, index, amount, self.address(address_id)
+
+    def address(self, address_id):
+        start, end = struct.unpack_from(
+            "<II", self.data, self.offsets + address_id * OFFSET.size
+        )
+        return self.data[self.blob + start : self.blob + end].decode()
+
+    # (amount, address) of an outpoint, None if it is not in the index
+    def get(self, tx_id, index):
+        key = outpoint_key(tx_id, index)
+        i = bisect_left(self.keys, key)
+        if i == self.count or self.keys[i] != key:
+            return None
+
+        _, amount, address_id = RECORD.unpack_from(
+            self.data, HEADER.size + i * RECORD.size
+        )
+        return amount, self.address(address_id)
+
+    def close(self):
+        self.data.close()
+        self.f.close()
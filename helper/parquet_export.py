@@ -0,0 +1,343 @@
+import os
+import shutil
+from collections import OrderedDict, defaultdict
+from datetime import datetime, timezone
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from helper.block_stats import COINBASE_SUBNETWORK_ID
+from helper.block_store import iter_accepted_blocks
+from helper.sharding import map_shards
+
+# Flat, typed tables of the block store in Parquet files, one dataset per
+# table in hive-style partitions (e.g. blocks/day=2024-05-01/*.parquet), so
+# that readers like pyarrow.dataset, pandas, DuckDB or Spark only load the
+# columns and partitions they need:
+#
+#   blocks        one row per block
+#   transactions  one row per transaction of a block (a transaction included
+#                 by several blocks has several rows, accepting_block_hash is
+#                 the same in all of them)
+#   inputs        one row per transaction input
+#   outputs       one row per transaction output
+#   mergesets     one row per block merged by a block, blue or red
+#
+# Rows of a block go to the partition of the block: its UTC day or the range
+# of DAA scores it falls in. Hex encoded scripts and payloads are stored as
+# binary.
+
+PARQUET_DIR = "./data/parquet"
+
+TABLES = ("blocks", "transactions", "inputs", "outputs", "mergesets")
+
+# Rows buffered per table and partition before they are written as a row group
+ROW_GROUP_SIZE = 100_000
+# Partitions with open files per process. Blocks are stored roughly in time
+# order, so only the last few partitions receive rows; a partition that is
+# closed and gets rows again continues in a new file.
+MAX_OPEN_PARTITIONS = 8
+
+TIMESTAMP = pa.timestamp("ms", tz="UTC")
+
+SCHEMAS = {
+    "blocks": pa.schema(
+        [
+            ("hash", pa.string()),
+            ("timestamp", TIMESTAMP),
+            ("daa_score", pa.uint64()),
+            ("blue_score", pa.uint64()),
+            ("blue_work", pa.string()),
+            ("version", pa.uint32()),
+            ("bits", pa.uint32()),
+            ("nonce", pa.uint64()),
+            ("difficulty", pa.float64()),
+            ("is_chain_block", pa.bool_()),
+            ("selected_parent_hash", pa.string()),
+            ("parent_hashes", pa.list_(pa.string())),
+            ("merged_blues", pa.uint32()),
+            ("merged_reds", pa.uint32()),
+            ("tx_count", pa.uint32()),
+        ]
+    ),
+    "transactions": pa.schema(
+        [
+            ("tx_id", pa.string()),
+            ("block_hash", pa.string()),
+            ("position", pa.uint32()),
+            ("block_time", TIMESTAMP),
+            ("is_coinbase", pa.bool_()),
+            ("subnetwork_id", pa.string()),
+            ("version", pa.uint32()),
+            ("lock_time", pa.uint64()),
+            ("gas", pa.uint64()),
+            ("mass", pa.uint64()),
+            ("payload", pa.binary()),
+            ("input_count", pa.uint32()),
+            ("output_count", pa.uint32()),
+            ("output_amount", pa.uint64()),
+            ("accepting_block_hash", pa.string()),
+        ]
+    ),
+    "inputs": pa.schema(
+        [
+            ("tx_id", pa.string()),
+            ("block_hash", pa.string()),
+            ("index", pa.uint32()),
+            ("previous_tx_id", pa.string()),
+            ("previous_index", pa.uint32()),
+            ("sequence", pa.uint64()),
+            ("sig_op_count", pa.uint32()),
+            ("signature_script", pa.binary()),
+        ]
+    ),
+    "outputs": pa.schema(
+        [
+            ("tx_id", pa.string()),
+            ("block_hash", pa.string()),
+            ("index", pa.uint32()),
+            ("amount", pa.uint64()),
+            ("address", pa.string()),
+            ("script_type", pa.string()),
+            ("script_version", pa.uint32()),
+            ("script_public_key", pa.binary()),
+        ]
+    ),
+    "mergesets": pa.schema(
+        [
+            ("block_hash", pa.string()),
+            ("merged_hash", pa.string()),
+            ("is_blue", pa.bool_()),
+        ]
+    ),
+}
+
+
+# (key, value) of the partition of a block: its UTC day or, with a range
+# size, the start of its DAA score range
+def partition_of(block, daa_range_size=None):
+    if daa_range_size:
+        daa_score = block.header.daaScore
+        return "daa_range", daa_score - daa_score % daa_range_size
+
+    ts = block.header.timestamp / 1000
+    return "day", datetime.fromtimestamp(ts, timezone.utc).strftime("%Y-%m-%d")
+
+
+# Column buffers of one partition, written to one file per table
+class PartitionFiles(object):
+    def __init__(self, out_dir, partition, name, compression, rows):
+        key, value = partition
+        self.dirs = {t: os.path.join(out_dir, t, f"{key}={value}") for t in TABLES}
+        self.name = name
+        self.compression = compression
+        self.rows = rows  # Rows written per table, shared by all partitions
+        self.columns = {t: {c: [] for c in SCHEMAS[t].names} for t in TABLES}
+        self.writers = {}
+
+    def flush(self, table):
+        columns = self.columns[table]
+        if not columns[SCHEMAS[table].names[0]]:
+            return
+
+        writer = self.writers.get(table)
+        if writer is None:
+            os.makedirs(self.dirs[table], exist_ok=True)
+            writer = self.writers[table] = pq.ParquetWriter(
+                os.path.join(self.dirs[table], self.name),
+                SCHEMAS[table],
+                compression=self.compression,
+            )
+        writer.write_table(pa.Table.from_pydict(columns, schema=SCHEMAS[table]))
+        self.rows[table] += len(columns[SCHEMAS[table].names[0]])
+        for values in columns.values():
+            values.clear()
+
+    def close(self):
+        for table in TABLES:
+            self.flush(table)
+        for writer in self.writers.values():
+            writer.close()
+
+
+class ParquetExporter(object):
+    def __init__(
+        self,
+        out_dir,
+        daa_range_size=None,
+        prefix="part",
+        compression="zstd",
+        row_group_size=ROW_GROUP_SIZE,
+    ):
+        self.out_dir = out_dir
+        self.daa_range_size = daa_range_size
+        self.prefix = prefix
+        self.compression = compression
+        self.row_group_size = row_group_size
+        self.open = OrderedDict()
+        self.files_written = defaultdict(int)
+        self.rows = dict.fromkeys(TABLES, 0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __files(self, partition):
+        files = self.open.get(partition)
+        if files is not None:
+            self.open.move_to_end(partition)
+            return files
+
+        if len(self.open) >= MAX_OPEN_PARTITIONS:
+            _, oldest = self.open.popitem(last=False)
+            oldest.close()
+
+        n = self.files_written[partition]
+        self.files_written[partition] += 1
+        files = self.open[partition] = PartitionFiles(
+            self.out_dir,
+            partition,
+            f"{self.prefix}-{n}.parquet",
+            self.compression,
+            self.rows,
+        )
+        return files
+
+    # accepted: {tx_id: accepting block hash} of the accepted transactions of
+    # the block, see helper.block_store.iter_accepted_blocks()
+    def add_block(self, block, accepted):
+        files = self.__files(partition_of(block, self.daa_range_size))
+        hash = block.verboseData.hash
+
+        b = files.columns["blocks"]
+        header = block.header
+        verbose = block.verboseData
+        b["hash"].append(hash)
+        b["timestamp"].append(header.timestamp)
+        b["daa_score"].append(header.daaScore)
+        b["blue_score"].append(header.blueScore)
+        b["blue_work"].append(header.blueWork)
+        b["version"].append(header.version)
+        b["bits"].append(header.bits)
+        b["nonce"].append(header.nonce)
+        b["difficulty"].append(verbose.difficulty)
+        b["is_chain_block"].append(verbose.isChainBlock)
+        b["selected_parent_hash"].append(verbose.selectedParentHash)
+        b["parent_hashes"].append(
+            list(header.parents[0].parentHashes) if header.parents else []
+        )
+        b["merged_blues"].append(len(verbose.mergeSetBluesHashes))
+        b["merged_reds"].append(len(verbose.mergeSetRedsHashes))
+        b["tx_count"].append(len(block.transactions))
+
+        m = files.columns["mergesets"]
+        for is_blue, merged in (
+            (True, verbose.mergeSetBluesHashes),
+            (False, verbose.mergeSetRedsHashes),
+        ):
+            m["block_hash"].extend([hash] * len(merged))
+            m["merged_hash"].extend(merged)
+            m["is_blue"].extend([is_blue] * len(merged))
+
+        t = files.columns["transactions"]
+        i = files.columns["inputs"]
+        o = files.columns["outputs"]
+        for position, tx in enumerate(block.transactions):
+            tx_id = tx.verboseData.transactionId
+            t["tx_id"].append(tx_id)
+            t["block_hash"].append(hash)
+            t["position"].append(position)
+            t["block_time"].append(tx.verboseData.blockTime or header.timestamp)
+            t["is_coinbase"].append(tx.subnetworkId == COINBASE_SUBNETWORK_ID)
+            t["subnetwork_id"].append(tx.subnetworkId)
+            t["version"].append(tx.version)
+            t["lock_time"].append(tx.lockTime)
+            t["gas"].append(tx.gas)
+            t["mass"].append(tx.mass)
+            t["payload"].append(bytes.fromhex(tx.payload))
+            t["input_count"].append(len(tx.inputs))
+            t["output_count"].append(len(tx.outputs))
+            t["output_amount"].append(sum(output.amount for output in tx.outputs))
+            t["accepting_block_hash"].append(accepted.get(tx_id))
+
+            for index, input in enumerate(tx.inputs):
+                i["tx_id"].append(tx_id)
+                i["block_hash"].append(hash)
+                i["index"].append(index)
+                i["previous_tx_id"].append(input.previousOutpoint.transactionId)
+                i["previous_index"].append(input.previousOutpoint.index)
+                i["sequence"].append(input.sequence)
+                i["sig_op_count"].append(input.sigOpCount)
+                i["signature_script"].append(bytes.fromhex(input.signatureScript))
+
+            for index, output in enumerate(tx.outputs):
+                o["tx_id"].append(tx_id)
+                o["block_hash"].append(hash)
+                o["index"].append(index)
+                o["amount"].append(output.amount)
+                o["address"].append(output.verboseData.scriptPublicKeyAddress)
+                o["script_type"].append(output.verboseData.scriptPublicKeyType)
+                o["script_version"].append(output.scriptPublicKey.version)
+                o["script_public_key"].append(
+                    bytes.fromhex(output.scriptPublicKey.scriptPublicKey)
+                )
+
+        for table in TABLES:
+            if (
+                len(files.columns[table][SCHEMAS[table].names[0]])
+                >= self.row_group_size
+            ):
+                files.flush(table)
+
+    def close(self):
+        while self.open:
+            _, files = self.open.popitem(last=False)
+            files.close()
+
+
+# Exports one shard of the block store (see helper.sharding), the files are
+# named after the shard so that shards can be exported in parallel. Returns
+# the number of rows per table.
+def export_shard(shard, path, out_dir, daa_range_size, compression, row_group_size):
+    start, end = shard
+    with ParquetExporter(
+        out_dir,
+        daa_range_size,
+        prefix=f"part-{start:012d}",
+        compression=compression,
+        row_group_size=row_group_size,
+    ) as exporter:
+        for _, block, accepted in iter_accepted_blocks(path, start=start, end=end):
+            exporter.add_block(block, accepted)
+    return exporter.rows
+
+
+# Rewrites the Parquet datasets of the whole store with `workers` processes,
+# partitioned by day or, with daa_range_size, by DAA score range
+def export_store(
+    path,
+    out_dir=PARQUET_DIR,
+    daa_range_size=None,
+    workers=1,
+    compression="zstd",
+    row_group_size=ROW_GROUP_SIZE,
+):
+    for table in TABLES:
+        shutil.rmtree(os.path.join(out_dir, table), ignore_errors=True)
+
+    rows = dict.fromkeys(TABLES, 0)
+    for shard_rows in map_shards(
+        export_shard,
+        path,
+        workers,
+        path,
+        out_dir,
+        daa_range_size,
+        compression,
+        row_group_size,
+    ):
+        for table, count in shard_rows.items():
+            rows[table] += count
+    return rows
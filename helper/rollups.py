@@ -0,0 +1,370 @@
+import os
+import sqlite3
+from collections import Counter
+
+from helper.block_index import INDEX_FILE
+from helper.block_stats import COINBASE_SUBNETWORK_ID
+from helper.block_store import (
+    BLOCKS_FILE,
+    block_view,
+    iter_accepted_blocks,
+    iter_record_spans,
+    open_block_state,
+    read_records,
+)
+from helper.mining_address import decode_payloads
+from helper.outpoint_index import OUTPOINTS_FILE, RESOLVED_OUTPOINTS_FILE
+from helper.spent_outputs import SPENT_OUTPUTS_FILE, load_spent_outputs
+from spectred.rpc_pb2 import RpcBlock
+
+# Pre-aggregated block statistics per hour (UTC), with daily views on top, so
+# that reports do not have to read the block store. Kept up to date by
+# save_blocks.py and ingest_blocks.py once the database exists (created with
+# update_rollups.py).
+#
+# Every block stored is recorded with its hour and its offset in the store.
+# An hour is recomputed from its own blocks only when it changed: when blocks
+# were added to it, or when the virtual chain changed the chain membership of
+# one of its blocks or the acceptance of a transaction first included by one
+# of its blocks.
+#
+# Transactions count once they are accepted, in the hour of the first record
+# of the store that includes them (see helper.block_state), so every accepted
+# transaction counts in exactly one hour, as in block_tx_analysis.py. Fees are
+# the inputs minus the outputs of transactions whose spent outputs are all
+# known (see helper.spent_outputs), hours with unresolved transactions are
+# recomputed when the spent outputs are rebuilt.
+ROLLUPS_FILE = "./data/rollups.sqlite"
+
+HOUR = 60 * 60 * 1000
+DAY = 24 * HOUR
+
+# Blocks recorded per INSERT while reading the store
+BATCH_SIZE = 1000
+
+# Hourly statistics, in the order of the hourly_rollups columns
+COLUMNS = (
+    "blocks",
+    "chain_blocks",
+    "merged_blues",
+    "merged_reds",
+    "max_mergeset",
+    "coinbase_txs",
+    "coinbase_amount",
+    "txs",
+    "outputs",
+    "output_amount",
+    "fee_txs",
+    "fees",
+    "unresolved_txs",
+)
+
+
+def aggregate(column):
+    return f"MAX({column})" if column.startswith("max_") else f"SUM({column})"
+
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS rollup_blocks (
+    hash TEXT PRIMARY KEY,
+    hour INTEGER NOT NULL,
+    offset INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS rollup_blocks_hour ON rollup_blocks (hour, offset);
+CREATE INDEX IF NOT EXISTS rollup_blocks_offset ON rollup_blocks (offset);
+
+CREATE TABLE IF NOT EXISTS hourly_rollups (
+    hour INTEGER PRIMARY KEY,
+    {", ".join(f"{column} INTEGER NOT NULL" for column in COLUMNS)}
+);
+
+CREATE TABLE IF NOT EXISTS hourly_miners (
+    hour INTEGER NOT NULL,
+    address TEXT NOT NULL,
+    blocks INTEGER NOT NULL,
+    PRIMARY KEY (hour, address)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS dirty_hours (hour INTEGER PRIMARY KEY);
+
+CREATE TABLE IF NOT EXISTS rollup_meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+) WITHOUT ROWID;
+
+CREATE VIEW IF NOT EXISTS hourly AS
+SELECT *, CAST(chain_blocks AS REAL) / blocks AS chain_block_ratio
+FROM hourly_rollups;
+
+CREATE VIEW IF NOT EXISTS daily AS
+SELECT
+    hour - hour % {DAY} AS day,
+    {", ".join(f"{aggregate(column)} AS {column}" for column in COLUMNS)},
+    CAST(SUM(chain_blocks) AS REAL) / SUM(blocks) AS chain_block_ratio
+FROM hourly_rollups
+GROUP BY day;
+
+CREATE VIEW IF NOT EXISTS daily_miners AS
+SELECT hour - hour % {DAY} AS day, address, SUM(blocks) AS blocks
+FROM hourly_miners
+GROUP BY day, address;
+"""
+
+TABLES = (
+    "rollup_blocks",
+    "hourly_rollups",
+    "hourly_miners",
+    "dirty_hours",
+    "rollup_meta",
+)
+
+
+def hour_of(block):
+    return block.header.timestamp - block.header.timestamp % HOUR
+
+
+def spent_outputs_mtime():
+    files = (OUTPOINTS_FILE, RESOLVED_OUTPOINTS_FILE, SPENT_OUTPUTS_FILE)
+    return max(
+        (int(os.path.getmtime(f)) for f in files if os.path.exists(f)), default=0
+    )
+
+
+def has_spent_outputs():
+    files = (OUTPOINTS_FILE, INDEX_FILE, SPENT_OUTPUTS_FILE)
+    return any(os.path.exists(f) for f in files)
+
+
+# Statistics of the blocks of one hour, (hash, block, accepted) as yielded by
+# helper.block_store.iter_accepted_blocks(), see COLUMNS
+def hour_stats(blocks, get_spent_output=None):
+    stats = dict.fromkeys(COLUMNS, 0)
+    payloads = []
+
+    for _, block, accepted in blocks:
+        blues = len(block.verboseData.mergeSetBluesHashes)
+        reds = len(block.verboseData.mergeSetRedsHashes)
+        stats["blocks"] += 1
+        stats["chain_blocks"] += block.verboseData.isChainBlock
+        stats["merged_blues"] += blues
+        stats["merged_reds"] += reds
+        stats["max_mergeset"] = max(stats["max_mergeset"], blues + reds)
+        payloads.append(block.transactions[0].payload if block.transactions else "")
+
+        for tx in block.transactions:
+            tx_id = tx.verboseData.transactionId
+            if tx_id not in accepted:
+                continue
+
+            output_amount = sum(output.amount for output in tx.outputs)
+            if tx.subnetworkId == COINBASE_SUBNETWORK_ID:
+                stats["coinbase_txs"] += 1
+                stats["coinbase_amount"] += output_amount
+                continue
+
+            stats["txs"] += 1
+            stats["outputs"] += len(tx.outputs)
+            stats["output_amount"] += output_amount
+
+            input_amount = 0
+            for input in tx.inputs:
+                outpoint = input.previousOutpoint
+                spent_output = None
+                if get_spent_output is not None:
+                    spent_output = get_spent_output(
+                        outpoint.transactionId, outpoint.index
+                    )
+                if spent_output is None:
+                    stats["unresolved_txs"] += 1
+                    break
+                input_amount += spent_output[0]
+            else:
+                stats["fee_txs"] += 1
+                stats["fees"] += input_amount - output_amount
+
+    miners = Counter(address for _, address in filter(None, decode_payloads(payloads)))
+    return stats, miners
+
+
+class Rollups(object):
+    def __init__(self, path=ROLLUPS_FILE):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute("PRAGMA synchronous = NORMAL")
+
+        # Rollups of earlier versions counted a transaction in every hour with
+        # a block that includes it, they are dropped and rebuilt from the store
+        columns = [
+            row[1] for row in self.db.execute("PRAGMA table_info(rollup_blocks)")
+        ]
+        if "first_hour" in columns:
+            for table in TABLES:
+                self.db.execute(f"DROP TABLE {table}")
+        self.db.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def __get_meta(self, key, default=0):
+        row = self.db.execute(
+            "SELECT value FROM rollup_meta WHERE key = ?", (key,)
+        ).fetchone()
+        return row[0] if row else default
+
+    def __set_meta(self, key, value):
+        self.db.execute(
+            "INSERT OR REPLACE INTO rollup_meta VALUES (?, ?)", (key, value)
+        )
+
+    # Forget everything, e.g. for a store that is crawled again
+    def reset(self):
+        for table in TABLES:
+            self.db.execute(f"DELETE FROM {table}")
+        self.db.commit()
+
+    # Marks the hours of the recorded blocks with the given hashes or offsets
+    def __mark_hours(self, column, keys):
+        keys = list(keys)
+        for i in range(0, len(keys), 500):
+            batch = keys[i : i + 500]
+            self.db.execute(
+                "INSERT OR IGNORE INTO dirty_hours SELECT DISTINCT hour FROM "
+                f"rollup_blocks WHERE {column} IN ({', '.join('?' * len(batch))})",
+                batch,
+            )
+
+    # Marks the hours affected by chain blocks that were added or removed, and
+    # by transactions whose acceptance changed, given by the offsets of the
+    # records that first include them. Blocks not recorded yet are taken care
+    # of when they are.
+    def chain_changed(self, hashes, offsets=()):
+        self.__mark_hours("hash", hashes)
+        self.__mark_hours("offset", offsets)
+
+    # Records the blocks appended to the store since the last update, up to
+    # byte offset end, then recomputes the changed hours
+    def update(self, path=BLOCKS_FILE, state=None, end=None):
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"No block store at {path}")
+        if state is None:
+            with open_block_state(path) as state:
+                return self.update(path, state, end)
+
+        start = self.__get_meta("store_offset")
+        if end is None:
+            end = os.path.getsize(path)
+        if end < start:
+            # The store was truncated or crawled again
+            self.reset()
+            start = 0
+
+        blocks = 0
+        batch = {}  # hash: (hour, offset)
+        for record_start, record_end, block in iter_record_spans(path, start, end):
+            if not isinstance(block, RpcBlock):
+                block = block_view(block)
+            batch[block.verboseData.hash] = (hour_of(block), record_start)
+            start = record_end
+
+            if len(batch) == BATCH_SIZE:
+                blocks += self.__add_blocks(batch)
+                batch = {}
+        blocks += self.__add_blocks(batch)
+        self.__set_meta("store_offset", start)
+
+        # Fees of transactions that could not be resolved before
+        mtime = spent_outputs_mtime()
+        if mtime > self.__get_meta("spent_outputs_mtime"):
+            self.db.execute(
+                "INSERT OR IGNORE INTO dirty_hours "
+                "SELECT hour FROM hourly_rollups WHERE unresolved_txs > 0"
+            )
+            self.__set_meta("spent_outputs_mtime", mtime)
+
+        dirty = [h for (h,) in self.db.execute("SELECT hour FROM dirty_hours")]
+        get_spent_output = None
+        if dirty and has_spent_outputs():
+            get_spent_output = load_spent_outputs(verbose=False)
+        for hour in sorted(dirty):
+            self.__recompute(path, state, hour, get_spent_output)
+        self.db.execute("DELETE FROM dirty_hours")
+        self.db.commit()
+        return blocks, len(dirty)
+
+    def __add_blocks(self, batch):
+        self.db.executemany(
+            "INSERT OR IGNORE INTO rollup_blocks VALUES (?, ?, ?)",
+            ((hash, *row) for hash, row in batch.items()),
+        )
+        self.db.executemany(
+            "INSERT OR IGNORE INTO dirty_hours VALUES (?)",
+            {(hour,) for hour, _ in batch.values()},
+        )
+        return len(batch)
+
+    def __recompute(self, path, state, hour, get_spent_output):
+        offsets = [
+            offset
+            for (offset,) in self.db.execute(
+                "SELECT offset FROM rollup_blocks WHERE hour = ? ORDER BY offset",
+                (hour,),
+            )
+        ]
+        self.db.execute("DELETE FROM hourly_rollups WHERE hour = ?", (hour,))
+        self.db.execute("DELETE FROM hourly_miners WHERE hour = ?", (hour,))
+        if not offsets:
+            return
+
+        blocks = iter_accepted_blocks(
+            path, state, first=True, records=zip(offsets, read_records(path, offsets))
+        )
+        stats, miners = hour_stats(blocks, get_spent_output)
+        self.db.execute(
+            f"INSERT INTO hourly_rollups VALUES (?{', ?' * len(COLUMNS)})",
+            (hour, *stats.values()),
+        )
+        self.db.executemany(
+            "INSERT INTO hourly_miners VALUES (?, ?, ?)",
+            ((hour, address, blocks) for address, blocks in miners.items()),
+        )
+
+    ## Queries
+    # Rows of the hourly or daily view as dicts, oldest first
+    def rows(self, view="daily", start=None, end=None):
+        key = "hour" if view == "hourly" else "day"
+        cursor = self.db.execute(
+            f"SELECT * FROM {view} WHERE {key} >= ? AND {key} < ? ORDER BY {key}",
+            (start or 0, end or 2**62),
+        )
+        names = [d[0] for d in cursor.description]
+        return [dict(zip(names, row)) for row in cursor]
+
+    # Sums over the hours in [start, end), e.g. a rolling 24 hour window
+    def window(self, start, end):
+        cursor = self.db.execute(
+            f"SELECT {', '.join(aggregate(c) for c in COLUMNS)} "
+            "FROM hourly_rollups WHERE hour >= ? AND hour < ?",
+            (start, end),
+        )
+        return dict(zip(COLUMNS, (value or 0 for value in cursor.fetchone())))
+
+    # {address: blocks} of the miners in [start, end)
+    def miners(self, start, end):
+        return dict(
+            self.db.execute(
+                "SELECT address, SUM(blocks) FROM hourly_miners "
+                "WHERE hour >= ? AND hour < ? GROUP BY address ORDER BY 2 DESC",
+                (start, end),
+            )
+        )
@@ -0,0 +1,17 @@
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+from helper.block_store import shard_store
+
+
+# Runs func(shard, *args) for every shard of the block store, in a pool of
+# `workers` processes, and returns the results in store order. Shards are
+# (start, end) byte ranges, see shard_store(). Worker processes may import the
+# calling script, so it needs a main guard.
+def map_shards(func, path, workers, *args):
+    shards = shard_store(path, workers)
+    if workers <= 1 or len(shards) <= 1:
+        return [func(shard, *args) for shard in shards]
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(func, shards, *(repeat(arg) for arg in args)))
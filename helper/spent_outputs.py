@@ -0,0 +1,53 @@
+import os
+
+from helper import fast_json
+from helper.block_index import INDEX_FILE, BlockIndex
+from helper.outpoint_index import OUTPOINTS_FILE, RESOLVED_OUTPOINTS_FILE, OutpointIndex
+
+SPENT_OUTPUTS_FILE = "./data/spent-outputs.json"
+
+
+# Returns get_spent_output(tx_id, index) -> (amount, address) or None.
+# Outputs created in the store are looked up in the outpoint index
+# (filter_spent_outputs.py) or else in the block index (save_blocks.py --index
+# or build_index.py), data/spent-outputs.json is only loaded when neither
+# exists. Older outputs fetched from the node by resolve_outpoints.py are
+# looked up after that.
+def load_spent_outputs(verbose=True):
+    if os.path.exists(OUTPOINTS_FILE):
+        outpoint_index = OutpointIndex(OUTPOINTS_FILE)
+        get_stored_output = outpoint_index.get
+
+        if verbose:
+            print(f"Outpoint Index Loaded: {len(outpoint_index)} outputs")
+    elif os.path.exists(INDEX_FILE):
+        block_index = BlockIndex(INDEX_FILE)
+        get_stored_output = block_index.get_output
+
+        if verbose:
+            print(f"Block Index Loaded: {block_index.count('outputs')} outputs")
+    else:
+        with open(SPENT_OUTPUTS_FILE, "rb") as f:
+            spent_outputs = fast_json.load(f)["outputs"]
+
+        def get_stored_output(tx_id, index):
+            output = spent_outputs.get(f"{tx_id}-{index}")
+            return (output["amount"], output["address"]) if output else None
+
+        if verbose:
+            print(f"Spent Outputs Loaded: {len(spent_outputs)}")
+
+    if not os.path.exists(RESOLVED_OUTPOINTS_FILE):
+        return get_stored_output
+
+    resolved_outputs = OutpointIndex(RESOLVED_OUTPOINTS_FILE)
+    if verbose:
+        print(f"Resolved Outpoints Loaded: {len(resolved_outputs)} outputs")
+
+    def get_spent_output(tx_id, index):
+        output = get_stored_output(tx_id, index)
+        if output is None:
+            output = resolved_outputs.get(tx_id, index)
+        return output
+
+    return get_spent_output
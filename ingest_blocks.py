@@ -0,0 +1,294 @@
+from collections import deque
+from datetime import datetime
+import argparse
+import asyncio
+import os
+import time
+from helper.block_index import INDEX_FILE, BlockIndex
+from helper.block_store import (
+    BLOCKS_FILE,
+    BlockStoreWriter,
+    open_block_state,
+)
+from helper.crawl import (
+    RecentHashes,
+    apply_vspc,
+    get_blocks,
+    get_vspc,
+    load_checkpoint,
+    save_checkpoint,
+)
+from helper.rollups import ROLLUPS_FILE, Rollups
+from spectred.SpectredClient import SpectredClient
+from spectred.SpectredThread import SpectredCommunicationError
+
+# Keeps the block store current without re-running the crawl: new blocks and
+# virtual chain changes are written to the store as the node announces them.
+# Runs on top of a store crawled by save_blocks.py and keeps its checkpoint up
+# to date, so either script can continue where the other one stopped (do not
+# run both at once).
+#
+# Notifications are subscribed before anything else on every (re)connect, then
+# blocks and chain changes since the checkpoint are fetched with getBlocks and
+# getVirtualChainFromBlock. Notifications received in the meantime are applied
+# afterwards, blocks seen twice are skipped and chain changes applied again
+# leave the state as it was.
+
+
+## Helpers
+class BlockIngest(object):
+    def __init__(self, checkpoint, state, index=None, rollups=None):
+        self.state = state
+        self.index = index
+        self.rollups = rollups
+        self.low_hash = checkpoint["lowHash"]
+        self.vspc_low_hash = checkpoint["vspcStartHash"]
+        self.last_chain_block = checkpoint["lastChainBlock"]
+        self.recent = RecentHashes(checkpoint["tailHashes"])
+        self.checkpoint = checkpoint
+        self.store = BlockStoreWriter(
+            BLOCKS_FILE, truncate_at=checkpoint["storeSize"], state=state
+        )
+        self.last_timestamp = None
+        self.unsaved = 0
+
+    def add_block(self, block):
+        hash = block.verboseData.hash
+        if hash in self.recent:
+            return False
+
+        # Keep 1 level of parents for memory/storage purposes
+        del block.header.parents[1:]
+        self.store.append(block)
+        self.recent.add(hash)
+        if self.index is not None:
+            self.index.add_blocks([block])
+
+        self.low_hash = hash
+        self.last_timestamp = block.header.timestamp
+        self.unsaved += 1
+        return True
+
+    # Applies a getVirtualChainFromBlock response or a virtual chain changed
+    # notification, both carry the same fields
+    def apply_chain_changes(self, vspc):
+        last_applied, _ = apply_vspc(vspc, self.state, None, self.index, self.rollups)
+        if vspc.addedChainBlockHashes:
+            self.last_chain_block = vspc.addedChainBlockHashes[-1]
+        if last_applied is not None:
+            self.vspc_low_hash = last_applied
+        self.unsaved += 1
+        return last_applied
+
+    # Fetch everything added to the DAG since the checkpoint
+    async def backfill(self, rpc_client):
+        blocks = 0
+        while True:
+            page = await get_blocks(rpc_client, self.low_hash)
+            new_blocks = sum(self.add_block(block) for block in page.blocks)
+            if not new_blocks:
+                break
+            blocks += new_blocks
+
+        while True:
+            vspc = await get_vspc(rpc_client, self.vspc_low_hash)
+            if self.apply_chain_changes(vspc) is None:
+                break
+
+        print(f"Backfilled {blocks} blocks")
+
+    # Writes only what changed since the last save: the store is appended to,
+    # the block state, index and rollups commit their open transactions and
+    # the checkpoint, which is of bounded size, is replaced if it moved
+    def save(self):
+        if not self.unsaved:
+            return
+
+        self.store.flush()
+        # Hours marked by chain changes are saved before the state
+        if self.rollups is not None:
+            self.rollups.commit()
+        self.state.commit(self.store.tell())
+        if self.index is not None:
+            self.index.commit()
+
+        checkpoint = {
+            "storeSize": self.store.tell(),
+            "lowHash": self.low_hash,
+            "vspcStartHash": self.vspc_low_hash,
+            "lastChainBlock": self.last_chain_block,
+            "tailHashes": list(self.recent.queue),
+        }
+        if checkpoint != self.checkpoint:
+            save_checkpoint(checkpoint)
+            self.checkpoint = checkpoint
+        self.unsaved = 0
+
+        if self.last_timestamp is not None:
+            print(self.low_hash, datetime.fromtimestamp(self.last_timestamp / 1000))
+
+    # Recomputes the rollups of the hours changed since the last update, from
+    # the blocks saved so far
+    def update_rollups(self):
+        if self.rollups is None:
+            return
+
+        self.save()
+        blocks, hours = self.rollups.update(
+            BLOCKS_FILE, self.state, end=self.store.tell()
+        )
+        if hours:
+            print(f"Rollups: {blocks} blocks added, {hours} hours updated")
+
+    def close(self):
+        self.save()
+        self.update_rollups()
+        self.store.close()
+        self.state.close()
+        if self.index is not None:
+            self.index.close()
+        if self.rollups is not None:
+            self.rollups.close()
+
+
+async def subscribe(rpc_client, command, params, queue):
+    async def on_message(resp):
+        queue.put_nowait(resp)
+
+    await rpc_client.notify(command, params, on_message, raw=True)
+    # notify() only returns when the node closed the stream
+    raise SpectredCommunicationError(f"{command} stream closed by the node")
+
+
+# One connection: subscribe, backfill, then apply notifications as they come
+async def run_connection(ingest, args):
+    queue = asyncio.Queue()
+    async with SpectredClient(*args.node.split(":"), streaming=True) as rpc_client:
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(
+                subscribe(rpc_client, "notifyBlockAddedRequest", None, queue)
+            )
+            tg.create_task(
+                subscribe(
+                    rpc_client,
+                    "notifyVirtualChainChangedRequest",
+                    {"includeAcceptedTransactionIds": True},
+                    queue,
+                )
+            )
+
+            # Backfill once both subscriptions are confirmed, notifications
+            # arriving before that are kept for later
+            pending = deque()
+            subscribed = 0
+            while subscribed < 2:
+                resp = await queue.get()
+                kind = resp.WhichOneof("payload")
+                if kind.startswith("notify"):
+                    error = getattr(resp, kind).error.message
+                    if error:
+                        raise RuntimeError(f"{kind}: {error}")
+                    subscribed += 1
+                else:
+                    pending.append(resp)
+
+            await ingest.backfill(rpc_client)
+            ingest.save()
+
+            ingest.update_rollups()
+
+            last_save = last_rollup = time.monotonic()
+            while True:
+                if pending:
+                    resp = pending.popleft()
+                else:
+                    try:
+                        resp = await asyncio.wait_for(queue.get(), args.save_interval)
+                    except asyncio.TimeoutError:
+                        resp = None
+
+                if resp is not None:
+                    kind = resp.WhichOneof("payload")
+                    if kind == "blockAddedNotification":
+                        ingest.add_block(resp.blockAddedNotification.block)
+                    elif kind == "virtualChainChangedNotification":
+                        ingest.apply_chain_changes(resp.virtualChainChangedNotification)
+
+                if time.monotonic() - last_save >= args.save_interval:
+                    ingest.save()
+                    last_save = time.monotonic()
+
+                if time.monotonic() - last_rollup >= args.rollup_interval:
+                    ingest.update_rollups()
+                    last_rollup = time.monotonic()
+
+
+## Main
+async def main(args):
+    checkpoint = load_checkpoint()
+    if checkpoint is None:
+        print("No checkpoint found, crawl the blocks with save_blocks.py first")
+        return
+    if "anchors" in checkpoint:
+        print("The last crawl was interrupted, finish it with save_blocks.py first")
+        return
+
+    # Keep the block index and the rollups in step with the store if they exist
+    state = open_block_state()
+    index = BlockIndex(state=state) if os.path.exists(INDEX_FILE) else None
+    rollups = Rollups() if os.path.exists(ROLLUPS_FILE) else None
+    block_ingest = BlockIngest(checkpoint, state, index, rollups)
+
+    try:
+        while True:
+            try:
+                await run_connection(block_ingest, args)
+            except* SpectredCommunicationError as e:
+                print(f"Connection lost: {e.exceptions[0]}")
+
+            # Keep what arrived so far, the next connection backfills the gap
+            block_ingest.save()
+            print(f"Reconnecting in {args.reconnect_delay}s")
+            await asyncio.sleep(args.reconnect_delay)
+    finally:
+        block_ingest.close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Write new blocks and chain changes to the block store as "
+        "the node announces them."
+    )
+    parser.add_argument(
+        "--node",
+        default="localhost:18110",
+        help="host:port of the node to ingest from, best the one the store was "
+        "crawled from (default: localhost:18110)",
+    )
+    parser.add_argument(
+        "--save-interval",
+        type=float,
+        default=5,
+        help="seconds between commits of the blocks and chain changes received "
+        "(default: 5)",
+    )
+    parser.add_argument(
+        "--rollup-interval",
+        type=float,
+        default=60,
+        help="seconds between updates of the rollups, if there are any (default: 60)",
+    )
+    parser.add_argument(
+        "--reconnect-delay",
+        type=float,
+        default=5,
+        help="seconds to wait before reconnecting to the node (default: 5)",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main(parse_args()))
+    except KeyboardInterrupt:
+        pass
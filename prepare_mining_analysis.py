@@ -1,38 +1,60 @@
 import json
-from helper.mining_address import retrieve_miner_info_from_payload
+import os
 
-# Input and output file paths
-blocks_file = r"data\block.json"
+from helper.block_store import find_blocks_file, iter_blocks
+from helper.mining_address import decode_payloads
+from helper.sharding import map_shards
+
+# Read ranges of the store in this many processes
+WORKERS = os.cpu_count() or 1
+
+# Output file path, the input is the block store
 output_file = r"data\mining_analysis.json"
 
 # prepares data from blocks.json
 
-mining_data = []
-
-# Load the blocks.json file
-with open(blocks_file, "r") as f:
-    blocks_data = json.load(f)["blocks"]
-
-# Iterate through each block and extract required information
-for block_hash, block_data in blocks_data.items():
-    try:
-        difficulty = block_data["verboseData"].get("difficulty", 0)
-        bits = block_data["header"].get("bits", 0)
-        payload = (
-            block_data["transactions"][0].get("payload", "")
-            if block_data.get("transactions")
-            else ""
-        )
-        block_time = (
-            block_data["transactions"][0]["verboseData"].get("blockTime", 0)
-            if block_data.get("transactions")
-            else 0
-        )
-        timestamp = block_data["header"].get("timestamp", 0)
 
-        # Decode payload
-        decoded_info, decoded_address = retrieve_miner_info_from_payload(payload)
+## Helpers
+# Mining data of the blocks in one shard of the store (see helper.sharding)
+def collect_mining_data(shard, blocks_file):
+    start, end = shard
+    blocks = []
+    payloads = []
+
+    # Iterate through each block and extract required information, reading the
+    # stored RpcBlock messages directly
+    for block_hash, block_data in iter_blocks(
+        blocks_file, raw=True, start=start, end=end
+    ):
+        try:
+            difficulty = block_data.verboseData.difficulty
+            bits = block_data.header.bits
+            payload = (
+                block_data.transactions[0].payload if block_data.transactions else ""
+            )
+            block_time = (
+                block_data.transactions[0].verboseData.blockTime
+                if block_data.transactions
+                else 0
+            )
+
+            blocks.append((block_hash, difficulty, bits, payload, block_time))
+            payloads.append(payload)
+        except Exception as e:
+            print(f"Error processing block {block_hash}: {e}")
 
+    def payload_error(i, e):
+        print(f"Error processing block {blocks[i][0]}: {e}")
+
+    # Decode payloads, most blocks share the script of a few miners
+    mining_data = []
+    for (block_hash, difficulty, bits, payload, block_time), decoded in zip(
+        blocks, decode_payloads(payloads, on_error=payload_error)
+    ):
+        if decoded is None:
+            continue
+
+        decoded_info, decoded_address = decoded
         mining_data.append(
             {
                 "blockhash": block_hash,
@@ -44,10 +66,21 @@ for block_hash, block_data in blocks_data.items():
                 "blocktime": block_time,
             }
         )
-    except Exception as e:
-        print(f"Error processing block {block_hash}: {e}")
 
-with open(output_file, "w") as f:
-    json.dump(mining_data, f, indent=4)
+    return mining_data
+
+
+## Main
+if __name__ == "__main__":
+    blocks_file = find_blocks_file()  # or the data/block.json dump of old crawls
+
+    mining_data = []
+    for shard_mining_data in map_shards(
+        collect_mining_data, blocks_file, WORKERS, blocks_file
+    ):
+        mining_data.extend(shard_mining_data)
+
+    with open(output_file, "w") as f:
+        json.dump(mining_data, f, indent=4)
 
-print(f"Successfully written to {output_file}")
+    print(f"Successfully written to {output_file}")
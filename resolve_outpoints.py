@@ -0,0 +1,191 @@
+from collections import defaultdict
+import argparse
+import asyncio
+import os
+import sys
+
+from helper.block_stats import COINBASE_SUBNETWORK_ID
+from helper.block_store import (
+    block_view,
+    find_blocks_file,
+    iter_accepted_blocks,
+    iter_records,
+)
+from helper.crawl import get_block
+from helper.outpoint_index import (
+    RESOLVED_OUTPOINTS_FILE,
+    OutpointIndex,
+    OutpointIndexWriter,
+)
+from helper.spent_outputs import load_spent_outputs
+from spectred.SpectredClient import SpectredClient
+from spectred.rpc_pb2 import RpcBlock
+
+# Resolves the previous outpoints of accepted transactions that spend outputs
+# created before the block store, so that block_tx_analysis.py does not have
+# to skip them. The node has no transaction lookup, but every such output was
+# created in a block in the past of the first stored block: the selected chain
+# is walked back from there and the mergesets of its chain blocks are fetched
+# with getBlock, concurrently, until all missing transactions are found. Found
+# outputs are kept in data/outpoints.resolved.idx and never fetched again.
+#
+# The store starts at the pruning point of the crawl, so the walk needs the
+# bodies of blocks before the pruning point. Only archival nodes keep them,
+# other nodes prune them and the walk stops at the first pruned block.
+
+
+## Helpers
+# {tx_id: {output indexes}} of outpoints spent by accepted transactions in the
+# store that no local source can resolve
+def find_missing_outpoints(blocks_file):
+    get_spent_output = load_spent_outputs()
+
+    missing = defaultdict(set)
+    for _, block, accepted in iter_accepted_blocks(blocks_file):
+        for tx in block.transactions:
+            if tx.subnetworkId == COINBASE_SUBNETWORK_ID:
+                continue
+            if tx.verboseData.transactionId not in accepted:
+                continue
+
+            for input in tx.inputs:
+                outpoint = input.previousOutpoint
+                if get_spent_output(outpoint.transactionId, outpoint.index) is None:
+                    missing[outpoint.transactionId].add(outpoint.index)
+
+    return missing
+
+
+def first_stored_block(blocks_file):
+    block = next(iter_records(blocks_file), None)
+    if block is not None and not isinstance(block, RpcBlock):
+        block = block_view(block)
+    return block
+
+
+## Main
+async def main(args):
+    blocks_file = find_blocks_file()  # or the data/block.json dump of old crawls
+    if not os.path.exists(blocks_file):
+        sys.exit(f"No block store at {blocks_file}, crawl one with save_blocks.py")
+
+    missing = find_missing_outpoints(blocks_file)
+    print(f"Unresolved outpoints: {sum(len(i) for i in missing.values())}")
+
+    start = first_stored_block(blocks_file)
+    if not missing or start is None:
+        return
+
+    # Keep previously resolved outputs, the index is rewritten as a whole
+    resolved = OutpointIndexWriter()
+    if os.path.exists(RESOLVED_OUTPOINTS_FILE):
+        with OutpointIndex(RESOLVED_OUTPOINTS_FILE) as cache:
+            for output in cache:
+                resolved.add(*output)
+
+    def scan(block):
+        for tx in block.transactions:
+            indexes = missing.pop(tx.verboseData.transactionId, None)
+            if indexes is None:
+                continue
+
+            for index in indexes:
+                if index < len(tx.outputs):
+                    output = tx.outputs[index]
+                    address = output.verboseData.scriptPublicKeyAddress
+                    resolved.add(
+                        tx.verboseData.transactionId, index, output.amount, address
+                    )
+
+    limit = asyncio.Semaphore(args.concurrency)
+
+    async def fetch(hash):
+        async with limit:
+            return await get_block(rpc_client, hash)
+
+    async with SpectredClient(*args.node.split(":"), streaming=True) as rpc_client:
+        block = start
+        seen = {start.verboseData.hash}
+        chain_blocks = 0
+        unavailable = 0
+        while missing and chain_blocks < args.max_chain_blocks:
+            # Fetch the blocks merged by this chain block
+            merged = [
+                hash
+                for hash in [
+                    *block.verboseData.mergeSetBluesHashes,
+                    *block.verboseData.mergeSetRedsHashes,
+                ]
+                if hash not in seen
+            ]
+            fetched = {}
+            for hash, r in zip(
+                merged, await asyncio.gather(*(fetch(hash) for hash in merged))
+            ):
+                seen.add(hash)
+                if r.error.message:
+                    unavailable += 1
+                else:
+                    scan(r.block)
+                    fetched[hash] = r.block
+
+            # Continue with the selected parent
+            parent_hash = block.verboseData.selectedParentHash
+            if not parent_hash:
+                break
+            if parent_hash in fetched:
+                block = fetched[parent_hash]
+            else:
+                r = await fetch(parent_hash)
+                if r.error.message:
+                    print(f"Stopping at {parent_hash}: {r.error.message}")
+                    unavailable += 1
+                    break
+                block = r.block
+                if parent_hash not in seen:
+                    seen.add(parent_hash)
+                    scan(block)
+
+            chain_blocks += 1
+            if chain_blocks % 100 == 0:
+                print(f"Walked {chain_blocks} chain blocks, {len(missing)} txs left")
+
+    print(f"Walked {chain_blocks} chain blocks, fetched {len(seen) - 1} blocks")
+    if missing:
+        print(f"Transactions not found: {len(missing)}")
+    if missing and unavailable:
+        print(
+            f"The node could not return {unavailable} blocks. Blocks before the "
+            "pruning point are only kept by archival nodes, use one with --node."
+        )
+
+    count = resolved.save(RESOLVED_OUTPOINTS_FILE)
+    print(f"Successfully written {count} outputs to {RESOLVED_OUTPOINTS_FILE}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Fetch outputs spent in the block store but created before it."
+    )
+    parser.add_argument(
+        "--node",
+        default="localhost:18110",
+        help="host:port of the node to fetch blocks from, an archival node "
+        "(default: localhost:18110)",
+    )
+    parser.add_argument(
+        "--max-chain-blocks",
+        type=int,
+        default=10_000,
+        help="how far to walk the selected chain back (default: 10000)",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=8,
+        help="max getBlock requests in flight (default: 8)",
+    )
+    return parser.parse_args()
+
+
+asyncio.run(main(parse_args()))
@@ -1,146 +1,468 @@
-from collections import defaultdict, OrderedDict
+from contextlib import AsyncExitStack
 from datetime import datetime
-import json
+import argparse
+import glob
 import os
 import asyncio
+from helper.block_index import INDEX_FILE, BlockIndex, index_store
+from helper.block_store import (
+    BLOCKS_FILE,
+    BlockStoreWriter,
+    iter_records,
+    open_block_state,
+)
+from helper.crawl import (
+    RecentHashes,
+    apply_vspc,
+    get_block,
+    get_blocks,
+    get_selected_tip,
+    get_vspc,
+    load_checkpoint,
+    save_checkpoint,
+)
+from helper.rollups import ROLLUPS_FILE, Rollups
 from spectred.SpectredClient import SpectredClient
+from spectred.SpectredMetrics import SpectredMetrics
 
 # https://github.com/spectre-project/spectre-db-filler
 
 
 ## Helpers
-async def get_blocks(rpc_client, low_hash):
-    print(f"Requesting blocks with lowHash: {low_hash}")
-    r = await rpc_client.request(
-        "getBlocksRequest",
-        params={
-            "lowHash": low_hash,
-            "includeTransactions": True,
-            "includeBlocks": True,
-        },
-    )
-    return r["getBlocksResponse"]
-
-
-async def get_vspc(rpc_client, low_hash):
+async def get_chain_anchors(rpc_client, low_hash, segments):
+    # Walk the selected chain without acceptance data, which is cheap, and
+    # pick evenly spaced chain blocks to split the crawl at
     r = await rpc_client.request(
         "getVirtualChainFromBlockRequest",
         params={
             "startHash": low_hash,
-            "includeAcceptedTransactionIds": True,
+            "includeAcceptedTransactionIds": False,
         },
-        timeout=60 * 60 * 1,  # seconds * minutes * hours
+        timeout=60 * 10,
+        raw=True,
     )
-    return r["getVirtualChainFromBlockResponse"]
+    chain = [low_hash] + list(r.getVirtualChainFromBlockResponse.addedChainBlockHashes)
+    step = max(1, -(-len(chain) // segments))
+    return chain[::step]
 
 
 async def get_dag_info(rpc_client):
-    r = await rpc_client.request("getBlockDagInfoRequest")
-    return r["getBlockDagInfoResponse"]
+    r = await rpc_client.request("getBlockDagInfoRequest", raw=True)
+    return r.getBlockDagInfoResponse
+
+
+def part_file(i):
+    root, ext = os.path.splitext(BLOCKS_FILE)
+    return f"{root}.part{i}{ext}"
+
+
+# Fetch blocks in DAG order from anchor until stop_hash (exclusive) or, if no
+# stop_hash is given, until the DAG tip (inclusive), appending every page to
+# the segment's part file. An interrupted segment continues after the last
+# block in its part file. Returns whether stop_hash was reached.
+async def get_segment(rpc_client, anchor, stop_hash, limit, path):
+    low_hash = anchor
+    recent = RecentHashes()
+    for block in iter_records(path):
+        low_hash = block.verboseData.hash
+        recent.add(low_hash)
+
+    with BlockStoreWriter(path) as part:
+        while True:
+            async with limit:
+                blocks = await get_blocks(rpc_client, low_hash)
+            # Fetch the sink once per page and test it against the page's
+            # blocks instead of asking the node again for every block
+            selected_tip = await get_selected_tip(rpc_client)
 
+            new_blocks = 0
+            done = reached = False
+            for block in blocks.blocks:
+                hash = block.verboseData.hash
+
+                if hash == stop_hash:
+                    done = reached = True
+                    break
+
+                if hash not in recent:
+                    # Keep 1 level of parents for memory/storage purposes
+                    del block.header.parents[1:]
+                    part.append(block)
+                    recent.add(hash)
+                    new_blocks += 1
+
+                # Stop once we get to DAG tip
+                if selected_tip == hash:
+                    done = True
+                    break
+
+                low_hash = hash
+
+            part.flush()
+
+            # Stop if the page did not advance, nothing left to fetch
+            if done or not new_blocks:
+                return reached
+
+
+def node_name(rpc_client):
+    return f"{rpc_client.spectred_host}:{rpc_client.spectred_port}"
+
+
+# Pick the node that crawls each segment, the nodes take turns. The last
+# segment ends at the DAG tip and is crawled from the first node, which also
+# serves the virtual chain. Other nodes must have the same pruning point as the
+# first node and the segment's anchor on their selected chain, otherwise the
+# segment is crawled from the first node.
+async def assign_segments(rpc_clients, anchors):
+    primary = rpc_clients[0]
+    pruning_point = (await get_dag_info(primary)).pruningPointHash
+
+    nodes = [primary]
+    for rpc_client in rpc_clients[1:]:
+        dag_info = await get_dag_info(rpc_client)
+        if dag_info.pruningPointHash != pruning_point:
+            print(
+                f"Warning: Skipping {node_name(rpc_client)}, its pruning point "
+                f"{dag_info.pruningPointHash} differs from {pruning_point}"
+            )
+            continue
+        nodes.append(rpc_client)
+
+    assigned = []
+    for i, anchor in enumerate(anchors):
+        rpc_client = nodes[(len(anchors) - 1 - i) % len(nodes)]
+        if rpc_client is not primary:
+            r = await get_block(rpc_client, anchor, include_transactions=False)
+            if r.error.message or not r.block.verboseData.isChainBlock:
+                print(
+                    f"Warning: {anchor} is not a chain block on "
+                    f"{node_name(rpc_client)}, crawling segment {i} from "
+                    f"{node_name(primary)}"
+                )
+                rpc_client = primary
+        assigned.append(rpc_client)
+    return assigned
+
+
+# Hashes of the given blocks that are already in the store
+def find_stored_blocks(hashes, index=None):
+    if index is not None:
+        return {hash for hash in hashes if index.has_block(hash)}
+
+    found = set()
+    for block in iter_records(BLOCKS_FILE):
+        if block.verboseData.hash in hashes:
+            found.add(block.verboseData.hash)
+            if len(found) == len(hashes):
+                break
+    return found
 
-async def get_selected_tip(rpc_client):
-    r = await rpc_client.request("GetSinkRequest")
-    return r["GetSinkResponse"]["sink"]
 
+# Fetch blocks that getBlocks did not return and append them to the store
+async def add_missing_blocks(rpc_client, hashes, limit, store_size, state, index=None):
+    async def fetch(hash):
+        async with limit:
+            return hash, await get_block(rpc_client, hash)
 
-## Main
-async def main():
-    rpc_client = SpectredClient("localhost", 18110)
+    blocks = []
+    with BlockStoreWriter(BLOCKS_FILE, truncate_at=store_size, state=state) as f:
+        for hash, r in await asyncio.gather(*(fetch(hash) for hash in hashes)):
+            if r.error.message:
+                print(f"Warning: Merged block {hash} not available: {r.error.message}")
+                continue
 
-    # Get pruning point hash
-    dag_info = await get_dag_info(rpc_client)
-    low_hash = dag_info["pruningPointHash"]
+            del r.block.header.parents[1:]
+            f.append(r.block)
+            blocks.append(r.block)
 
-    # Load blocks from pruning point hash to tip
-    block_cache = OrderedDict()
-    tx_to_blocks_index = defaultdict(list)
+        store_size = f.tell()
 
-    while True:
-        blocks = await get_blocks(rpc_client, low_hash)
+    if index is not None:
+        index.add_blocks(blocks)
 
-        for idx, block in enumerate(blocks.get("blocks", [])):
-            hash = block["verboseData"]["hash"]
+    print(f"Fetched {len(blocks)} merged blocks missing from the crawl")
+    return store_size
 
-            # Keep 1 level of parents for memory/storage purposes
-            block["header"]["parents"] = block["header"]["parents"][0]["parentHashes"]
-            # Add block to cache
-            block_cache[hash] = block
 
-            # Store tx to blocks mapping
-            for tx in block["transactions"]:
-                tx_id = tx["verboseData"]["transactionId"]
-                tx_to_blocks_index[tx_id].append(hash)
+def remove_part_files():
+    root, ext = os.path.splitext(BLOCKS_FILE)
+    for path in glob.glob(f"{root}.part*{ext}"):
+        os.remove(path)
 
-            # Break once we get to DAG tip
-            selected_tip = await get_selected_tip(rpc_client)
-            if selected_tip == hash:
+
+## Main
+async def main(args):
+    checkpoint = None if args.fresh else load_checkpoint()
+    state = open_block_state()
+    if checkpoint is None:
+        state.reset()
+
+    # Keep the block index in step with the store once it exists. An index
+    # requested for a store that was crawled without one is built after the
+    # crawl, from the whole store.
+    index = None
+    build_index = False
+    if args.index or os.path.exists(INDEX_FILE):
+        if checkpoint is None and os.path.exists(INDEX_FILE):
+            os.remove(INDEX_FILE)
+        if checkpoint is None or os.path.exists(INDEX_FILE):
+            index = BlockIndex(state=state)
+        else:
+            build_index = True
+
+    # Keep the rollups (update_rollups.py) current once they exist
+    rollups = Rollups() if os.path.exists(ROLLUPS_FILE) else None
+    if rollups is not None and checkpoint is None:
+        rollups.reset()
+
+    metrics = SpectredMetrics() if args.metrics else None
+    async with AsyncExitStack() as stack:
+        rpc_clients = [
+            await stack.enter_async_context(
+                SpectredClient(
+                    *node.split(":"), streaming=True, hooks=[metrics] if metrics else ()
+                )
+            )
+            for node in args.nodes.split(",")
+        ]
+        # The first node is the reference for the pruning point, the segment
+        # anchors and the virtual chain
+        rpc_client = rpc_clients[0]
+
+        if checkpoint is None:
+            # Get pruning point hash
+            dag_info = await get_dag_info(rpc_client)
+            low_hash = dag_info.pruningPointHash
+            checkpoint = {
+                "storeSize": 0,
+                "lowHash": low_hash,
+                "vspcStartHash": low_hash,
+                "lastChainBlock": None,
+                "tailHashes": [],
+            }
+
+        # Start a new crawl unless the checkpoint is of an interrupted one
+        if "anchors" not in checkpoint:
+            low_hash = checkpoint["lowHash"]
+            segments = args.segments or len(rpc_clients)
+            if segments > 1:
+                anchors = await get_chain_anchors(rpc_client, low_hash, segments)
+            else:
+                anchors = [low_hash]
+
+            remove_part_files()
+            checkpoint["anchors"] = anchors
+            checkpoint["done"] = []
+            save_checkpoint(checkpoint)
+
+        anchors = checkpoint["anchors"]
+
+        segment_clients = await assign_segments(rpc_clients, anchors)
+        limits = {c: asyncio.Semaphore(args.concurrency) for c in rpc_clients}
+
+        async def crawl_segment(i, stop_hash):
+            segment_client = segment_clients[i]
+            while True:
+                reached = await get_segment(
+                    segment_client,
+                    anchors[i],
+                    stop_hash,
+                    limits[segment_client],
+                    part_file(i),
+                )
+                # Segments only fit together if every one ends at the next
+                # anchor, otherwise crawl the segment again from the first node
+                if stop_hash is None or reached:
+                    break
+                os.remove(part_file(i))
+                if segment_client is rpc_client:
+                    raise RuntimeError(
+                        f"Segment {i} from {node_name(rpc_client)} ended before "
+                        f"the next anchor {stop_hash}"
+                    )
+                print(
+                    f"Warning: Segment {i} from {node_name(segment_client)} ended "
+                    f"before the next anchor {stop_hash}, crawling it from "
+                    f"{node_name(rpc_client)}"
+                )
+                segment_client = segment_clients[i] = rpc_client
+
+            checkpoint["done"].append(i)
+            save_checkpoint(checkpoint)
+
+        # Load blocks from the last checkpoint (or pruning point) to tip
+        limit = limits[rpc_client]
+        async with asyncio.TaskGroup() as tg:
+            for i, stop_hash in enumerate(anchors[1:] + [None]):
+                if i not in checkpoint["done"]:
+                    tg.create_task(crawl_segment(i, stop_hash))
+
+        # Append segments to the store in DAG order, blocks in the anticone of
+        # an anchor or of the previous run's tip can show up twice
+        last_cache_block = checkpoint["lowHash"]
+        last_chain_block = checkpoint["lastChainBlock"]
+        last_timestamp = None
+        recent = RecentHashes(checkpoint["tailHashes"])
+        unknown_merged_blocks = {}
+        index_batch = []
+        with BlockStoreWriter(
+            BLOCKS_FILE, truncate_at=checkpoint["storeSize"], state=state
+        ) as f:
+            for i in range(len(anchors)):
+                for block in iter_records(part_file(i)):
+                    hash = block.verboseData.hash
+                    if hash in recent:
+                        continue
+
+                    f.append(block)
+                    recent.add(hash)
+                    if index is not None:
+                        index_batch.append(block)
+                        if len(index_batch) == 1000:
+                            index.add_blocks(index_batch)
+                            index_batch = []
+                    last_cache_block = hash
+                    if block.verboseData.isChainBlock:
+                        last_chain_block = hash
+
+                        # Merged blocks that were not crawled just before
+                        # the chain block, their transactions can be
+                        # accepted by it without being in the store
+                        merged = [
+                            merged_hash
+                            for merged_hash in [
+                                *block.verboseData.mergeSetBluesHashes,
+                                *block.verboseData.mergeSetRedsHashes,
+                            ]
+                            if merged_hash not in recent
+                        ]
+                        if merged:
+                            unknown_merged_blocks[hash] = merged
+
+                    # Keep an eye on progress
+                    last_timestamp = block.header.timestamp
+
+            store_size = f.tell()
+
+        if index is not None:
+            index.add_blocks(index_batch)
+
+        if last_timestamp is not None:
+            os.system(
+                "cls" if os.name == "nt" else "clear"
+            )  # Clear console output (Windows: 'cls', others: 'clear')
+            print(last_cache_block, datetime.fromtimestamp(last_timestamp / 1000))
+
+        # Apply virtual selected parent chain to the block state, starting at
+        # the last chain block applied by the previous run. The node sends the
+        # chain in chunks, each one is applied as it arrives and the next
+        # request continues after the last chain block applied.
+        vspc_low_hash = checkpoint["vspcStartHash"]
+        candidates = set()
+        while True:
+            vspc = await get_vspc(rpc_client, vspc_low_hash)
+
+            # Every transaction accepted by a chain block comes from its
+            # mergeset, so merged blocks that were not crawled may be needed
+            for d in vspc.acceptedTransactionIds:
+                candidates.update(unknown_merged_blocks.get(d.acceptingBlockHash, ()))
+
+            last_applied, done = apply_vspc(
+                vspc, state, last_chain_block, index, rollups
+            )
+            if last_applied is None:
+                break
+            vspc_low_hash = last_applied
+            if done:
                 break
 
-            low_hash = hash
-
-        last_cache_block = next(reversed(block_cache))
-        selected_tip = await get_selected_tip(rpc_client)
-        if selected_tip == last_cache_block:
-            break
-
-    # Keep an eye on progress
-    os.system(
-        "cls" if os.name == "nt" else "clear"
-    )  # Clear console output (Windows: 'cls', others: 'clear')
-    print(
-        last_cache_block,
-        datetime.fromtimestamp(
-            int(block_cache[last_cache_block]["header"]["timestamp"]) / 1000
-        ),
+        # Fetch the merged blocks that are not in the store (e.g. left out by
+        # getBlocks near the pruning point) to resolve all accepted transactions
+        if candidates:
+            missing = candidates - find_stored_blocks(candidates, index)
+            if missing:
+                store_size = await add_missing_blocks(
+                    rpc_client, missing, limit, store_size, state, index
+                )
+
+    # Hours marked by the chain changes are saved before the state
+    if rollups is not None:
+        rollups.commit()
+    state.commit(store_size)
+
+    if index is not None:
+        index.close()
+    elif build_index:
+        index_store()
+
+    # Next run only fetches blocks and chain changes after this point
+    save_checkpoint(
+        {
+            "storeSize": store_size,
+            "lowHash": last_cache_block,
+            "vspcStartHash": vspc_low_hash,
+            "lastChainBlock": last_chain_block,
+            "tailHashes": list(recent.queue),
+        }
     )
+    remove_part_files()
 
-    # Apply virtual selected parent chain to block_cache
-    vspc_low_hash = next(iter(block_cache))
-    vspc = await get_vspc(rpc_client, vspc_low_hash)
-
-    # Block hash to stop VSPC iteration at to ensure accuracy
-    vspc_stop_hash = None
-    for k, v in reversed(block_cache.items()):
-        if v["verboseData"]["isChainBlock"]:
-            vspc_stop_hash = k
-            break
-
-    # Set isChainBlock to False for removed blocks
-    for hash in vspc.get("removedChainBlockHashes", []):
-        block_cache[hash]["verboseData"]["isChainBlock"] = False
-
-    # Set isChainBlock to True for added blocks
-    for hash in vspc.get("addedChainBlockHashes", []):
-        if hash == vspc_stop_hash:
-            break
-        block_cache[hash]["verboseData"]["isChainBlock"] = True
-
-    # Set accepted to True for accepted transactions
-    tx_in_blocks_none = 0
-    for d in vspc.get("acceptedTransactionIds", []):
-        if d["acceptingBlockHash"] == vspc_stop_hash:
-            break
-
-        for accepted_tx_id in d["acceptedTransactionIds"]:
-            tx_in_blocks = tx_to_blocks_index.get(accepted_tx_id)
-
-            if tx_in_blocks is None:
-                # TODO: Handle this case
-                tx_in_blocks_none += 1
-                continue
+    if rollups is not None:
+        blocks, hours = rollups.update(BLOCKS_FILE, state, end=store_size)
+        rollups.close()
+        print(f"Rollups: {blocks} blocks added, {hours} hours updated")
+    state.close()
 
-            for block_hash in tx_in_blocks:
-                for i, tx in enumerate(block_cache[block_hash]["transactions"]):
-                    if tx["verboseData"]["transactionId"] == accepted_tx_id:
-                        tx["accepted"] = True
-                        tx["acceptingBlockHash"] = d["acceptingBlockHash"]
+    if metrics is not None:
+        print(metrics.summary())
+        metrics.write_prometheus(args.metrics)
 
-    # Dump to JSON
-    with open("./data/block.json", "w") as f:
-        json.dump({"blocks": block_cache}, f, indent=4)
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Save all blocks from the pruning point to the DAG tip."
+    )
+    parser.add_argument(
+        "--fresh",
+        action="store_true",
+        help="ignore the checkpoint and crawl again from the pruning point",
+    )
+    parser.add_argument(
+        "--nodes",
+        default="localhost:18110",
+        help="comma separated host:port list of the nodes to crawl from, the "
+        "segments are spread over them (default: localhost:18110)",
+    )
+    parser.add_argument(
+        "--segments",
+        type=int,
+        default=None,
+        help="split the crawl at evenly spaced chain blocks and fetch the "
+        "segments in parallel (default: one per node, a sequential crawl with "
+        "one node)",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=4,
+        help="max getBlocks requests in flight per node (default: 4)",
+    )
+    parser.add_argument(
+        "--index",
+        action="store_true",
+        help=f"also fill the SQLite block index ({INDEX_FILE}), which is kept "
+        "up to date by every later run",
+    )
+    parser.add_argument(
+        "--metrics",
+        metavar="PATH",
+        help="print request statistics at the end and write them to PATH in "
+        "the Prometheus text format",
+    )
+    return parser.parse_args()
 
 
 # Run the main function
 # Use an event loop for running the async main function
-asyncio.run(main())
+asyncio.run(main(parse_args()))
@@ -0,0 +1,68 @@
+# encoding: utf-8
+import asyncio
+import logging
+
+from spectred.SpectredThread import create_channel
+
+_logger = logging.getLogger(__name__)
+
+
+class SpectredChannelPool(object):
+    """
+    Bounded set of long-lived grpc.aio channels to one spectred node.
+
+    Channels are opened lazily and handed out round-robin; every request opens
+    its own HTTP/2 stream on the channel, so many requests can be in flight on
+    one connection. A channel that failed is dropped via `reset` and replaced
+    by a fresh one on the next `acquire`.
+    """
+
+    def __init__(self, spectred_host, spectred_port, size=4):
+        if size < 1:
+            raise ValueError("Channel pool size must be at least 1.")
+
+        self.spectred_host = spectred_host
+        self.spectred_port = spectred_port
+        self.size = size
+
+        self.__channels = [None] * size
+        self.__next = 0
+        self.opened = 0  # Channels opened so far, including replacements
+        self.__closed = False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    def acquire(self):
+        if self.__closed:
+            raise RuntimeError("Channel pool is closed.")
+
+        idx = self.__next
+        self.__next = (idx + 1) % self.size
+
+        if self.__channels[idx] is None:
+            _logger.debug(
+                f"Opening channel {idx} to {self.spectred_host}:{self.spectred_port}"
+            )
+            self.__channels[idx] = create_channel(
+                self.spectred_host, self.spectred_port
+            )
+            self.opened += 1
+
+        return self.__channels[idx]
+
+    async def reset(self, channel):
+        for idx, c in enumerate(self.__channels):
+            if c is channel:
+                _logger.debug(f"Resetting channel {idx}")
+                self.__channels[idx] = None
+                await c.close()
+
+    async def close(self):
+        self.__closed = True
+        channels = [c for c in self.__channels if c is not None]
+        self.__channels = [None] * self.size
+        await asyncio.gather(*(c.close() for c in channels))
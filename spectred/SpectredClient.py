@@ -1,7 +1,17 @@
 # encoding: utf-8
 import asyncio
+import time
 
-from spectred.SpectredThread import SpectredThread, SpectredCommunicationError
+from google.protobuf import json_format
+
+from spectred.SpectredChannelPool import SpectredChannelPool
+from spectred.SpectredMetrics import RequestEvent, node_name
+from spectred.SpectredStream import SpectredStream
+from spectred.SpectredThread import (
+    SpectredThread,
+    SpectredCommunicationError,
+    SpectredTimeoutError,
+)
 import logging
 
 _logger = logging.getLogger(__name__)
@@ -10,7 +20,9 @@ _logger = logging.getLogger(__name__)
 
 
 class SpectredClient(object):
-    def __init__(self, spectred_host, spectred_port):
+    def __init__(
+        self, spectred_host, spectred_port, pool_size=4, streaming=False, hooks=()
+    ):
         self.spectred_host = spectred_host
         self.spectred_port = spectred_port
         self.server_version = None
@@ -18,6 +30,46 @@ class SpectredClient(object):
         self.is_synced = None
         self.p2p_id = None
 
+        self.channel_pool = SpectredChannelPool(
+            spectred_host, spectred_port, size=pool_size
+        )
+
+        # In streaming mode every pooled channel keeps one MessageStream open
+        # and pipelines all requests over it.
+        self.streaming = streaming
+        self.__streams = {}
+
+        # Objects with request_started(client, command) and
+        # request_finished(client, event) methods, see SpectredMetrics
+        self.hooks = list(hooks)
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def close(self):
+        streams = list(self.__streams.values())
+        self.__streams.clear()
+        await asyncio.gather(*(s.close() for s in streams))
+        await self.channel_pool.close()
+
+    def __stream(self, channel):
+        stream = self.__streams.get(channel)
+        if stream is None or not stream.is_open:
+            stream = self.__streams[channel] = SpectredStream(channel)
+        return stream
+
+    async def __reset_channel(self, channel):
+        stream = self.__streams.pop(channel, None)
+        if stream is not None:
+            await stream.close()
+        await self.channel_pool.reset(channel)
+
     async def ping(self):
         try:
             info = await self.request("getInfoRequest")
@@ -30,27 +82,108 @@ class SpectredClient(object):
         except Exception:
             return False
 
-    async def request(self, command, params=None, timeout=60, retry=0):
+    async def request(self, command, params=None, timeout=60, retry=0, raw=False):
+        # raw=True returns the SpectredResponse message itself, skipping the
+        # conversion to a dict of (partly stringified) values
         _logger.debug(f"Request start: {command}, {params}")
+        if not self.hooks:
+            return await self.__request(command, params, timeout, retry, raw)
+
+        for hook in self.hooks:
+            hook.request_started(self, command)
+        trace = {"encode_time": 0.0, "request_bytes": 0, "response_bytes": 0}
+        stats = {"network_time": 0.0, "retry_sleep": 0.0, "retries": 0}
+        opened = self.channel_pool.opened
+        error = None
+        start = time.perf_counter()
+        try:
+            resp = await self.__request(
+                command, params, timeout, retry, True, trace, stats
+            )
+            decode_start = time.perf_counter()
+            if not raw:
+                resp = json_format.MessageToDict(resp)
+            decode_time = time.perf_counter() - decode_start
+            return resp
+        except BaseException as e:
+            error = e
+            decode_time = 0.0
+            raise
+        finally:
+            event = RequestEvent(
+                command=command,
+                node=node_name(self),
+                error=error,
+                latency=time.perf_counter() - start,
+                network_time=max(
+                    stats["network_time"] - stats["retry_sleep"] - trace["encode_time"],
+                    0.0,
+                ),
+                encode_time=trace["encode_time"],
+                decode_time=decode_time,
+                retry_sleep=stats["retry_sleep"],
+                retries=stats["retries"],
+                request_bytes=trace["request_bytes"],
+                response_bytes=trace["response_bytes"],
+                connected=self.channel_pool.opened != opened,
+            )
+            for hook in self.hooks:
+                hook.request_finished(self, event)
+
+    async def __request(
+        self, command, params, timeout, retry, raw, trace=None, stats=None
+    ):
         for i in range(1 + retry):
+            channel = self.channel_pool.acquire()
+            call_start = time.perf_counter()
             try:
-                with SpectredThread(self.spectred_host, self.spectred_port) as t:
+                if self.streaming:
+                    resp = await self.__stream(channel).request(
+                        command, params, timeout=timeout, raw=raw, trace=trace
+                    )
+                    _logger.debug("Request end")
+                    return resp
+
+                with SpectredThread(
+                    self.spectred_host, self.spectred_port, channel=channel
+                ) as t:
                     resp = await t.request(
-                        command, params, wait_for_response=True, timeout=timeout
+                        command,
+                        params,
+                        wait_for_response=True,
+                        timeout=timeout,
+                        raw=raw,
+                        trace=trace,
                     )
                     _logger.debug("Request end")
                     return resp
-            except SpectredCommunicationError:
+            except SpectredCommunicationError as e:
+                # Drop the channel so the next attempt reconnects, unless only
+                # the response was late: requests sharing the channel and its
+                # stream are still fine then
+                if not isinstance(e, SpectredTimeoutError):
+                    await self.__reset_channel(channel)
                 if i == retry:
                     _logger.debug("Retries done.")
                     raise
                 else:
                     _logger.debug("Wait for next retry.")
+                    if stats is not None:
+                        stats["retries"] += 1
+                        stats["retry_sleep"] += 0.3
                     await asyncio.sleep(0.3)
             except Exception:
                 _logger.exception("I should not be here.")
                 raise
+            finally:
+                if stats is not None:
+                    stats["network_time"] += time.perf_counter() - call_start
 
-    async def notify(self, command, params, callback):
-        t = SpectredThread(self.spectred_host, self.spectred_port, async_thread=True)
-        return await t.notify(command, params, callback)
+    async def notify(self, command, params, callback, raw=False):
+        channel = self.channel_pool.acquire()
+        t = SpectredThread(self.spectred_host, self.spectred_port, channel=channel)
+        try:
+            return await t.notify(command, params, callback, raw=raw)
+        except SpectredCommunicationError:
+            await self.__reset_channel(channel)
+            raise
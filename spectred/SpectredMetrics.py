@@ -0,0 +1,230 @@
+# encoding: utf-8
+import os
+from bisect import bisect_left
+from collections import defaultdict, namedtuple
+
+# Upper bounds in seconds, like Prometheus' "le" buckets
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+    120,
+    300,
+    600,
+)
+
+# One finished SpectredClient.request() call. Times are in seconds:
+#   latency       whole call, including retries and decoding
+#   network_time  waiting for the node (includes its processing)
+#   encode_time   building the request message
+#   decode_time   converting the response to a dict (0 for raw requests)
+#   retry_sleep   waiting between attempts
+# Bytes are the protobuf sizes of the messages, before gzip compression on the
+# channel. `connected` is set when the call had to open a channel first.
+RequestEvent = namedtuple(
+    "RequestEvent",
+    [
+        "command",
+        "node",
+        "error",
+        "latency",
+        "network_time",
+        "encode_time",
+        "decode_time",
+        "retry_sleep",
+        "retries",
+        "request_bytes",
+        "response_bytes",
+        "connected",
+    ],
+)
+
+
+class Histogram(object):
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    # Upper bound of the bucket holding the q-quantile
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class CommandMetrics(object):
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.connects = 0
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.retry_sleep = 0.0
+        self.latency = Histogram()
+        self.network_time = Histogram()
+        self.encode_time = Histogram()
+        self.decode_time = Histogram()
+
+
+class SpectredMetrics(object):
+    """
+    Request metrics hook for SpectredClient (see SpectredClient.add_hook).
+
+    Aggregates per node and command: request, error and retry counts, bytes
+    sent and received, latency histograms with network, encode and decode
+    time split out, and the number of requests in flight. `summary()` renders
+    a table, `prometheus()` the Prometheus text format.
+    """
+
+    def __init__(self):
+        self.commands = defaultdict(CommandMetrics)
+        self.in_flight = defaultdict(int)
+
+    # Hook API
+    def request_started(self, client, command):
+        self.in_flight[(node_name(client), command)] += 1
+
+    def request_finished(self, client, event):
+        self.in_flight[(event.node, event.command)] -= 1
+
+        m = self.commands[(event.node, event.command)]
+        m.requests += 1
+        m.errors += event.error is not None
+        m.retries += event.retries
+        m.connects += event.connected
+        m.request_bytes += event.request_bytes
+        m.response_bytes += event.response_bytes
+        m.retry_sleep += event.retry_sleep
+        m.latency.observe(event.latency)
+        m.network_time.observe(event.network_time)
+        m.encode_time.observe(event.encode_time)
+        m.decode_time.observe(event.decode_time)
+
+    def summary(self):
+        lines = [
+            f"{'node':<22}{'command':<38}{'requests':>9}{'errors':>7}"
+            f"{'retries':>8}{'p50':>8}{'p99':>8}{'mean':>9}{'network':>9}"
+            f"{'decode':>8}{'MB in':>9}"
+        ]
+        for (node, command), m in sorted(self.commands.items()):
+            latency = m.latency
+            lines.append(
+                f"{node:<22}{command:<38}{m.requests:>9}{m.errors:>7}"
+                f"{m.retries:>8}{latency.quantile(0.5):>8}"
+                f"{latency.quantile(0.99):>8}{latency.sum / latency.count:>9.4f}"
+                f"{share(m.network_time.sum, latency.sum):>9}"
+                f"{share(m.decode_time.sum, latency.sum):>8}"
+                f"{m.response_bytes / 1e6:>9.2f}"
+            )
+        lines.append("p50/p99 are bucket upper bounds in seconds, mean in seconds")
+        return "\n".join(lines)
+
+    def prometheus(self):
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append(f"# HELP spectred_{name} {help}")
+            lines.append(f"# TYPE spectred_{name} {kind}")
+            for labels, value in samples:
+                lines.append(f"spectred_{name}{format_labels(labels)} {value}")
+
+        def histogram(name, help, attr):
+            samples = []
+            for (node, command), m in sorted(self.commands.items()):
+                h = getattr(m, attr)
+                labels = {"node": node, "command": command}
+                seen = 0
+                for bound, count in zip(h.buckets + ("+Inf",), h.counts):
+                    seen += count
+                    samples.append(({**labels, "le": bound}, seen))
+            metric(f"{name}_seconds", "histogram", help, [])
+            for labels, value in samples:
+                lines.append(
+                    f"spectred_{name}_seconds_bucket{format_labels(labels)} {value}"
+                )
+            for (node, command), m in sorted(self.commands.items()):
+                h = getattr(m, attr)
+                labels = format_labels({"node": node, "command": command})
+                lines.append(f"spectred_{name}_seconds_sum{labels} {h.sum}")
+                lines.append(f"spectred_{name}_seconds_count{labels} {h.count}")
+
+        def counter(name, help, attr):
+            metric(
+                name,
+                "counter",
+                help,
+                [
+                    ({"node": node, "command": command}, getattr(m, attr))
+                    for (node, command), m in sorted(self.commands.items())
+                ],
+            )
+
+        counter("requests_total", "Finished requests.", "requests")
+        counter("request_errors_total", "Requests that failed.", "errors")
+        counter("request_retries_total", "Retried attempts.", "retries")
+        counter("channel_connects_total", "Requests that opened a channel.", "connects")
+        counter("sent_bytes_total", "Request bytes (protobuf).", "request_bytes")
+        counter("received_bytes_total", "Response bytes (protobuf).", "response_bytes")
+        counter(
+            "retry_sleep_seconds_total", "Time slept between retries.", "retry_sleep"
+        )
+        histogram("request_latency", "Whole request latency.", "latency")
+        histogram("request_network", "Time waiting for the node.", "network_time")
+        histogram("request_encode", "Time building the request.", "encode_time")
+        histogram("request_decode", "Time converting the response.", "decode_time")
+        metric(
+            "requests_in_flight",
+            "gauge",
+            "Requests waiting for a response.",
+            [
+                ({"node": node, "command": command}, count)
+                for (node, command), count in sorted(self.in_flight.items())
+            ],
+        )
+        return "\n".join(lines) + "\n"
+
+    # Writes the Prometheus text format, e.g. for the node exporter's textfile
+    # collector
+    def write_prometheus(self, path):
+        tmp_file = f"{path}.tmp"
+        with open(tmp_file, "w") as f:
+            f.write(self.prometheus())
+        os.replace(tmp_file, path)
+
+
+def node_name(client):
+    return f"{client.spectred_host}:{client.spectred_port}"
+
+
+def share(part, total):
+    return f"{part / total:.0%}" if total else "-"
+
+
+def format_labels(labels):
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels.items()) + "}"
@@ -1,37 +1,314 @@
 # encoding: utf-8
 import asyncio
+import logging
+import time
+from collections import defaultdict, deque
 
 from spectred.SpectredClient import SpectredClient
 
 # pipenv run python -m grpc_tools.protoc -I./protos --python_out=. --grpc_python_out=. ./protos/rpc.proto ./protos/messages.proto
 from spectred.SpectredThread import SpectredCommunicationError
 
+_logger = logging.getLogger(__name__)
+
+# Weight of the newest sample in the latency and error averages
+EWMA_ALPHA = 0.2
+# Latencies per command kept for the hedging threshold
+LATENCY_WINDOW = 200
+# Samples needed before requests are hedged
+HEDGE_MIN_SAMPLES = 20
+# Share of requests that may be hedged, so that hedging does not double the
+# load on nodes that are slow because they are busy
+HEDGE_BUDGET = 0.05
+# New latencies of a command before its p99 is computed again
+P99_REFRESH = 20
+# Read-only queries of the DAG, the UTXO set and the mempool, which may be
+# sent to a second node. Submissions are never hedged, and neither are
+# queries about the node itself, whose answers differ between nodes.
+HEDGED_COMMANDS = frozenset(
+    {
+        "getBlockRequest",
+        "getBlocksRequest",
+        "getHeadersRequest",
+        "getBlockCountRequest",
+        "getBlockDagInfoRequest",
+        "GetSinkRequest",
+        "getSinkBlueScoreRequest",
+        "getVirtualChainFromBlockRequest",
+        "getCurrentNetworkRequest",
+        "getSubnetworkRequest",
+        "getCoinSupplyRequest",
+        "getDaaScoreTimestampEstimateRequest",
+        "estimateNetworkHashesPerSecondRequest",
+        "getUtxosByAddressesRequest",
+        "getBalanceByAddressRequest",
+        "getBalancesByAddressesRequest",
+        "getMempoolEntryRequest",
+        "getMempoolEntriesRequest",
+        "getMempoolEntriesByAddressesRequest",
+        "getFeeEstimateRequest",
+        "getCurrentBlockColorRequest",
+    }
+)
+
+
+class SpectredNode(object):
+    """
+    Health of one node as seen by SpectredMultiClient.
+
+    `healthy` is set by the health checks (reachable, synced and, if required,
+    utxo-indexed) and cleared by a communication error. Latency and error rate
+    are exponentially weighted moving averages over the node's requests.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.healthy = None  # Not checked yet
+        self.outstanding = 0
+        self.latency = None
+        self.error_rate = 0.0
+
+    @property
+    def name(self):
+        return f"{self.client.spectred_host}:{self.client.spectred_port}"
+
+    def record(self, latency=None, error=False):
+        if latency is not None:
+            self.latency = (
+                latency
+                if self.latency is None
+                else (1 - EWMA_ALPHA) * self.latency + EWMA_ALPHA * latency
+            )
+        self.error_rate = (1 - EWMA_ALPHA) * self.error_rate + EWMA_ALPHA * error
+
+    def score(self):
+        # Expected wait: requests ahead of this one times the usual latency,
+        # penalized by the error rate. Nodes without samples are tried first.
+        return (
+            (self.outstanding + 1) * (self.latency or 0.0) / (1.001 - self.error_rate),
+            self.outstanding,
+        )
+
 
 class SpectredMultiClient(object):
-    def __init__(self, hosts: list[str]):
-        self.spectreds = [SpectredClient(*h.split(":")) for h in hosts]
+    """
+    Routes requests over several spectred nodes.
 
-    def __get_spectred(self):
-        for k in self.spectreds:
-            if k.is_utxo_indexed and k.is_synced:
-                return k
+    Nodes are pinged in the background every `health_interval` seconds. Each
+    request goes to the healthy node with the fewest outstanding requests,
+    weighted by its latency and error averages, and fails over to the next one
+    on a communication error. A read-only request (HEDGED_COMMANDS) still
+    running after the p99 latency of its command is hedged: sent to a second
+    node as well, the first response wins.
+    """
+
+    def __init__(
+        self,
+        hosts: list[str],
+        pool_size=4,
+        streaming=False,
+        require_utxo_index=True,
+        health_interval=30,
+        hedge=True,
+        hooks=(),
+    ):
+        self.nodes = [
+            SpectredNode(
+                SpectredClient(
+                    *h.split(":"), pool_size=pool_size, streaming=streaming, hooks=hooks
+                )
+            )
+            for h in hosts
+        ]
+        self.spectreds = [node.client for node in self.nodes]
+        self.require_utxo_index = require_utxo_index
+        self.health_interval = health_interval
+        self.hedge = hedge
+
+        self.__latencies = defaultdict(lambda: deque(maxlen=LATENCY_WINDOW))
+        self.__recorded = defaultdict(int)  # Latencies recorded per command
+        self.__p99 = {}  # command: (p99, latencies recorded when computed)
+        self.__hedge_tokens = 0.0
+        self.hedged = 0
+        self.__health_task = None
+        self.__first_check = None
+
+    async def __aenter__(self):
+        if self.health_interval:
+            self.__health_task = asyncio.create_task(self.__check_health())
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def close(self):
+        if self.__health_task is not None:
+            self.__health_task.cancel()
+            self.__health_task = None
+        await asyncio.gather(*(k.close() for k in self.spectreds))
+
+    async def __check_health(self):
+        while True:
+            await self.initialize_all()
+            await asyncio.sleep(self.health_interval)
+
+    async def __ping(self, node):
+        start = time.monotonic()
+        info = await node.client.ping()
+        # Pings keep the latency of nodes current that get no requests
+        if info:
+            node.record(time.monotonic() - start)
+        node.healthy = bool(info) and bool(node.client.is_synced)
+        if self.require_utxo_index:
+            node.healthy = node.healthy and bool(node.client.is_utxo_indexed)
+
+    def add_hook(self, hook):
+        for client in self.spectreds:
+            client.add_hook(hook)
 
     async def initialize_all(self):
-        tasks = [asyncio.create_task(k.ping()) for k in self.spectreds]
+        await asyncio.gather(*(self.__ping(node) for node in self.nodes))
+
+    # Waits for the first health check, requests started before it share it
+    async def __checked(self):
+        if all(node.healthy is None for node in self.nodes):
+            if self.__first_check is None or self.__first_check.done():
+                self.__first_check = asyncio.ensure_future(self.initialize_all())
+            await asyncio.shield(self.__first_check)
+
+    def __get_node(self, exclude=()):
+        candidates = [n for n in self.nodes if n.healthy and n not in exclude]
+        if not candidates:
+            return None
+        return min(candidates, key=SpectredNode.score)
+
+    def __get_spectred(self):
+        node = self.__get_node()
+        if node is None:
+            raise SpectredCommunicationError("No healthy spectred node.")
+        return node.client
 
-        for t in tasks:
-            await t
+    def __hedge_delay(self, command):
+        if not self.hedge or command not in HEDGED_COMMANDS:
+            return None
+        # Only requests that may be hedged add to the budget
+        self.__hedge_tokens = min(self.__hedge_tokens + HEDGE_BUDGET, 10)
 
-    async def request(self, command, params=None, timeout=60):
+        latencies = self.__latencies[command]
+        if len(latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        recorded = self.__recorded[command]
+        p99 = self.__p99.get(command)
+        if p99 is None or recorded - p99[1] >= P99_REFRESH:
+            p99 = self.__p99[command] = (
+                sorted(latencies)[int(len(latencies) * 0.99)],
+                recorded,
+            )
+        return p99[0]
+
+    # Starts a request on the node, it counts as outstanding right away so that
+    # requests started at the same time are spread over the nodes
+    def __start_request(self, node, command, params, timeout, retry, raw):
+        node.outstanding += 1
+        return asyncio.create_task(
+            self.__request(node, command, params, timeout, retry, raw)
+        )
+
+    async def __request(self, node, command, params, timeout, retry, raw):
+        start = time.monotonic()
         try:
-            return await self.__get_spectred().request(
-                command, params, timeout=timeout, retry=1
+            resp = await node.client.request(
+                command, params, timeout=timeout, retry=retry, raw=raw
             )
         except SpectredCommunicationError:
-            await self.initialize_all()
-            return await self.__get_spectred().request(
-                command, params, timeout=timeout, retry=3
+            node.record(error=True)
+            node.healthy = False
+            _logger.debug(f"{node.name} failed, marked unhealthy")
+            raise
+        finally:
+            node.outstanding -= 1
+
+        latency = time.monotonic() - start
+        node.record(latency)
+        self.__latencies[command].append(latency)
+        self.__recorded[command] += 1
+        return resp
+
+    # Sends the request to the best node not in `tried` and, if it takes longer
+    # than usual, to the next best one too
+    async def __hedged_request(self, command, params, timeout, retry, raw, tried):
+        node = self.__get_node(tried)
+        if node is None:
+            raise SpectredCommunicationError("No healthy spectred node left.")
+        tried.add(node)
+
+        primary = self.__start_request(node, command, params, timeout, retry, raw)
+        tasks = [primary]
+        try:
+            delay = self.__hedge_delay(command)
+            if delay is None:
+                return await primary
+
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+            hedge_node = None
+            if not done and self.__hedge_tokens >= 1:
+                hedge_node = self.__get_node(tried)
+            if hedge_node is None:
+                return await primary
+
+            self.__hedge_tokens -= 1
+            self.hedged += 1
+            _logger.debug(f"Hedging {command} on {hedge_node.name} after {delay:.3f}s")
+            tried.add(hedge_node)
+            tasks.append(
+                self.__start_request(hedge_node, command, params, timeout, retry, raw)
+            )
+            pending = set(tasks)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                # Retrieve every exception, also that of a request that lost
+                errors = {task: task.exception() for task in done}
+                for task, e in errors.items():
+                    if e is None:
+                        return task.result()
+                    error = e
+            raise error
+        finally:
+            # Requests that lost, or that still run when the caller is
+            # cancelled, are cancelled rather than left running orphaned
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    async def request(self, command, params=None, timeout=60, raw=False):
+        await self.__checked()
+
+        # Fail over through the healthy nodes, then check all nodes again
+        tried = set()
+        while self.__get_node(tried) is not None:
+            try:
+                return await self.__hedged_request(
+                    command, params, timeout, 1, raw, tried
+                )
+            except SpectredCommunicationError:
+                _logger.debug(f"{command} failed, trying the next node")
+
+        await self.initialize_all()
+        return await self.__hedged_request(command, params, timeout, 3, raw, set())
+
+    # Runs independent requests concurrently, spread over the nodes. Takes
+    # (command, params) pairs and returns the responses in the same order.
+    async def request_many(self, requests, timeout=60, raw=False):
+        return await asyncio.gather(
+            *(
+                self.request(command, params, timeout=timeout, raw=raw)
+                for command, params in requests
             )
+        )
 
-    async def notify(self, command, params, callback):
-        return await self.__get_spectred().notify(command, params, callback)
+    async def notify(self, command, params, callback, raw=False):
+        await self.__checked()
+        return await self.__get_spectred().notify(command, params, callback, raw=raw)
@@ -0,0 +1,189 @@
+# encoding: utf-8
+import asyncio
+import logging
+import time
+from collections import defaultdict, deque
+
+import grpc
+from google.protobuf import json_format
+
+from . import messages_pb2_grpc
+from .SpectredThread import (
+    SpectredCommunicationError,
+    SpectredTimeoutError,
+    build_request,
+)
+
+_logger = logging.getLogger(__name__)
+
+
+def response_type(command):
+    # getBlocksRequest -> getBlocksResponse, GetSinkRequest -> GetSinkResponse
+    return command.removesuffix("Request") + "Response"
+
+
+class SpectredStream(object):
+    """
+    Long-lived bidirectional MessageStream session.
+
+    Requests are pipelined onto one open stream without waiting for earlier
+    responses. Every request gets a message id; responses are routed back by
+    the echoed id, or, if the node does not echo ids, to the oldest waiter of
+    the matching response type. Without echoed ids a stream takes no new
+    requests after a timeout, as the order of the responses may be lost.
+    """
+
+    def __init__(self, channel):
+        self.stub = messages_pb2_grpc.RPCStub(channel)
+
+        self.__outgoing = asyncio.queues.Queue()
+        self.__waiters = defaultdict(deque)
+        self.__next_id = 1
+        self.__call = None
+        self.__reader = None
+        self.__error = None
+        self.__ids_echoed = False
+        self.__retired = False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    @property
+    def is_open(self):
+        return self.__call is not None and self.__error is None and not self.__retired
+
+    @property
+    def in_flight(self):
+        # Requests still waiting for their responses
+        return sum(
+            not future.done() for w in self.__waiters.values() for _, future in w
+        )
+
+    def open(self):
+        if self.__call is None:
+            self.__call = self.stub.MessageStream(self.__requests())
+            self.__reader = asyncio.create_task(self.__read())
+
+    async def request(self, command, params=None, timeout=60, raw=False, trace=None):
+        # trace, if given, is a dict that gets the encode time and the message
+        # sizes for SpectredClient's hooks
+        if self.__error is not None:
+            raise self.__error
+        self.open()
+
+        start = time.perf_counter()
+        msg = build_request(command, params)
+        msg.id = self.__next_id
+        self.__next_id += 1
+
+        if trace is not None:
+            trace["encode_time"] = time.perf_counter() - start
+            trace["request_bytes"] = msg.ByteSize()
+
+        future = asyncio.get_running_loop().create_future()
+        self.__waiters[response_type(command)].append((msg.id, future))
+        self.__outgoing.put_nowait(msg)
+
+        try:
+            resp = await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError as e:
+            self.__abandon(response_type(command), msg.id)
+            raise SpectredTimeoutError(
+                f"Timeout after {timeout}s waiting for {response_type(command)}"
+            ) from e
+        except asyncio.CancelledError:
+            self.__abandon(response_type(command), msg.id)
+            raise
+
+        if trace is not None:
+            trace["response_bytes"] = resp.ByteSize()
+        return resp if raw else json_format.MessageToDict(resp)
+
+    async def close(self):
+        if self.__call is None:
+            return
+
+        self.__outgoing.put_nowait(None)
+        self.__call.cancel()
+        try:
+            await self.__reader
+        except asyncio.CancelledError:
+            pass
+
+        self.__fail_waiters(SpectredCommunicationError("Message stream closed."))
+        self.__call = None
+
+    async def __requests(self):
+        while (msg := await self.__outgoing.get()) is not None:
+            yield msg
+
+    async def __read(self):
+        try:
+            async for resp in self.__call:
+                self.__dispatch(resp)
+            error = SpectredCommunicationError("Message stream ended by node.")
+        except grpc.aio.AioRpcError as e:
+            error = SpectredCommunicationError(str(e))
+        except asyncio.CancelledError:
+            error = SpectredCommunicationError("Message stream closed.")
+
+        self.__error = error
+        self.__fail_waiters(error)
+
+    # Gives up waiting for a response, only this request fails. With echoed
+    # ids the late response is recognized and dropped. Otherwise the cancelled
+    # waiter stays queued to consume it, but if it never comes every later
+    # response of the type would go to the wrong waiter: the waiters of the
+    # type behind it fail, and the stream takes no new requests and closes
+    # once the others are answered.
+    def __abandon(self, payload, msg_id):
+        waiters = self.__waiters[payload]
+        entry = next((w for w in waiters if w[0] == msg_id), None)
+        if entry is None or not entry[1].cancel():
+            return
+
+        if self.__ids_echoed:
+            waiters.remove(entry)
+        else:
+            self.__retired = True
+            error = SpectredTimeoutError(
+                f"Order of {payload} messages lost after an earlier timeout"
+            )
+            for _, future in list(waiters)[waiters.index(entry) + 1 :]:
+                if not future.done():
+                    future.set_exception(error)
+        self.__close_when_idle()
+
+    def __close_when_idle(self):
+        if self.__retired and self.__call is not None and not self.in_flight:
+            # The reader fails no waiters then and ends the stream
+            self.__outgoing.put_nowait(None)
+            self.__call.cancel()
+
+    def __dispatch(self, resp):
+        payload = resp.WhichOneof("payload")
+        waiters = self.__waiters.get(payload)
+        if resp.id:
+            self.__ids_echoed = True
+            entry = next((w for w in waiters or () if w[0] == resp.id), None)
+        else:
+            entry = waiters[0] if waiters else None
+        if entry is None:
+            _logger.debug(f"Dropping unrequested {payload}")
+            return
+        waiters.remove(entry)
+
+        future = entry[1]
+        if not future.done():
+            future.set_result(resp)
+        self.__close_when_idle()
+
+    def __fail_waiters(self, error):
+        for waiters in self.__waiters.values():
+            for _, future in waiters:
+                if not future.done():
+                    future.set_exception(error)
+            waiters.clear()
@@ -1,5 +1,6 @@
 # encoding: utf-8
 import asyncio
+import time
 from queue import Queue
 
 import grpc
@@ -17,32 +18,54 @@ class SpectredCommunicationError(Exception):
     pass
 
 
+# No response in time, the connection itself may be fine
+class SpectredTimeoutError(SpectredCommunicationError):
+    pass
+
+
 # pipenv run python -m grpc_tools.protoc -I./protos --python_out=. --grpc_python_out=. ./protos/rpc.proto ./protos/messages.proto
 
 
+def create_channel(spectred_host, spectred_port, async_channel=True):
+    factory = grpc.aio.insecure_channel if async_channel else grpc.insecure_channel
+    return factory(
+        f"{spectred_host}:{spectred_port}",
+        compression=grpc.Compression.Gzip,
+        options=[
+            ("grpc.max_send_message_length", MAX_MESSAGE_LENGTH),
+            ("grpc.max_receive_message_length", MAX_MESSAGE_LENGTH),
+        ],
+    )
+
+
+def build_request(cmd, params=None):
+    msg = SpectredRequest()
+    msg2 = getattr(msg, cmd)
+    payload = params
+
+    if payload:
+        if isinstance(payload, dict):
+            json_format.ParseDict(payload, msg2)
+        if isinstance(payload, str):
+            json_format.Parse(payload, msg2)
+
+    msg2.SetInParent()
+    return msg
+
+
 class SpectredThread(object):
-    def __init__(self, spectred_host, spectred_port, async_thread=True):
+    def __init__(self, spectred_host, spectred_port, async_thread=True, channel=None):
         self.spectred_host = spectred_host
         self.spectred_port = spectred_port
 
-        if async_thread:
-            self.channel = grpc.aio.insecure_channel(
-                f"{spectred_host}:{spectred_port}",
-                compression=grpc.Compression.Gzip,
-                options=[
-                    ("grpc.max_send_message_length", MAX_MESSAGE_LENGTH),
-                    ("grpc.max_receive_message_length", MAX_MESSAGE_LENGTH),
-                ],
-            )
-        else:
-            self.channel = grpc.insecure_channel(
-                f"{spectred_host}:{spectred_port}",
-                compression=grpc.Compression.Gzip,
-                options=[
-                    ("grpc.max_send_message_length", MAX_MESSAGE_LENGTH),
-                    ("grpc.max_receive_message_length", MAX_MESSAGE_LENGTH),
-                ],
-            )
+        # A channel handed in by the caller (e.g. from a SpectredChannelPool) is
+        # shared and stays open after this thread is done with it.
+        self.owns_channel = channel is None
+        if channel is None:
+            channel = create_channel(spectred_host, spectred_port, async_thread)
+        self.channel = channel
+
+        if not async_thread:
             self.__sync_queue = Queue()
         self.stub = messages_pb2_grpc.RPCStub(self.channel)
 
@@ -56,53 +79,59 @@ class SpectredThread(object):
     def __exit__(self, *args):
         self.__closing = True
 
-    async def request(self, command, params=None, wait_for_response=True, timeout=5):
+    async def close(self):
+        self.__closing = True
+        if self.owns_channel:
+            await self.channel.close()
+
+    async def request(
+        self,
+        command,
+        params=None,
+        wait_for_response=True,
+        timeout=5,
+        raw=False,
+        trace=None,
+    ):
+        # trace, if given, is a dict that gets the encode time and the message
+        # sizes for SpectredClient's hooks
         if wait_for_response:
+            start = time.perf_counter()
+            msg = build_request(command, params)
+            if trace is not None:
+                trace["encode_time"] = time.perf_counter() - start
+                trace["request_bytes"] = msg.ByteSize()
             try:
                 async for resp in self.stub.MessageStream(
-                    self.yield_cmd(command, params), timeout=timeout
+                    self.yield_msg(msg), timeout=timeout
                 ):
                     self.__queue.put_nowait("done")
-                    return json_format.MessageToDict(resp)
+                    if trace is not None:
+                        trace["response_bytes"] = resp.ByteSize()
+                    return resp if raw else json_format.MessageToDict(resp)
             except grpc.aio._call.AioRpcError as e:
                 raise SpectredCommunicationError(str(e))
 
-    async def notify(self, command, params=None, callback_func=None):
+    async def notify(self, command, params=None, callback_func=None, raw=False):
         try:
             async for resp in self.stub.MessageStream(self.yield_cmd(command, params)):
                 # self.__queue.put_nowait("done")
                 if callback_func:
-                    await callback_func(json_format.MessageToDict(resp))
+                    await callback_func(
+                        resp if raw else json_format.MessageToDict(resp)
+                    )
 
         except (grpc.aio._call.AioRpcError, _MultiThreadedRendezvous) as e:
             raise SpectredCommunicationError(str(e))
 
     async def yield_cmd(self, cmd, params=None):
-        msg = SpectredRequest()
-        msg2 = getattr(msg, cmd)
-        payload = params
-
-        if payload:
-            if isinstance(payload, dict):
-                json_format.ParseDict(payload, msg2)
-            if isinstance(payload, str):
-                json_format.Parse(payload, msg2)
+        yield build_request(cmd, params)
+        await self.__queue.get()
 
-        msg2.SetInParent()
+    async def yield_msg(self, msg):
         yield msg
         await self.__queue.get()
 
     def yield_cmd_sync(self, cmd, params=None):
-        msg = SpectredRequest()
-        msg2 = getattr(msg, cmd)
-        payload = params
-
-        if payload:
-            if isinstance(payload, dict):
-                json_format.ParseDict(payload, msg2)
-            if isinstance(payload, str):
-                json_format.Parse(payload, msg2)
-
-        msg2.SetInParent()
-        yield msg
+        yield build_request(cmd, params)
         self.__sync_queue.get()
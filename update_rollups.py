@@ -0,0 +1,70 @@
+from datetime import datetime, timezone
+import argparse
+import os
+import sys
+
+from helper.block_store import find_blocks_file
+from helper.rollups import DAY, ROLLUPS_FILE, Rollups
+
+# Creates the hourly and daily rollups of the block store (see
+# helper/rollups.py) or brings them up to date, then prints the last days of
+# the store. Once the database exists save_blocks.py and ingest_blocks.py keep
+# it up to date themselves. Without a store the data/block.json dump of old
+# crawls is read.
+
+
+## Helpers
+def format_day(day):
+    return datetime.fromtimestamp(day / 1000, timezone.utc).strftime("%Y-%m-%d")
+
+
+def print_days(rollups, days):
+    rows = rollups.rows("daily")[-days:]
+    print(
+        f"{'day':<12}{'blocks':>9}{'chain':>7}{'merged':>9}{'txs':>10}"
+        f"{'outputs':>10}{'fees (SPR)':>14}{'miners':>8}"
+    )
+    for row in rows:
+        miners = len(rollups.miners(row["day"], row["day"] + DAY))
+        print(
+            f"{format_day(row['day']):<12}{row['blocks']:>9,}"
+            f"{row['chain_block_ratio']:>7.0%}"
+            f"{row['merged_blues'] + row['merged_reds']:>9,}{row['txs']:>10,}"
+            f"{row['outputs']:>10,}{row['fees'] / 100_000_000:>14,.2f}{miners:>8}"
+        )
+
+
+## Main
+def main(args):
+    blocks_file = find_blocks_file()
+    if not os.path.exists(blocks_file):
+        sys.exit(f"No block store at {blocks_file}, crawl one with save_blocks.py")
+
+    with Rollups(ROLLUPS_FILE) as rollups:
+        if args.rebuild:
+            rollups.reset()
+        blocks, hours = rollups.update(blocks_file)
+        print(f"Rollups: {blocks} blocks added, {hours} hours updated")
+        print_days(rollups, args.days)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Create or update the hourly and daily block rollups."
+    )
+    parser.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="recompute all hours from the whole store",
+    )
+    parser.add_argument(
+        "--days",
+        type=int,
+        default=14,
+        help="last days of the store to print (default: 14)",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main(parse_args())